@@ -0,0 +1,150 @@
+""" Admission control for the expensive report routes. At most
+HEAVY_REQUEST_LIMIT of them run at once on an instance, and up to
+HEAVY_REQUEST_QUEUE more wait up to HEAVY_REQUEST_QUEUE_TIMEOUT seconds for
+their turn. Anything beyond that is turned away with a 503, so that a burst
+of full reports can't take every gunicorn worker and database connection
+from the cheap requests.
+
+Slots are lock files under ADMISSION_DIR held with flock, which makes the
+limit shared by every worker process on the instance, and the kernel frees
+a slot as soon as the process holding it dies. Holders also mark their slot
+in a state file, so the slots in use can be counted without locking any. """
+
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+POLL_INTERVAL = 0.05
+HELD = b'1'
+FREE = b'0'
+
+
+class Saturated(Exception):
+
+    """ Raised when a heavy request can neither run nor queue """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super(Saturated, self).__init__(
+            'Too many report requests, retry in {0}s'.format(retry_after))
+
+
+class Slots:
+
+    """ A fixed number of slots shared between processes. A slot is held
+    while its lock file is locked by an open file descriptor, and marked
+    held by its byte in the state file """
+
+    def __init__(self, directory, name, size):
+        self.paths = [
+            os.path.join(directory, '{0}-{1}.lock'.format(name, index))
+            for index in range(size)
+        ]
+        self.state_path = os.path.join(directory, '{0}.state'.format(name))
+
+    def mark(self, index, state):
+        """ Record the state of a slot. Only the slot's holder writes its
+        byte, so no lock is needed """
+        fd = os.open(self.state_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            os.pwrite(fd, state, index)
+        finally:
+            os.close(fd)
+
+    def acquire(self):
+        """ Lock a free slot and return it, or None if all of them are
+        held """
+        for index, path in enumerate(self.paths):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.mark(index, HELD)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            except Exception:
+                os.close(fd)
+                raise
+            return index, fd
+        return None
+
+    def release(self, slot):
+        index, fd = slot
+        try:
+            self.mark(index, FREE)
+        finally:
+            # Closing the descriptor drops its lock
+            os.close(fd)
+
+    def held(self):
+        """ Number of slots marked held right now. A slot whose process died
+        holding it stays marked until it is next taken and released """
+        try:
+            with open(self.state_path, 'rb') as f:
+                return f.read(len(self.paths)).count(HELD)
+        except FileNotFoundError:
+            return 0
+
+
+def slots():
+    """ The running and queued slots configured for the app """
+    directory = current_app.config['ADMISSION_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return (
+        Slots(directory, 'running',
+              current_app.config['HEAVY_REQUEST_LIMIT']),
+        Slots(directory, 'queued', current_app.config['HEAVY_REQUEST_QUEUE']),
+    )
+
+
+def wait_for_slot(running, timeout):
+    """ Poll for a running slot until timeout seconds have passed """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        slot = running.acquire()
+        if slot is not None:
+            return slot
+    return None
+
+
+@contextmanager
+def admitted():
+    """ Run the block once a slot is free, waiting in the queue if there
+    is room in it. Raises Saturated otherwise. Does nothing when
+    HEAVY_REQUEST_LIMIT is 0 """
+    config = current_app.config
+    if not config['HEAVY_REQUEST_LIMIT']:
+        yield
+        return
+    running, queued = slots()
+    slot = running.acquire()
+    if slot is None:
+        place = queued.acquire()
+        if place is not None:
+            try:
+                slot = wait_for_slot(
+                    running, config['HEAVY_REQUEST_QUEUE_TIMEOUT'])
+            finally:
+                queued.release(place)
+    if slot is None:
+        raise Saturated(config['HEAVY_REQUEST_RETRY_AFTER'])
+    try:
+        yield
+    finally:
+        running.release(slot)
+
+
+def status():
+    """ Limits and current use of the slots on this instance """
+    config = current_app.config
+    running, queued = slots()
+    return {
+        'limit': config['HEAVY_REQUEST_LIMIT'],
+        'queue': config['HEAVY_REQUEST_QUEUE'],
+        'in_flight': running.held(),
+        'queued': queued.held(),
+    }
@@ -2,42 +2,54 @@ import io
 import csv
 import os
 
-from sqlalchemy import func
-from models import QuotaData, Quota
-from quotas import db
+from filters import filter_dates, resolve_ranges
+from models import LoadRun, QuotaData, Quota
+from database import db
+import records
 
 
 class QuotaDataResource(QuotaData):
 
-    def details(self):
-        """ Displays QuotaData in dict format """
+    @staticmethod
+    def data_dict(data):
+        """ Displays a QuotaData instance or record in dict format """
         return {
-            'quota_guid': self.quota,
-            'date_collected': str(self.date_collected),
-            'memory_limit': self.memory_limit,
-            'total_routes': self.total_routes,
-            'total_services': self.total_services,
+            'quota_guid': data.quota_guid,
+            'date_collected': str(data.date_collected),
+            'memory_limit': data.memory_limit,
+            'total_routes': data.total_routes,
+            'total_services': data.total_services,
         }
 
+    def details(self):
+        """ Displays QuotaData in dict format """
+        return self.data_dict(self)
+
     @classmethod
-    def aggregate(cls, quota_guid, start_date=None, end_date=None):
+    def aggregate(cls, quota_guid, start_date=None, end_date=None,
+                  date_ranges=None):
         """ Counts the number of days a specific memory setting has
-        been active """
-        q = db.session.query(cls.memory_limit, func.count(cls.date_collected))
-        if start_date and end_date:
-            q = q.filter(cls.date_collected.between(start_date, end_date))
-        q = q.filter_by(quota=quota_guid).group_by(cls.memory_limit)
-        return q.all()
+        been active, including compacted monthly history. Ranges must
+        cover compacted months whole """
+        date_ranges = resolve_ranges(start_date, end_date, date_ranges)
+        memory = records.memory_records(date_ranges, guids=[quota_guid])
+        # Keyed by the quota's integer id, which is the only key here
+        return next(iter(memory.values()), [])
 
 
 class QuotaResource(Quota):
 
-    def foreign_key_preparer(self, model, start_date=None, end_date=None):
+    @classmethod
+    def any_exist(cls):
+        """ Check if any quota has been loaded, without scanning """
+        return db.session.query(cls.guid).limit(1).first() is not None
+
+    def foreign_key_preparer(self, model, start_date=None, end_date=None,
+                             date_ranges=None):
         """ Prepares data from foreign keys """
-        data = model.query.filter_by(quota=self.guid)
-        if start_date and end_date:
-            data = data.filter(
-                model.date_collected.between(start_date, end_date))
+        date_ranges = resolve_ranges(start_date, end_date, date_ranges)
+        data = model.query.filter(model.quota_id == self.id)
+        data = filter_dates(data, model.date_collected, date_ranges)
         data = data.order_by(model.date_collected).all()
         return [item.details() for item in data]
 
@@ -66,76 +78,165 @@ class QuotaResource(Quota):
             str(row.get('created_at')),
         ]
 
-    def details(self):
-        """ Displays Quota in dict format """
+    @staticmethod
+    def quota_dict(quota):
+        """ Displays a Quota instance or record in dict format """
         return {
-            'guid': self.guid,
-            'name': self.name,
-            'created_at': str(self.created_at),
-            'updated_at': str(self.updated_at)
+            'guid': quota.guid,
+            'name': quota.name,
+            'created_at': str(quota.created_at),
+            'updated_at': str(quota.updated_at),
+            'foundation': quota.foundation,
         }
 
-    def data_details(self, start_date=None, end_date=None):
-        """ Displays Quota in dict format with data details """
-        memory_data = self.foreign_key_preparer(
-            model=QuotaDataResource, start_date=start_date, end_date=end_date)
-        return {
-            'guid': self.guid,
-            'name': self.name,
-            'created_at': str(self.created_at),
-            'updated_at': str(self.updated_at),
-            'memory': memory_data,
-        }
+    @classmethod
+    def aggregates_dict(cls, quota, memory_data):
+        """ Displays a Quota instance or record in dict format with its
+        memory aggregates and cost """
+        data = cls.quota_dict(quota)
+        data['memory'] = cls.prepare_memory_data(memory_data)
+        data['cost'] = cls.get_mem_cost(memory_data)
+        return data
 
-    def data_aggregates(self, start_date=None, end_date=None):
+    def details(self):
+        """ Displays Quota in dict format """
+        return self.quota_dict(self)
+
+    def data_details(self, start_date=None, end_date=None, date_ranges=None):
+        """ Displays Quota in dict format with data details """
+        data = self.quota_dict(self)
+        data['memory'] = self.foreign_key_preparer(
+            model=QuotaDataResource, start_date=start_date, end_date=end_date,
+            date_ranges=date_ranges)
+        return data
+
+    def data_aggregates(self, start_date=None, end_date=None,
+                        date_ranges=None):
         """ Displays Quota in dict format with data details """
         memory_data = QuotaDataResource.aggregate(
-            quota_guid=self.guid, start_date=start_date, end_date=end_date)
-        return {
-            'guid': self.guid,
-            'name': self.name,
-            'created_at': str(self.created_at),
-            'updated_at': str(self.updated_at),
-            'memory': self.prepare_memory_data(memory_data),
-            'cost': self.get_mem_cost(memory_data)
-        }
+            quota_guid=self.guid, start_date=start_date, end_date=end_date,
+            date_ranges=date_ranges)
+        return self.aggregates_dict(self, memory_data)
 
-    # Resources
+    # Resources, read through the Core queries in records.py
     @classmethod
-    def list_one_details(cls, guid, start_date=None, end_date=None):
+    def list_one_details(cls, guid, start_date=None, end_date=None,
+                         date_ranges=None):
         """ List one quota along with all data on memory usage and services """
-        quota = cls.query.filter_by(guid=guid).first()
-        if quota:
-            return quota.data_details(
-                start_date=start_date, end_date=end_date)
+        date_ranges = resolve_ranges(start_date, end_date, date_ranges)
+        quotas = records.quota_records(guids=[guid])
+        if quotas:
+            data = cls.quota_dict(quotas[0])
+            data['memory'] = [
+                QuotaDataResource.data_dict(row)
+                for row in records.data_records(guid, date_ranges)
+            ]
+            return data
 
     @classmethod
-    def list_one_aggregate(cls, guid, start_date=None, end_date=None):
+    def list_one_aggregate(cls, guid, start_date=None, end_date=None,
+                           date_ranges=None):
         """ List one quota and aggregation of service and memory usage
         by date """
-        quota = cls.query.filter_by(guid=guid).first()
-        if quota:
-            return quota.data_aggregates(
-                start_date=start_date, end_date=end_date)
+        date_ranges = resolve_ranges(start_date, end_date, date_ranges)
+        quotas = records.quota_records(guids=[guid])
+        if quotas:
+            memory = records.memory_records(date_ranges, guids=[guid])
+            return cls.aggregates_dict(
+                quotas[0], memory.get(quotas[0].id, []))
 
     @classmethod
-    def list_all(cls, start_date=None, end_date=None):
-        """ Lists all of the Quota data (This endpoint will be
-            refactored later) """
-        quotas = cls.query.order_by(cls.guid).all()
+    def list_many(cls, guids, start_date=None, end_date=None,
+                  date_ranges=None):
+        """ Lists the quotas in guids with their aggregates, in the same
+        two queries as list_all whatever the number of guids """
+        date_ranges = resolve_ranges(start_date, end_date, date_ranges)
+        quotas = records.quota_records(guids=guids)
+        memory = records.memory_records(date_ranges, guids=guids)
         return [
-            quota.data_aggregates(start_date=start_date, end_date=end_date)
+            cls.aggregates_dict(quota, memory.get(quota.id, []))
             for quota in quotas
         ]
 
     @classmethod
-    def generate_cvs(cls, start_date=None, end_date=None):
-        """ Return a csv version of the data starting with the header row """
+    def list_all(cls, **options):
+        """ Lists all of the Quota data with two queries, one for the
+        quotas and one for all of their aggregates. Filtering, sorting and
+        limiting happen in the first query, so the aggregates are only
+        read for the quotas returned """
+        return [
+            cls.aggregates_dict(quota, memory_data)
+            for quota, memory_data in cls.list_all_rows(**options)
+        ]
+
+    @classmethod
+    def list_all_rows(cls, start_date=None, end_date=None, date_ranges=None,
+                      foundation=None, sort=None, descending=False,
+                      limit=None, name_prefix=None, guid_prefix=None):
+        """ The quota records of list_all paired with their memory
+        aggregates, for serializers that build one quota at a time """
+        date_ranges = resolve_ranges(start_date, end_date, date_ranges)
+        filters = {
+            'foundation': foundation, 'name_prefix': name_prefix,
+            'guid_prefix': guid_prefix,
+        }
+        quotas = records.quota_records(
+            date_ranges=date_ranges, sort=sort, descending=descending,
+            limit=limit, **filters)
+        if limit is None:
+            memory = records.memory_records(date_ranges, **filters)
+        elif quotas:
+            memory = records.memory_records(
+                date_ranges, ids=[quota.id for quota in quotas])
+        else:
+            memory = {}
+        return [(quota, memory.get(quota.id, [])) for quota in quotas]
+
+    @classmethod
+    def generate_cvs(cls, start_date=None, end_date=None, date_ranges=None,
+                     **options):
+        """ Return a csv version of the data starting with the header row,
+        taking the filter and sort options of list_all """
         output = io.StringIO()
         writer = csv.writer(output)
         writer.writerow([
             'quota_name', 'quota_guid', 'quota_cost', 'quota_created_date'
         ])
-        for row in cls.list_all(start_date=start_date, end_date=end_date):
+        rows = cls.list_all(
+            start_date=start_date, end_date=end_date, date_ranges=date_ranges,
+            **options)
+        for row in rows:
             writer.writerow(cls.prepare_csv_row(row))
         return output.getvalue()
+
+
+class LoadRunResource(LoadRun):
+
+    def details(self):
+        """ Displays LoadRun in dict format """
+        return {
+            'id': self.id,
+            'started_at': str(self.started_at),
+            'finished_at': str(self.finished_at),
+            'status': self.status,
+            'pages_fetched': self.pages_fetched,
+            'http_time': self.http_time,
+            'db_time': self.db_time,
+            'rows_upserted': self.rows_upserted,
+            'errors': self.errors,
+            'duration': self.duration,
+            'error_message': self.error_message,
+            'foundation': self.foundation,
+        }
+
+    @classmethod
+    def last_success(cls):
+        """ The most recent run that finished successfully """
+        return cls.query.filter_by(status='success').order_by(
+            cls.id.desc()).first()
+
+    @classmethod
+    def list_recent(cls, limit=50):
+        """ Lists the most recent loader runs, newest first """
+        runs = cls.query.order_by(cls.started_at.desc()).limit(limit).all()
+        return [run.details() for run in runs]
@@ -0,0 +1,322 @@
+""" Benchmarks for the ingestion and reporting hot paths """
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+
+from flask import current_app
+from sqlalchemy import Integer, cast, func, select, union_all
+
+from api import QuotaResource, QuotaDataResource
+from database import db
+from filters import date_clause, resolve_ranges
+from models import Quota, QuotaData, QuotaDataMonthly
+import scripts
+
+MEMORY_SIZES = [512, 1024, 1875, 2048, 4096, 10240]
+
+
+class SyntheticCloudFoundry:
+
+    """ Stands in for the CloudFoundry client and yields generated quota
+    definitions instead of requesting them """
+
+    def __init__(self, quotas):
+        self.quotas = quotas
+
+    def get_quotas(self):
+        """ Get quota definitions """
+        for quota in self.quotas:
+            yield quota
+
+
+def generate_quota_definitions(n_quotas):
+    """ Generates quota definitions shaped like the resources returned by
+    /v2/quota_definitions """
+    definitions = []
+    for index in range(n_quotas):
+        guid = str(uuid.UUID(int=index))
+        definitions.append({
+            'metadata': {
+                'guid': guid,
+                'url': '/v2/quota_definitions/{0}'.format(guid),
+                'created_at': '2015-01-01T01:01:01Z',
+                'updated_at': '2015-01-01T01:01:01Z',
+            },
+            'entity': {
+                'name': 'quota_{0}'.format(index),
+                'memory_limit': MEMORY_SIZES[index % len(MEMORY_SIZES)],
+                'total_routes': 1000,
+                'total_services': 100,
+            }
+        })
+    return definitions
+
+
+def populate_database(n_quotas, n_days, chunk_size=10000):
+    """ Inserts n_quotas quotas with n_days of daily data each, ending
+    yesterday so that a load run still writes today's rows """
+    quota_rows = []
+    for definition in generate_quota_definitions(n_quotas):
+        quota_rows.append({
+            'guid': definition['metadata']['guid'],
+            'name': definition['entity']['name'],
+            'url': definition['metadata']['url'],
+            'created_at': datetime.datetime(2015, 1, 1),
+            'updated_at': datetime.datetime(2015, 1, 1),
+        })
+    db.session.execute(Quota.__table__.insert(), quota_rows)
+    quota_ids = dict(db.session.execute(
+        select([Quota.__table__.c.guid, Quota.__table__.c.id])).fetchall())
+
+    today = datetime.date.today()
+    data_rows = []
+    for index, quota in enumerate(quota_rows):
+        for day in range(1, n_days + 1):
+            # Change the memory limit every 30 days to produce several
+            # groups per quota in the aggregates
+            size = (index + day // 30) % len(MEMORY_SIZES)
+            data_rows.append({
+                'quota_id': quota_ids[quota['guid']],
+                'date_collected': today - datetime.timedelta(days=day),
+                'memory_limit': MEMORY_SIZES[size],
+                'total_routes': 1000,
+                'total_services': 100,
+            })
+            if len(data_rows) >= chunk_size:
+                db.session.execute(QuotaData.__table__.insert(), data_rows)
+                data_rows = []
+    if data_rows:
+        db.session.execute(QuotaData.__table__.insert(), data_rows)
+    db.session.commit()
+    return [quota['guid'] for quota in quota_rows]
+
+
+def time_call(func, repeat=3):
+    """ Calls func repeat times and returns its timings in seconds """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'mean': sum(timings) / len(timings),
+        'max': max(timings),
+        'repeat': repeat,
+    }
+
+
+def measure_allocations(func):
+    """ Calls func once and returns the peak memory it allocated and the
+    number of allocations still live when it returned, which includes the
+    objects it built for its result """
+    tracemalloc.start()
+    try:
+        result = func()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        'peak_bytes': peak,
+        'live_blocks': sum(stat.count for stat in snapshot.statistics(
+            'filename')),
+    }
+
+
+def measure_storage():
+    """ Size on disk of the data table, with its partitions and indexes,
+    and the time of a full scan over it """
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        size = connection.scalar(
+            "SELECT sum(pg_total_relation_size(c.oid)) FROM pg_class c "
+            "WHERE c.relname = 'data' OR c.oid IN ("
+            "SELECT i.inhrelid FROM pg_inherits i "
+            "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'data')")
+    elif connection.dialect.name == 'sqlite':
+        database = connection.engine.url.database
+        size = None
+        if database and database != ':memory:':
+            size = os.path.getsize(database)
+    else:
+        size = None
+    scan = time_call(lambda: connection.execute(
+        'SELECT count(*), sum(memory_limit) FROM data').fetchall())
+    return {'data_bytes': int(size) if size is not None else None,
+            'full_scan': scan}
+
+
+def aggregate_orm(quota, date_ranges):
+    """ QuotaDataResource.aggregate as it was before the Core read path:
+    an ORM query of the days per memory limit of one quota """
+    daily = select([
+        QuotaData.memory_limit.label('memory_limit'),
+        func.count(QuotaData.date_collected).label('days'),
+    ]).where(QuotaData.quota_id == quota.id).group_by(QuotaData.memory_limit)
+    monthly = select([
+        QuotaDataMonthly.memory_limit.label('memory_limit'),
+        QuotaDataMonthly.days.label('days'),
+    ]).where(QuotaDataMonthly.quota_id == quota.id)
+    daily_dates = date_clause(QuotaData.date_collected, date_ranges)
+    if daily_dates is not None:
+        daily = daily.where(daily_dates)
+        monthly = monthly.where(
+            date_clause(QuotaDataMonthly.month, date_ranges))
+    combined = union_all(daily, monthly).alias('combined')
+    q = db.session.query(
+        combined.c.memory_limit, cast(func.sum(combined.c.days), Integer))
+    q = q.group_by(combined.c.memory_limit)
+    return q.all()
+
+
+def list_all_orm(start_date, end_date):
+    """ The ORM read path list_all used before the Core read path in
+    records.py, kept here as the baseline it is benchmarked against: a
+    mapped instance and an ORM query per quota, which don't go through
+    records.py """
+    date_ranges = resolve_ranges(start_date, end_date)
+    quotas = QuotaResource.query.order_by(QuotaResource.guid).all()
+    listed = []
+    for quota in quotas:
+        memory_data = aggregate_orm(quota, date_ranges)
+        listed.append({
+            'guid': quota.guid,
+            'name': quota.name,
+            'created_at': str(quota.created_at),
+            'updated_at': str(quota.updated_at),
+            'foundation': quota.foundation,
+            'memory': QuotaResource.prepare_memory_data(memory_data),
+            'cost': QuotaResource.get_mem_cost(memory_data),
+        })
+    return listed
+
+
+def run_benchmarks(database_uri, n_quotas, n_days, repeat=3):
+    """ Builds a synthetic database at database_uri and times the hot
+    paths against it. The tables at database_uri are dropped when the run
+    finishes, so never point this at a database with real data """
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    db.session.remove()
+    backend = db.engine.url.get_backend_name()
+    db.drop_all()
+    db.create_all()
+    try:
+        start = time.perf_counter()
+        guids = populate_database(n_quotas=n_quotas, n_days=n_days)
+        populate_time = time.perf_counter() - start
+
+        start_date = datetime.date.today() - datetime.timedelta(days=n_days)
+        end_date = datetime.date.today()
+        quota = QuotaResource.query.filter_by(guid=guids[0]).first()
+        cf_api = SyntheticCloudFoundry(generate_quota_definitions(n_quotas))
+
+        timings = {
+            'load_quotas': time_call(
+                lambda: scripts.load_quotas(cf_api=cf_api), repeat=repeat),
+            'list_all': time_call(
+                lambda: QuotaResource.list_all(
+                    start_date=start_date, end_date=end_date),
+                repeat=repeat),
+            'list_one_aggregate': time_call(
+                lambda: QuotaResource.list_one_aggregate(
+                    guid=guids[0], start_date=start_date, end_date=end_date),
+                repeat=repeat),
+            'foreign_key_preparer': time_call(
+                lambda: quota.foreign_key_preparer(
+                    QuotaDataResource,
+                    start_date=start_date, end_date=end_date),
+                repeat=repeat),
+            'generate_cvs': time_call(
+                lambda: QuotaResource.generate_cvs(
+                    start_date=start_date, end_date=end_date),
+                repeat=repeat),
+            'list_all_orm': time_call(
+                lambda: list_all_orm(start_date, end_date), repeat=repeat),
+        }
+        storage = measure_storage()
+        db.session.expunge_all()
+        allocations = {
+            'list_all': measure_allocations(
+                lambda: QuotaResource.list_all(
+                    start_date=start_date, end_date=end_date)),
+            'list_all_orm': measure_allocations(
+                lambda: list_all_orm(start_date, end_date)),
+        }
+    finally:
+        db.session.remove()
+        db.drop_all()
+    return {
+        'backend': backend,
+        'populate': populate_time,
+        'timings': timings,
+        'allocations': allocations,
+        'storage': storage,
+    }
+
+
+def git_revision():
+    """ Returns the current commit hash, if the code is in a git checkout """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, out_dir, prefix='bench'):
+    """ Writes a benchmark run to out_dir as a timestamped json file """
+    os.makedirs(out_dir, exist_ok=True)
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    path = os.path.join(out_dir, '{0}-{1}.json'.format(prefix, timestamp))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return path
+
+
+def measure_startup(repeat=3):
+    """ Times how long a fresh interpreter takes to import the WSGI app and
+    to start manage.py, which every gunicorn worker and CLI command pays """
+    commands = {
+        'import_wsgi': [sys.executable, '-c', 'import wsgi'],
+        'manage_help': [sys.executable, 'manage.py', '--help'],
+    }
+    root = os.path.dirname(os.path.abspath(__file__))
+    timings = {}
+    for name, command in commands.items():
+        timings[name] = time_call(
+            lambda: subprocess.check_call(
+                command, cwd=root, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL),
+            repeat=repeat)
+    return timings
+
+
+def run(database_uris, n_quotas, n_days, repeat, out_dir):
+    """ Runs the benchmarks against every database and records the results """
+    original_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'quotas': n_quotas,
+        'days': n_days,
+        'runs': [],
+        'startup': measure_startup(repeat=repeat),
+    }
+    try:
+        for uri in database_uris:
+            results['runs'].append(
+                run_benchmarks(uri, n_quotas, n_days, repeat=repeat))
+    finally:
+        current_app.config['SQLALCHEMY_DATABASE_URI'] = original_uri
+        db.session.remove()
+    return results, save_results(results, out_dir)
@@ -6,7 +6,11 @@ echo "------ Starting APP ------"
 if [ $CF_INSTANCE_INDEX = "0" ]; then
     echo "----- Apply Migrations -----"
     python manage.py db upgrade
+    # Load in the background so the app is up while the crawl runs,
+    # /readyz reports when data is available
     echo "----- Load Database -----"
-    python manage.py update_database
+    python manage.py update_database &
+    echo "----- Start Scheduler -----"
+    python manage.py scheduler &
 fi
-gunicorn quotas:app --log-file -
+exec gunicorn -c gunicorn_config.py wsgi:app
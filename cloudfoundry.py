@@ -1,6 +1,102 @@
+import codecs
+import json
 import time
 import requests
 
+# The largest page the Cloud Foundry v2 API returns
+RESULTS_PER_PAGE = 100
+CHUNK_SIZE = 16 * 1024
+# Seconds to wait to connect and then between bytes of a response, so a
+# foundation that stops answering fails its load instead of hanging it
+REQUEST_TIMEOUT = (10, 60)
+
+decoder = json.JSONDecoder()
+
+
+class PartialJSON(Exception):
+
+    """ Raised when the buffered text ends before the current value """
+
+
+def skip_whitespace(text, pos):
+    """ Index of the first non whitespace character at or after pos """
+    while pos < len(text) and text[pos] in ' \t\n\r':
+        pos += 1
+    return pos
+
+
+def iter_json_resources(chunks, page):
+    """ Incrementally parses a JSON page object read in chunks of text,
+    yielding each item of its `resources` array as soon as it is complete.
+    The other top level keys, e.g. next_url, are stored in page. Only the
+    value being parsed is buffered, so memory doesn't grow with the page """
+    chunks = iter(chunks)
+    state = {'buffer': '', 'done': False}
+
+    def read_more():
+        chunk = next(chunks, None)
+        if chunk is None:
+            if state['done']:
+                raise ValueError('Truncated JSON page')
+            state['done'] = True
+        else:
+            state['buffer'] += chunk
+
+    def expect(char):
+        """ Consume char, after any whitespace, or return False """
+        while True:
+            pos = skip_whitespace(state['buffer'], 0)
+            if pos < len(state['buffer']):
+                if state['buffer'][pos] != char:
+                    return False
+                state['buffer'] = state['buffer'][pos + 1:]
+                return True
+            state['buffer'] = ''
+            read_more()
+
+    def value():
+        """ Decode the next complete value and drop it from the buffer """
+        while True:
+            text = state['buffer']
+            pos = skip_whitespace(text, 0)
+            try:
+                obj, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                read_more()
+                continue
+            # A number at the end of the buffer may continue in the next
+            # chunk, so wait for the character that ends it
+            if end == len(text) and not state['done']:
+                read_more()
+                continue
+            state['buffer'] = text[end:]
+            return obj
+
+    if not expect('{'):
+        raise ValueError('Expected a JSON object')
+    if expect('}'):
+        return
+    while True:
+        key = value()
+        if not expect(':'):
+            raise ValueError('Expected : after {0}'.format(key))
+        if key == 'resources':
+            if not expect('['):
+                raise ValueError('Expected resources to be a list')
+            if not expect(']'):
+                while True:
+                    yield value()
+                    if expect(']'):
+                        break
+                    if not expect(','):
+                        raise ValueError('Expected , between resources')
+        else:
+            page[key] = value()
+        if expect('}'):
+            return
+        if not expect(','):
+            raise ValueError('Expected , between keys')
+
 
 class CloudFoundry:
 
@@ -12,6 +108,8 @@ class CloudFoundry:
         self.uaa_url = uaa_url
         self.username = username
         self.password = password
+        self.pages_fetched = 0
+        self.http_time = 0.0
         self.request_token()
 
     def request_token(self):
@@ -26,7 +124,9 @@ class CloudFoundry:
             'password': self.password,
             'grant_type': 'password'
         }
-        r = requests.post(url=token_url, headers=headers, params=params)
+        r = requests.post(
+            url=token_url, headers=headers, params=params,
+            timeout=REQUEST_TIMEOUT)
         self.token = r.json()
         self.token['time_stamp'] = time.time()
 
@@ -37,28 +137,70 @@ class CloudFoundry:
             self.request_token()
         return self.token['access_token']
 
-    def make_request(self, endpoint):
+    def make_request(self, endpoint, params=None, stream=False):
         """ Make request to specific endpoint """
         token = self.prepare_token()
         url = '{0}{1}'.format(self.api_url, endpoint)
         headers = {'authorization': 'bearer ' + token}
-        req = requests.get(url=url, headers=headers)
+        start = time.time()
+        req = requests.get(
+            url=url, headers=headers, params=params, stream=stream,
+            timeout=REQUEST_TIMEOUT)
+        self.http_time += time.time() - start
         return req
 
+    def first_page_params(self, endpoint):
+        """ Ask for the largest pages on the first request, the next_url of
+        later pages already carries the page size """
+        if 'results-per-page' in endpoint:
+            return None
+        return {'results-per-page': RESULTS_PER_PAGE}
+
     def yield_request(self, endpoint):
         """ Yield all of the request pages """
+        params = self.first_page_params(endpoint)
         while endpoint:
-            req = self.make_request(endpoint=endpoint).json()
+            req = self.make_request(endpoint=endpoint, params=params).json()
+            self.pages_fetched += 1
             endpoint = req.get('next_url')
+            params = None
             yield req
 
+    def read_chunks(self, response):
+        """ Yields the body of a streamed response as text, counting the
+        time spent waiting on the network """
+        text = codecs.getincrementaldecoder('utf-8')()
+        chunks = iter(response.iter_content(chunk_size=CHUNK_SIZE))
+        while True:
+            start = time.time()
+            chunk = next(chunks, None)
+            self.http_time += time.time() - start
+            if chunk is None:
+                break
+            yield text.decode(chunk)
+        yield text.decode(b'', final=True)
+
+    def yield_resources(self, endpoint):
+        """ Yield the resources of every page, decoding each page as it is
+        read instead of buffering it whole """
+        params = self.first_page_params(endpoint)
+        while endpoint:
+            response = self.make_request(
+                endpoint=endpoint, params=params, stream=True)
+            page = {}
+            try:
+                for resource in iter_json_resources(
+                        self.read_chunks(response), page):
+                    yield resource
+            finally:
+                response.close()
+            self.pages_fetched += 1
+            endpoint = page.get('next_url')
+            params = None
+
     def get_quotas(self):
         """ Get quota definitions """
-        quotas_gen = self.yield_request(endpoint='/v2/quota_definitions')
-        for quota_bundle in quotas_gen:
-            if 'resources' in quota_bundle:
-                for quota in quota_bundle['resources']:
-                    yield quota
+        return self.yield_resources(endpoint='/v2/quota_definitions')
 
     def get_orgs(self):
         """ Get org data """
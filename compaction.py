@@ -0,0 +1,84 @@
+""" Rolls daily QuotaData older than the retention horizon into monthly
+rows. Each batch of quotas is compacted and deleted in its own short
+transaction, so the job never holds locks on more than a batch of rows
+and can be stopped and rerun at any point. """
+
+import datetime
+import logging
+
+from sqlalchemy import func
+
+from models import QuotaData, QuotaDataMonthly
+from partitions import add_months, month_start
+from database import db
+
+
+def compaction_cutoff(horizon_days, today=None):
+    """ Daily rows before the returned date are compacted. The cutoff is
+    rounded down to a month boundary so only whole months are compacted """
+    today = today or datetime.date.today()
+    return month_start(today - datetime.timedelta(days=horizon_days))
+
+
+def quotas_in_month(month, batch_size):
+    """ Ids of up to batch_size quotas with daily rows in month """
+    rows = db.session.query(QuotaData.quota_id).filter(
+        QuotaData.date_collected >= month,
+        QuotaData.date_collected < add_months(month, 1),
+    ).distinct().order_by(QuotaData.quota_id).limit(batch_size).all()
+    return [row[0] for row in rows]
+
+
+def compact_batch(month, quota_ids):
+    """ Compact one month of daily rows for the quotas in quota_ids and
+    delete them, in one transaction. Returns the number of daily rows
+    removed """
+    in_month = (
+        QuotaData.quota_id.in_(quota_ids),
+        QuotaData.date_collected >= month,
+        QuotaData.date_collected < add_months(month, 1),
+    )
+    aggregates = db.session.query(
+        QuotaData.quota_id,
+        func.coalesce(QuotaData.memory_limit, 0),
+        func.count(QuotaData.date_collected),
+    ).filter(*in_month).group_by(
+        QuotaData.quota_id, func.coalesce(QuotaData.memory_limit, 0)).all()
+    existing = {
+        (row.quota_id, row.memory_limit): row
+        for row in QuotaDataMonthly.query.filter(
+            QuotaDataMonthly.quota_id.in_(quota_ids),
+            QuotaDataMonthly.month == month)
+    }
+    for quota_id, memory_limit, days in aggregates:
+        monthly = existing.get((quota_id, memory_limit))
+        if monthly is None:
+            monthly = QuotaDataMonthly(
+                quota_id=quota_id, month=month, memory_limit=memory_limit)
+            db.session.add(monthly)
+        monthly.days += days
+    deleted = QuotaData.query.filter(*in_month).delete(
+        synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def compact(horizon_days, batch_size=100, today=None):
+    """ Compact all daily rows older than the horizon, month by month.
+    Returns the number of daily rows removed """
+    cutoff = compaction_cutoff(horizon_days, today=today)
+    oldest = db.session.query(func.min(QuotaData.date_collected)).filter(
+        QuotaData.date_collected < cutoff).scalar()
+    if oldest is None:
+        logging.info('No data older than %s to compact', cutoff)
+        return 0
+    deleted = 0
+    month = month_start(oldest)
+    while month < cutoff:
+        quota_ids = quotas_in_month(month, batch_size)
+        while quota_ids:
+            deleted += compact_batch(month, quota_ids)
+            quota_ids = quotas_in_month(month, batch_size)
+        logging.info('Compacted %s', month.strftime('%Y-%m'))
+        month = add_months(month, 1)
+    return deleted
@@ -1,5 +1,27 @@
+import json
 import os
 
+# gunicorn workers each hold their own pool, so the per worker pool is
+# sized to keep all workers on an instance within the connection budget
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 2))
+DB_CONNECTION_BUDGET = int(os.environ.get('DB_CONNECTION_BUDGET', 10))
+
+
+def cf_foundations():
+    """ Foundations the loader collects from. CF_FOUNDATIONS holds a JSON
+    list of objects with a name, api_url, uaa_url, username and password.
+    Without it the single foundation in CF_API_URL, CF_UAA_URL,
+    CF_USERNAME and CF_PASSWORD is used """
+    if os.environ.get('CF_FOUNDATIONS'):
+        return json.loads(os.environ['CF_FOUNDATIONS'])
+    return [{
+        'name': os.environ.get('CF_FOUNDATION_NAME', 'default'),
+        'api_url': os.environ.get('CF_API_URL'),
+        'uaa_url': os.environ.get('CF_UAA_URL'),
+        'username': os.environ.get('CF_USERNAME'),
+        'password': os.environ.get('CF_PASSWORD'),
+    }]
+
 
 class Config(object):
     DEBUG = False
@@ -7,8 +29,66 @@ class Config(object):
     CSRF_ENABLED = True
     SECRET_KEY = os.environ.get('SECRET_KEY', "None")
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get(
+        'DB_POOL_SIZE', max(2, DB_CONNECTION_BUDGET // WEB_CONCURRENCY)))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+    SQLALCHEMY_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    # RDS closes connections that sit idle, recycle them before it does
+    SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 300))
+    SQLALCHEMY_POOL_PRE_PING = os.environ.get(
+        'DB_POOL_PRE_PING', 'true') == 'true'
+    # Reporting reads go to the replica when one is configured
+    SQLALCHEMY_BINDS = (
+        {'replica': os.environ['REPLICA_DATABASE_URL']}
+        if os.environ.get('REPLICA_DATABASE_URL') else None)
+    SQLALCHEMY_REPLICA_MAX_LAG = int(os.environ.get('REPLICA_MAX_LAG', 60))
+    SQLALCHEMY_REPLICA_CHECK_INTERVAL = int(
+        os.environ.get('REPLICA_CHECK_INTERVAL', 30))
+    # Milliseconds, applied to Postgres connections only
+    SQLALCHEMY_STATEMENT_TIMEOUT = int(
+        os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+    # Milliseconds for report jobs and the manage.py batch commands, 0 for
+    # no limit
+    JOB_STATEMENT_TIMEOUT = int(os.environ.get('DB_JOB_STATEMENT_TIMEOUT', 0))
     USERNAME = os.environ.get('SECRET_USERNAME', 'admin')
     PASSWORD = os.environ.get('SECRET_PASSWORD', 'admin')
+    # Daily data older than this is compacted into monthly rows
+    COMPACT_HORIZON_DAYS = int(os.environ.get('COMPACT_HORIZON_DAYS', 548))
+    PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+    CF_FOUNDATIONS = cf_foundations()
+    # Quotas written per transaction, and batches fetched ahead of the writes
+    LOADER_BATCH_SIZE = int(os.environ.get('LOADER_BATCH_SIZE', 100))
+    LOADER_QUEUE_SIZE = int(os.environ.get('LOADER_QUEUE_SIZE', 4))
+    # Most guids one /api/quotas/batch request may ask for
+    BATCH_MAX_GUIDS = int(os.environ.get('BATCH_MAX_GUIDS', 500))
+    # Report jobs are built in the background and kept on local disk
+    REPORTS_DIR = os.environ.get('REPORTS_DIR', '/tmp/quotas-reports')
+    REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 2))
+    REPORT_JOB_TIMEOUT = int(os.environ.get('REPORT_JOB_TIMEOUT', 1800))
+    REPORT_MAX_AGE = int(os.environ.get('REPORT_MAX_AGE', 86400))
+    # Write the standard reports to the database after every load, and
+    # serve requests for them from it
+    PRECOMPUTED_REPORTS = os.environ.get(
+        'PRECOMPUTED_REPORTS', 'true') == 'true'
+    # Full reports running at once per instance, leaving a worker free for
+    # cheap requests, and how many more may wait for a turn. A waiting sync
+    # worker is a held worker, so by default only the workers left over
+    # after that one may wait. 0 disables it
+    HEAVY_REQUEST_LIMIT = int(os.environ.get(
+        'HEAVY_REQUEST_LIMIT', max(1, WEB_CONCURRENCY - 1)))
+    HEAVY_REQUEST_QUEUE = int(os.environ.get(
+        'HEAVY_REQUEST_QUEUE',
+        max(0, WEB_CONCURRENCY - 1 - HEAVY_REQUEST_LIMIT)))
+    HEAVY_REQUEST_QUEUE_TIMEOUT = float(
+        os.environ.get('HEAVY_REQUEST_QUEUE_TIMEOUT', 2))
+    HEAVY_REQUEST_RETRY_AFTER = int(
+        os.environ.get('HEAVY_REQUEST_RETRY_AFTER', 5))
+    ADMISSION_DIR = os.environ.get('ADMISSION_DIR', '/tmp/quotas-admission')
+    # Rows per Parquet row group, and so per fetch, of the data export
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 50000))
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION') == 'true'
+    INSTRUMENTATION_N_PLUS_ONE = int(
+        os.environ.get('INSTRUMENTATION_N_PLUS_ONE', 10))
 
 
 class ProductionConfig(Config):
@@ -28,3 +108,7 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite:///test.db"
+    SQLALCHEMY_BINDS = None
+    REPORTS_DIR = 'test_reports'
+    PRECOMPUTED_REPORTS = False
+    ADMISSION_DIR = 'test_admission'
@@ -0,0 +1,215 @@
+""" Flask-SQLAlchemy binding with the engine tuning used in deployment
+and routing of reporting reads to a read replica """
+
+import logging
+import time
+from contextlib import contextmanager
+
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import Pool
+
+POOL_OPTIONS = ['pool_size', 'pool_timeout', 'pool_recycle', 'max_overflow']
+REPLICA_BIND = 'replica'
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Test connections as they leave the pool so that connections the
+    database dropped while idle are replaced instead of failing a request """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool retries the checkout with a fresh connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def replica_lag(connection):
+    """ Seconds the replica is behind the primary. Only Postgres streaming
+    replicas can lag, other backends always report 0 """
+    if connection.dialect.name != 'postgresql':
+        return 0
+    return connection.scalar(
+        'SELECT CASE '
+        'WHEN NOT pg_is_in_recovery() THEN 0 '
+        'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) '
+        'END')
+
+
+class RoutingSession(SignallingSession):
+
+    """ Session that sends reads to the read replica while use_replica is
+    set. Writes always go to the primary, and so do the reads that follow
+    a write, which the replica may not have yet. A read the replica fails
+    to serve for want of a connection is retried once on the primary """
+
+    def __init__(self, db, **options):
+        self.router = db
+        self.use_replica = False
+        self.has_written = False
+        self.reading_replica = False
+        self.statement_timeout = None
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        self.reading_replica = False
+        if not self.use_replica:
+            return SignallingSession.get_bind(self, mapper, clause)
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.has_written = True
+        elif not self.has_written:
+            replica = self.router.get_replica_engine(self.app)
+            if replica is not None:
+                self.reading_replica = True
+                return replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def _connection_for_bind(self, engine, execution_options=None, **kw):
+        try:
+            return SignallingSession._connection_for_bind(
+                self, engine, execution_options, **kw)
+        except exc.DBAPIError:
+            if not self.reading_replica:
+                raise
+            self.router.replica_failed(self.app)
+            self.reading_replica = False
+            return SignallingSession._connection_for_bind(
+                self, self.router.get_engine(self.app), execution_options,
+                **kw)
+
+    def execute(self, clause, params=None, mapper=None, bind=None, **kw):
+        try:
+            return SignallingSession.execute(
+                self, clause, params, mapper, bind, **kw)
+        except exc.DBAPIError as error:
+            # Only a replica connection that was lost is worth a retry, not
+            # a statement the replica rejected
+            if bind is not None or not self.reading_replica or \
+                    not error.connection_invalidated:
+                raise
+            self.router.replica_failed(self.app)
+            return SignallingSession.execute(
+                self, clause, params, mapper, bind, **kw)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def apply_statement_timeout(session, transaction, connection):
+    """ Give each transaction the session begins the session's statement
+    timeout. SET LOCAL ends with the transaction, so the connection goes
+    back to the pool with the timeout it was opened with """
+    if session.statement_timeout is not None and \
+            connection.dialect.name == 'postgresql':
+        connection.execute('SET LOCAL statement_timeout = {0:d}'.format(
+            session.statement_timeout))
+
+
+class Database(SQLAlchemy):
+
+    """ Applies the pool and statement settings from the app config and
+    routes reads to the engine bound as `replica` in SQLALCHEMY_BINDS """
+
+    def __init__(self, *args, **kwargs):
+        self._replica_health = {}
+        super(Database, self).__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    @contextmanager
+    def replica(self):
+        """ Send the reads made inside the block to the read replica,
+        falling back to the primary when the replica is unhealthy. Once
+        the session writes, the rest of the block reads from the primary
+        so that it sees its own writes """
+        session = self.session()
+        previous = session.use_replica
+        session.use_replica = True
+        try:
+            yield
+        finally:
+            session.use_replica = previous
+            if not previous:
+                session.has_written = False
+
+    @contextmanager
+    def statement_timeout(self, timeout):
+        """ Run the transactions begun inside the block with a statement
+        timeout of timeout milliseconds, 0 for none, instead of
+        SQLALCHEMY_STATEMENT_TIMEOUT. For report jobs and batch commands,
+        which are expected to outlast a request """
+        session = self.session()
+        previous = session.statement_timeout
+        session.statement_timeout = timeout
+        try:
+            yield
+        finally:
+            session.statement_timeout = previous
+
+    def get_replica_engine(self, app):
+        """ Returns the replica engine if one is configured and healthy """
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        uri = binds.get(REPLICA_BIND)
+        if not uri:
+            return None
+        engine = self.get_engine(app, bind=REPLICA_BIND)
+        checked_at, healthy = self._replica_health.get(uri, (None, False))
+        interval = app.config.get('SQLALCHEMY_REPLICA_CHECK_INTERVAL', 30)
+        now = time.time()
+        if checked_at is None or now - checked_at >= interval:
+            healthy = self.check_replica(app, engine)
+            self._replica_health[uri] = (now, healthy)
+        if healthy:
+            return engine
+
+    def replica_failed(self, app):
+        """ Read from the primary until the replica's next health check,
+        after the replica failed a read """
+        uri = app.config['SQLALCHEMY_BINDS'][REPLICA_BIND]
+        self._replica_health[uri] = (time.time(), False)
+        logging.warning('Replica connection failed, reading from the primary')
+
+    def check_replica(self, app, engine):
+        """ Check that the replica is reachable and not lagging more than
+        SQLALCHEMY_REPLICA_MAX_LAG seconds behind the primary """
+        try:
+            connection = engine.connect()
+            try:
+                lag = replica_lag(connection)
+            finally:
+                connection.close()
+        except exc.SQLAlchemyError:
+            logging.warning('Replica unavailable, reading from the primary')
+            return False
+        max_lag = app.config.get('SQLALCHEMY_REPLICA_MAX_LAG')
+        if lag is not None and max_lag is not None and lag > max_lag:
+            logging.warning(
+                'Replica is %.0fs behind, reading from the primary', lag)
+            return False
+        return True
+
+    def init_app(self, app):
+        super(Database, self).init_app(app)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            if not event.contains(Pool, 'checkout', ping_connection):
+                event.listen(Pool, 'checkout', ping_connection)
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite':
+            # SQLite connections can't be shared between threads, so let
+            # Flask-SQLAlchemy choose the sqlite pool
+            for option in POOL_OPTIONS:
+                options.pop(option, None)
+        elif info.drivername.startswith('postgres'):
+            timeout = app.config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+            if timeout:
+                connect_args = options.setdefault('connect_args', {})
+                connect_args['options'] = '-c statement_timeout={0}'.format(
+                    timeout)
+        super(Database, self).apply_driver_hacks(app, info, options)
+
+
+db = Database()
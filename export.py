@@ -0,0 +1,134 @@
+""" Bulk export of the daily data, joined to its quota, as a Parquet file.
+Compacted monthly history comes first, one row per quota, month and memory
+limit with its number of days, then the daily rows, each counting one day.
+Rows are read from a server side cursor and written in row groups of
+EXPORT_BATCH_SIZE rows, so memory use is bounded by the batch size whatever
+the date range. pyarrow is imported on first use to keep it out of the
+startup of every worker. """
+
+from sqlalchemy import literal_column, null, select
+
+from database import db
+from filters import date_clause
+from records import (
+    check_compacted_ranges, data_table, monthly_table, quota_table)
+
+PARQUET = 'application/vnd.apache.parquet'
+COLUMNS = [
+    ('quota_guid', quota_table.c.guid),
+    ('quota_name', quota_table.c.name),
+    ('foundation', quota_table.c.foundation),
+    ('date_collected', data_table.c.date_collected),
+    ('month', null()),
+    ('memory_limit', data_table.c.memory_limit),
+    ('total_routes', data_table.c.total_routes),
+    ('total_services', data_table.c.total_services),
+    ('days', literal_column('1')),
+]
+MONTHLY_COLUMNS = [
+    ('quota_guid', quota_table.c.guid),
+    ('quota_name', quota_table.c.name),
+    ('foundation', quota_table.c.foundation),
+    ('date_collected', null()),
+    ('month', monthly_table.c.month),
+    ('memory_limit', monthly_table.c.memory_limit),
+    ('total_routes', null()),
+    ('total_services', null()),
+    ('days', monthly_table.c.days),
+]
+
+
+def export_schema():
+    import pyarrow as pa
+    return pa.schema([
+        pa.field('quota_guid', pa.string()),
+        pa.field('quota_name', pa.string()),
+        pa.field('foundation', pa.string()),
+        pa.field('date_collected', pa.date32()),
+        pa.field('month', pa.date32()),
+        pa.field('memory_limit', pa.int64()),
+        pa.field('total_routes', pa.int64()),
+        pa.field('total_services', pa.int64()),
+        pa.field('days', pa.int64()),
+    ])
+
+
+def export_query(date_ranges):
+    """ Daily data within date_ranges with the details of its quota,
+    ordered by quota and date """
+    query = select([
+        column.label(name) for name, column in COLUMNS
+    ]).select_from(
+        data_table.join(quota_table, data_table.c.quota_id == quota_table.c.id)
+    )
+    clause = date_clause(data_table.c.date_collected, date_ranges)
+    if clause is not None:
+        query = query.where(clause)
+    return query.order_by(
+        data_table.c.quota_id, data_table.c.date_collected
+    ).execution_options(stream_results=True)
+
+
+def monthly_export_query(date_ranges):
+    """ Compacted months within date_ranges with the details of their
+    quota, ordered by quota, month and memory limit """
+    query = select([
+        column.label(name) for name, column in MONTHLY_COLUMNS
+    ]).select_from(
+        monthly_table.join(
+            quota_table, monthly_table.c.quota_id == quota_table.c.id)
+    )
+    clause = date_clause(monthly_table.c.month, date_ranges)
+    if clause is not None:
+        query = query.where(clause)
+    return query.order_by(
+        monthly_table.c.quota_id, monthly_table.c.month,
+        monthly_table.c.memory_limit
+    ).execution_options(stream_results=True)
+
+
+def export_batches(date_ranges, batch_size):
+    """ Lists of up to batch_size rows of the export, compacted months
+    first, read from the database as they are needed """
+    for query in (monthly_export_query(date_ranges),
+                  export_query(date_ranges)):
+        result = db.session.execute(query)
+        try:
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            result.close()
+
+
+def record_batch(rows, schema):
+    """ Turn a list of rows into an Arrow record batch, column by column """
+    import pyarrow as pa
+    columns = list(zip(*rows))
+    arrays = [
+        pa.array(list(values), type=field.type)
+        for values, field in zip(columns, schema)
+    ]
+    return pa.RecordBatch.from_arrays(arrays, schema.names)
+
+
+def write_parquet(path, date_ranges, batch_size, compression='snappy'):
+    """ Write the export for date_ranges to a Parquet file at path, one
+    row group per batch. Like the reports, date_ranges must cover
+    compacted months whole. Returns the number of rows written """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    check_compacted_ranges(date_ranges)
+    schema = export_schema()
+    written = 0
+    writer = pq.ParquetWriter(path, schema, compression=compression)
+    try:
+        for rows in export_batches(date_ranges, batch_size):
+            batch = record_batch(rows, schema)
+            writer.write_table(pa.Table.from_batches([batch]))
+            written += len(rows)
+    finally:
+        writer.close()
+    return written
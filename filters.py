@@ -0,0 +1,166 @@
+""" Parsing and validation of date range and report parameters and the
+SQL predicates they compile to """
+
+import calendar
+import datetime
+import re
+from collections import namedtuple
+
+from sqlalchemy import and_, or_
+
+DATE_PATTERN = re.compile(
+    r'^(?P<year>\d{4})(?:-(?P<month>\d{1,2})(?:-(?P<day>\d{1,2}))?)?'
+    r'(?:[ T][0-9:.+Z-]*)?$')
+
+
+SORT_KEYS = ('cost', 'name', 'created_at')
+
+
+class ParameterError(ValueError):
+
+    """ Raised when a report parameter is invalid """
+
+
+class DateRangeError(ParameterError):
+
+    """ Raised when a date or date range parameter can't be parsed """
+
+
+class DateRange(namedtuple('DateRange', ['start', 'end'])):
+
+    """ Inclusive range of dates, a missing start or end leaves that side
+    of the range open """
+
+    def conditions(self, column):
+        """ Sargable predicates limiting column to the range """
+        conditions = []
+        if self.start is not None:
+            conditions.append(column >= self.start)
+        if self.end is not None:
+            conditions.append(column <= self.end)
+        return conditions
+
+
+def parse_date(value, end=False):
+    """ Parses a date given as YYYY, YYYY-MM or YYYY-MM-DD, optionally
+    followed by a time, which is ignored. Partial dates expand to the
+    first day of the period, or its last day when end is True """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    match = DATE_PATTERN.match(str(value).strip())
+    if not match:
+        raise DateRangeError('Invalid date: {0}'.format(value))
+    year = int(match.group('year'))
+    month = match.group('month')
+    day = match.group('day')
+    try:
+        if month is None:
+            return datetime.date(year, 12, 31) if end else \
+                datetime.date(year, 1, 1)
+        month = int(month)
+        if day is None:
+            last_day = calendar.monthrange(year, month)[1]
+            return datetime.date(year, month, last_day if end else 1)
+        return datetime.date(year, month, int(day))
+    except ValueError:
+        raise DateRangeError('Invalid date: {0}'.format(value))
+
+
+def make_range(start, end):
+    """ Builds a validated DateRange from two date values """
+    date_range = DateRange(parse_date(start), parse_date(end, end=True))
+    if date_range.start and date_range.end and \
+            date_range.start > date_range.end:
+        raise DateRangeError(
+            'Range starts after it ends: {0}..{1}'.format(start, end))
+    return date_range
+
+
+def parse_range(value):
+    """ Parses one range in the form start..end, where either side may be
+    left empty. A single date or period without .. covers that period """
+    if '..' in value:
+        start, end = value.split('..', 1)
+    else:
+        start = end = value
+    if not start.strip() and not end.strip():
+        raise DateRangeError('Empty range: {0}'.format(value))
+    return make_range(start.strip(), end.strip())
+
+
+def parse_ranges(since=None, until=None, ranges=None):
+    """ Parses the since/until pair or a comma separated list of ranges
+    into a list of DateRanges. An empty list means no date filter """
+    if ranges:
+        if since or until:
+            raise DateRangeError(
+                'Use either range or since/until, not both')
+        return [parse_range(value) for value in ranges.split(',')]
+    date_range = make_range(since, until)
+    if date_range.start is None and date_range.end is None:
+        return []
+    return [date_range]
+
+
+def resolve_ranges(start_date=None, end_date=None, date_ranges=None):
+    """ Returns date_ranges when given, otherwise the range between
+    start_date and end_date """
+    if date_ranges is not None:
+        return date_ranges
+    return parse_ranges(since=start_date, until=end_date)
+
+
+def parse_sort(sort=None, order=None):
+    """ Validates the sort key and order of a report. Returns the key, or
+    None for the default guid order, and whether to sort descending. Cost
+    sorts descending unless asked otherwise, other keys ascending """
+    if sort and sort not in SORT_KEYS:
+        raise ParameterError('sort must be one of {0}'.format(
+            ', '.join(SORT_KEYS)))
+    if order and order not in ('asc', 'desc'):
+        raise ParameterError('order must be asc or desc')
+    if order:
+        return sort or None, order == 'desc'
+    return sort or None, sort == 'cost'
+
+
+def parse_limit(limit=None):
+    """ Validates the number of quotas a report is limited to """
+    if limit is None or limit == '':
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ParameterError('Invalid limit: {0}'.format(limit))
+    if limit < 1:
+        raise ParameterError('limit must be at least 1')
+    return limit
+
+
+def date_clause(column, date_ranges):
+    """ Predicate matching column to any of the ranges, or None when the
+    ranges don't limit the dates """
+    clauses = []
+    for date_range in date_ranges:
+        conditions = date_range.conditions(column)
+        if not conditions:
+            # A range open on both ends matches every row
+            return None
+        clauses.append(and_(*conditions))
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return or_(*clauses)
+
+
+def filter_dates(query, column, date_ranges):
+    """ Limits query to rows where column falls in any of the ranges """
+    clause = date_clause(column, date_ranges)
+    if clause is None:
+        return query
+    return query.filter(clause)
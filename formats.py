@@ -0,0 +1,84 @@
+""" Output formats of the quota endpoints, chosen by the Accept header.
+JSON stays the default. MessagePack and NDJSON responses are streamed, each
+quota is turned into a dict and encoded on its own as the body is sent, so
+the full list is never built as one document. msgpack is imported on first
+use to keep it out of the startup of every worker. """
+
+import json
+
+from flask import Response, jsonify, request
+
+import instrumentation
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+NDJSON = 'application/x-ndjson'
+MIMETYPES = [JSON, MSGPACK, NDJSON]
+
+
+def negotiate():
+    """ The format the client accepts best, JSON when it has no
+    preference. None when it accepts none of them """
+    if not request.accept_mimetypes:
+        return JSON
+    return request.accept_mimetypes.best_match(MIMETYPES)
+
+
+def not_acceptable():
+    response = jsonify({
+        'error': 'Acceptable formats are {0}'.format(', '.join(MIMETYPES)),
+    })
+    response.status_code = 406
+    return response
+
+
+def ndjson_lines(items):
+    for item in items:
+        yield json.dumps(item) + '\n'
+
+
+def msgpack_chunks(key, count, items):
+    """ A map of key to an array of count items, packed one item at a
+    time """
+    import msgpack
+    packer = msgpack.Packer(use_bin_type=True)
+    yield packer.pack_map_header(1) + packer.pack(key) + \
+        packer.pack_array_header(count)
+    for item in items:
+        yield packer.pack(item)
+
+
+def negotiated(response):
+    """ Mark a response as depending on the Accept header for caches """
+    response.vary.add('Accept')
+    return response
+
+
+def list_response(mimetype, key, rows, to_dict):
+    """ Response listing rows under key. to_dict turns one row into the
+    dict that is serialized """
+    if mimetype == MSGPACK:
+        items = (to_dict(*row) for row in rows)
+        response = Response(
+            msgpack_chunks(key, len(rows), items), mimetype=MSGPACK)
+    elif mimetype == NDJSON:
+        items = (to_dict(*row) for row in rows)
+        response = Response(ndjson_lines(items), mimetype=NDJSON)
+    else:
+        with instrumentation.timed('serialize'):
+            response = jsonify({key: [to_dict(*row) for row in rows]})
+    return negotiated(response)
+
+
+def item_response(mimetype, item):
+    """ Response holding one dict """
+    if mimetype == MSGPACK:
+        import msgpack
+        response = Response(
+            msgpack.packb(item, use_bin_type=True), mimetype=MSGPACK)
+    elif mimetype == NDJSON:
+        response = Response(json.dumps(item) + '\n', mimetype=NDJSON)
+    else:
+        with instrumentation.timed('serialize'):
+            response = jsonify(item)
+    return negotiated(response)
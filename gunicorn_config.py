@@ -0,0 +1,32 @@
+""" gunicorn settings, used with `gunicorn -c gunicorn_config.py`
+
+GUNICORN_WORKER_CLASS=gevent serves each worker's requests on greenlets,
+so a request waiting on Postgres no longer holds a whole worker. psycopg2
+is made cooperative with psycogreen in that mode. """
+
+import os
+
+bind = '0.0.0.0:{0}'.format(os.getenv('PORT', 8000))
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+# Concurrent requests per gevent worker, ignored by sync workers
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+# Each worker imports the app and opens its connection pool after the fork,
+# so no pooled connection is ever shared with the master
+preload_app = False
+accesslog = '-'
+errorlog = '-'
+
+
+def patch_psycopg():
+    """ Make psycopg2 yield to other greenlets while it waits on the
+    database, instead of blocking the whole worker """
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def post_fork(server, worker):
+    """ gevent workers need psycopg2 patched before they serve requests """
+    if worker_class == 'gevent':
+        patch_psycopg()
@@ -0,0 +1,214 @@
+""" Opt-in request profiling and SQL instrumentation. When the
+INSTRUMENTATION setting is on, every request records its SQL statement
+count, database time, serialization time and response size. The numbers
+are returned in a Server-Timing header and summed per endpoint at
+/metrics in the Prometheus text format. Metrics are kept per process. """
+
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from auth import requires_auth
+
+
+class RequestStats:
+
+    """ Timings and SQL statements recorded during one request """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = Counter()
+        self.db_time = 0.0
+        self.timers = Counter()
+
+    @property
+    def query_count(self):
+        return sum(self.statements.values())
+
+    def record_query(self, statement, elapsed):
+        """ Add one executed statement to the request """
+        self.statements[statement] += 1
+        self.db_time += elapsed
+
+    def repeated_statements(self, threshold):
+        """ Statements executed at least threshold times, which is the
+        signature of an N+1 query pattern """
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+    def server_timing(self, total):
+        """ Format the timings as a Server-Timing header value """
+        metrics = [
+            'db;dur={0:.2f};desc="{1} queries"'.format(
+                self.db_time * 1000, self.query_count),
+        ]
+        for name, value in sorted(self.timers.items()):
+            metrics.append('{0};dur={1:.2f}'.format(name, value * 1000))
+        metrics.append('total;dur={0:.2f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+class Metrics:
+
+    """ Process wide counters rendered in the Prometheus text format """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = Counter()
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._values[key] += value
+
+    def render(self):
+        """ Render all counters in the Prometheus text exposition format """
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP {0} {1}'.format(
+                        name, self._help[name]))
+                lines.append('# TYPE {0} counter'.format(name))
+            label_text = ','.join(
+                '{0}="{1}"'.format(key, str(val).replace('"', '\\"'))
+                for key, val in labels)
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append('{0}{1} {2}'.format(name, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe(
+    'quotas_http_requests_total', 'Requests served by endpoint and status')
+metrics.describe(
+    'quotas_http_request_seconds_total', 'Time spent serving requests')
+metrics.describe(
+    'quotas_db_queries_total', 'SQL statements executed by requests')
+metrics.describe(
+    'quotas_db_seconds_total', 'Time spent executing SQL in requests')
+metrics.describe(
+    'quotas_serialize_seconds_total', 'Time spent serializing responses')
+metrics.describe(
+    'quotas_response_bytes_total', 'Size of the response bodies sent')
+metrics.describe(
+    'quotas_n_plus_one_total', 'Requests that repeated an identical statement')
+metrics.describe(
+    'quotas_admission_rejected_total',
+    'Heavy requests turned away by admission control')
+
+
+def current_stats():
+    """ Returns the stats of the request being served, if any """
+    if has_request_context():
+        return g.get('request_stats')
+
+
+@contextmanager
+def timed(name):
+    """ Adds the time spent inside the block to the named request timer """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.timers[name] += time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # The start is kept on the statement's own execution context, so a
+    # statement that raises leaves nothing behind on the pooled connection
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, '_query_start', None)
+    if start is None:
+        return
+    stats = current_stats()
+    if stats is not None:
+        stats.record_query(statement, time.perf_counter() - start)
+
+
+def start_request():
+    if current_app.config.get('INSTRUMENTATION'):
+        g.request_stats = RequestStats()
+
+
+def finish_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+    total = time.perf_counter() - stats.start
+    endpoint = request.endpoint or 'unknown'
+    response.headers['Server-Timing'] = stats.server_timing(total)
+
+    if response.content_length is not None:
+        size = response.content_length
+    elif not response.is_streamed:
+        size = len(response.get_data())
+    else:
+        size = 0
+
+    labels = {'endpoint': endpoint}
+    metrics.inc('quotas_http_requests_total',
+                {'endpoint': endpoint, 'status': response.status_code})
+    metrics.inc('quotas_http_request_seconds_total', labels, total)
+    metrics.inc('quotas_db_queries_total', labels, stats.query_count)
+    metrics.inc('quotas_db_seconds_total', labels, stats.db_time)
+    metrics.inc('quotas_serialize_seconds_total', labels,
+                stats.timers['serialize'])
+    metrics.inc('quotas_response_bytes_total', labels, size)
+
+    threshold = current_app.config.get('INSTRUMENTATION_N_PLUS_ONE', 10)
+    repeated = stats.repeated_statements(threshold)
+    if repeated:
+        metrics.inc('quotas_n_plus_one_total', labels)
+        statement, count = repeated[0]
+        logging.warning(
+            'Possible N+1 on %s: statement ran %s times: %s',
+            request.path, count, ' '.join(statement.split()))
+    return response
+
+
+@requires_auth
+def metrics_view():
+    """ Endpoint that exposes the request metrics to Prometheus """
+    if not current_app.config.get('INSTRUMENTATION'):
+        return Response('Instrumentation is disabled\n', 404)
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """ Hook the instrumentation into the app and SQLAlchemy. The hooks
+    stay idle unless the INSTRUMENTATION setting is on """
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
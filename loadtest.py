@@ -0,0 +1,260 @@
+""" HTTP load test of the API. Seeds a synthetic database, boots the app
+under gunicorn with gunicorn_config.py and drives a weighted mix of report,
+quota detail and CSV requests from concurrent clients. Throughput, latency
+percentiles and the resident memory of the gunicorn processes are saved as
+json so runs can be compared between commits and worker settings. """
+
+import datetime
+import math
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+from flask import current_app
+
+from config import Config
+from database import db
+import bench
+
+ROUTES = {
+    'list': '/api/quotas/?since={since}',
+    'detail': '/api/quotas/{guid}/?since={since}',
+    'csv': '/quotas.csv?since={since}',
+}
+DEFAULT_MIX = 'list=3,detail=6,csv=1'
+
+
+def parse_mix(mix):
+    """ Parses a `route=weight,...` mix into a dict of route weights """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ROUTES:
+            raise ValueError('Unknown route {0}, expected one of {1}'.format(
+                name, ', '.join(sorted(ROUTES))))
+        weights[name] = int(weight or 1)
+    if not any(weights.values()):
+        raise ValueError('The mix needs at least one weighted route')
+    return weights
+
+
+def seed_database(database_uri, n_quotas, n_days):
+    """ Replaces the tables at database_uri with synthetic data and
+    returns the quota guids """
+    original_uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+    current_app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    db.session.remove()
+    try:
+        db.drop_all()
+        db.create_all()
+        return bench.populate_database(n_quotas=n_quotas, n_days=n_days)
+    finally:
+        db.session.remove()
+        current_app.config['SQLALCHEMY_DATABASE_URI'] = original_uri
+
+
+def start_server(database_uri, port, workers, worker_class, reports_dir):
+    """ Starts gunicorn with the deployment settings against
+    database_uri. Standard reports go to an empty reports_dir, so every
+    request is computed live """
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': database_uri,
+        'PORT': str(port),
+        'WEB_CONCURRENCY': str(workers),
+        'GUNICORN_WORKER_CLASS': worker_class,
+        'REPORTS_DIR': reports_dir,
+    })
+    env.setdefault('APP_SETTINGS', 'config.ProductionConfig')
+    root = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen(
+        ['gunicorn', '-c', 'gunicorn_config.py', 'wsgi:app'],
+        cwd=root, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(base_url, server, timeout=30):
+    """ Polls /healthz until the server answers """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with {0}'.format(
+                server.returncode))
+        try:
+            if requests.get(base_url + '/healthz').status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start within {0}s'.format(timeout))
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def process_rss(pid):
+    """ Resident memory of a process in bytes, from /proc """
+    try:
+        with open('/proc/{0}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def child_pids(pid):
+    """ Pids of the direct children of pid, which for the gunicorn master
+    are its workers """
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                # The parent pid follows the command name in parentheses
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+
+def server_rss(pid):
+    """ Resident memory of the gunicorn master and each of its workers """
+    return {
+        'master': process_rss(pid),
+        'workers': [process_rss(child) for child in child_pids(pid)],
+    }
+
+
+def percentile(ordered, fraction):
+    """ Nearest rank percentile of an ordered list """
+    if not ordered:
+        return None
+    index = max(0, int(math.ceil(fraction * len(ordered))) - 1)
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    """ Throughput and latencies of (route, status, seconds) samples,
+    overall and per route. Only 2xx responses count as successes """
+    groups = {'all': samples}
+    for route in set(sample[0] for sample in samples):
+        groups[route] = [sample for sample in samples if sample[0] == route]
+    summary = {}
+    for name, group in groups.items():
+        latencies = sorted(sample[2] for sample in group)
+        ok = [sample for sample in group if 200 <= sample[1] < 300]
+        summary[name] = {
+            'requests': len(group),
+            'ok': len(ok),
+            'errors': len(group) - len(ok),
+            'rejected': sum(1 for sample in group if sample[1] == 503),
+            'requests_per_second': len(ok) / elapsed if elapsed else 0,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        }
+    return summary
+
+
+def client(base_url, routes, guids, since, deadline, samples, lock):
+    """ Sends requests picked from routes until deadline, recording the
+    route, status and latency of each """
+    session = requests.Session()
+    session.auth = (Config.USERNAME, Config.PASSWORD)
+    recorded = []
+    while time.monotonic() < deadline:
+        route = random.choice(routes)
+        path = ROUTES[route].format(guid=random.choice(guids), since=since)
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + path)
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        recorded.append((route, status, time.perf_counter() - start))
+    with lock:
+        samples.extend(recorded)
+
+
+def drive(base_url, server, guids, since, mix, concurrency, duration):
+    """ Runs concurrency clients for duration seconds while sampling the
+    memory of the server. Returns the samples, the elapsed time and the
+    peak memory seen """
+    routes = [name for name, weight in mix.items() for _ in range(weight)]
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    clients = [
+        threading.Thread(
+            target=client,
+            args=(base_url, routes, guids, since, deadline, samples, lock))
+        for _ in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    peak = {'master': 0, 'workers': [], 'total': 0}
+    while any(thread.is_alive() for thread in clients):
+        rss = server_rss(server.pid)
+        total = rss['master'] + sum(rss['workers'])
+        if total > peak['total']:
+            peak = dict(rss, total=total)
+        time.sleep(0.5)
+    for thread in clients:
+        thread.join()
+    return samples, time.perf_counter() - start, peak
+
+
+def run(database_uri, n_quotas, n_days, mix, concurrency, duration, workers,
+        worker_class, port, out_dir):
+    """ Seeds the database, load tests the app under gunicorn and saves
+    the results """
+    mix = parse_mix(mix)
+    guids = seed_database(database_uri, n_quotas, n_days)
+    since = datetime.date.today() - datetime.timedelta(days=n_days)
+    base_url = 'http://127.0.0.1:{0}'.format(port)
+    with tempfile.TemporaryDirectory() as reports_dir:
+        server = start_server(
+            database_uri, port, workers, worker_class, reports_dir)
+        try:
+            wait_until_up(base_url, server)
+            idle = server_rss(server.pid)
+            samples, elapsed, peak = drive(
+                base_url, server, guids, since.isoformat(), mix, concurrency,
+                duration)
+        finally:
+            stop_server(server)
+    results = {
+        'revision': bench.git_revision(),
+        'python': platform.python_version(),
+        'backend': database_uri.split(':', 1)[0],
+        'quotas': n_quotas,
+        'days': n_days,
+        'mix': mix,
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'workers': workers,
+        'worker_class': worker_class,
+        'summary': summarize(samples, elapsed),
+        'rss_idle': idle,
+        'rss_peak': peak,
+    }
+    return results, bench.save_results(results, out_dir, prefix='loadtest')
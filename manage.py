@@ -1,13 +1,14 @@
 import os
+import time
 from subprocess import call
 
 from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
 
-from quotas import app, db
-from scripts import load_data
-app.config.from_object(os.environ['APP_SETTINGS'])
+from database import db
+from quotas import create_app
 
+app = create_app()
 manager = Manager(app)
 
 # Migration Commands
@@ -18,9 +19,92 @@ manager.add_command('db', MigrateCommand)
 @manager.command
 def update_database():
     "Updates database with quotas"
+    from scripts import load_data
     load_data()
 
 
+@manager.command
+def scheduler():
+    "Runs the scheduled database updates until stopped"
+    from scheduler import run_scheduler
+    run_scheduler(app)
+
+
+@manager.command
+def partitions():
+    "Creates the monthly data partitions for the coming months"
+    from scripts import prepare_partitions
+    created = prepare_partitions()
+    print('Created {0} partitions'.format(len(created)))
+    for name in created:
+        print(name)
+
+
+@manager.option('-d', '--horizon-days', dest='horizon_days', type=int,
+                default=None)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=100)
+def compact(horizon_days, batch_size):
+    """ Rolls daily data older than the horizon into monthly rows """
+    from compaction import compact
+    if horizon_days is None:
+        horizon_days = app.config['COMPACT_HORIZON_DAYS']
+    with db.statement_timeout(app.config['JOB_STATEMENT_TIMEOUT']):
+        deleted = compact(horizon_days=horizon_days, batch_size=batch_size)
+    print('Compacted {0} daily rows'.format(deleted))
+
+
+@manager.option('-m', '--months', dest='months', type=int, default=1)
+@manager.option('-o', '--out', dest='out', default='statements')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+def statements(months, out, workers):
+    """ Writes a chargeback statement for each of the last complete months """
+    from statements import generate_statements
+    manifest = generate_statements(
+        os.environ['APP_SETTINGS'], months=months, out_dir=out,
+        workers=workers)
+    for entry in manifest['months']:
+        print('{0} {1:6} quotas {2:.2f}s {3}'.format(
+            entry['month'], entry['quotas'], entry['seconds'],
+            entry['file']))
+    print('{0} quotas in {1} months in {2:.2f}s, {3:.1f} quotas/s'.format(
+        manifest['quotas'], len(manifest['months']), manifest['seconds'],
+        manifest['quotas_per_second'] or 0))
+    print('Statements saved to {0}'.format(out))
+
+
+@manager.option('-s', '--since', dest='since', default=None)
+@manager.option('-u', '--until', dest='until', default=None)
+@manager.option('-r', '--range', dest='date_range', default=None)
+@manager.option('-o', '--out', dest='out', default='data.parquet')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=None)
+def export(since, until, date_range, out, batch_size):
+    """ Exports the daily and compacted data of every quota to Parquet """
+    from export import write_parquet
+    from filters import parse_ranges
+    date_ranges = parse_ranges(since=since, until=until, ranges=date_range)
+    start = time.perf_counter()
+    with db.replica(), db.statement_timeout(
+            app.config['JOB_STATEMENT_TIMEOUT']):
+        written = write_parquet(
+            out, date_ranges, batch_size or app.config['EXPORT_BATCH_SIZE'])
+    print('Exported {0} rows to {1} in {2:.2f}s'.format(
+        written, out, time.perf_counter() - start))
+
+
+@manager.command
+def report(report_id):
+    """ Builds a submitted report job, for the gevent workers """
+    import reports
+    status = reports.load_status(report_id)
+    if status is None:
+        raise SystemExit('No report job {0}'.format(report_id))
+    reports.run_job(app, status)
+    if reports.load_status(report_id)['status'] != 'ready':
+        raise SystemExit(1)
+
+
 @manager.command
 def tests():
     """ Run tests """
@@ -29,6 +113,62 @@ def tests():
     test_command += "--cover-package=scripts --with-coverage"
     call([test_command], shell=True)
 
+
+@manager.option('-q', '--quotas', dest='quotas', type=int, default=100)
+@manager.option('-d', '--days', dest='days', type=int, default=365)
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=3)
+@manager.option('-o', '--out', dest='out', default='bench_results')
+def bench(quotas, days, repeat, out):
+    """ Benchmark ingestion and reporting against synthetic data """
+    import bench
+    database_uris = [os.getenv('BENCH_SQLITE_URL', 'sqlite:///bench.db')]
+    if os.getenv('BENCH_POSTGRES_URL'):
+        database_uris.append(os.getenv('BENCH_POSTGRES_URL'))
+    results, path = bench.run(
+        database_uris=database_uris, n_quotas=quotas, n_days=days,
+        repeat=repeat, out_dir=out)
+    for run in results['runs']:
+        for name, timing in sorted(run['timings'].items()):
+            print('{0:8} {1:22} {2:.4f}s'.format(
+                run['backend'], name, timing['mean']))
+        for name, allocation in sorted(run['allocations'].items()):
+            print('{0:8} {1:22} {2} bytes peak'.format(
+                run['backend'], name, allocation['peak_bytes']))
+    print('Results saved to {0}'.format(path))
+
+
+@manager.option('-q', '--quotas', dest='quotas', type=int, default=200)
+@manager.option('-d', '--days', dest='days', type=int, default=365)
+@manager.option('-m', '--mix', dest='mix', default=None)
+@manager.option('-c', '--concurrency', dest='concurrency', type=int,
+                default=8)
+@manager.option('-t', '--duration', dest='duration', type=int, default=30)
+@manager.option('-w', '--workers', dest='workers', type=int, default=2)
+@manager.option('-k', '--worker-class', dest='worker_class', default='sync')
+@manager.option('-p', '--port', dest='port', type=int, default=8123)
+@manager.option('-o', '--out', dest='out', default='loadtest_results')
+def loadtest(quotas, days, mix, concurrency, duration, workers,
+             worker_class, port, out):
+    """ Load test the API under gunicorn against synthetic data """
+    import loadtest
+    database_uri = os.getenv('LOADTEST_DATABASE_URL', 'sqlite:///loadtest.db')
+    results, path = loadtest.run(
+        database_uri=database_uri, n_quotas=quotas, n_days=days,
+        mix=mix or loadtest.DEFAULT_MIX, concurrency=concurrency,
+        duration=duration, workers=workers, worker_class=worker_class,
+        port=port, out_dir=out)
+    for name, stats in sorted(results['summary'].items()):
+        print('{0:7} {1:6} req {2:8.1f} req/s p50 {3:.4f}s p95 {4:.4f}s '
+              'p99 {5:.4f}s {6} errors'.format(
+                  name, stats['requests'], stats['requests_per_second'],
+                  stats['p50'] or 0, stats['p95'] or 0, stats['p99'] or 0,
+                  stats['errors']))
+    peak = results['rss_peak']
+    print('Peak RSS {0} bytes, workers {1}'.format(
+        peak['total'], peak['workers']))
+    print('Results saved to {0}'.format(path))
+
+
 @manager.command
 def build():
     """ Calls out to npm and ensures that the front end is built """
@@ -0,0 +1,29 @@
+"""add data_monthly table
+
+Revision ID: 1b6e4f2a9c3
+Revises: 2f7d3b8c1e4
+Create Date: 2026-10-19 11:26:52.904117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1b6e4f2a9c3'
+down_revision = '2f7d3b8c1e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('data_monthly',
+    sa.Column('quota', sa.String(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('memory_limit', sa.Integer(), nullable=False),
+    sa.Column('days', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['quota'], ['quota.guid'], ),
+    sa.PrimaryKeyConstraint('quota', 'month', 'memory_limit', name='quota_guid_month_memory')
+    )
+
+
+def downgrade():
+    op.drop_table('data_monthly')
@@ -0,0 +1,90 @@
+"""partition data by month on postgres
+
+Revision ID: 2f7d3b8c1e4
+Revises: 4a1c9e0b7d2
+Create Date: 2026-10-19 10:41:07.220351
+
+Converts the data table into a table range partitioned on date_collected
+with one partition per month and a default partition. Requires Postgres 11
+or later. Other backends keep the unpartitioned table.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f7d3b8c1e4'
+down_revision = '4a1c9e0b7d2'
+
+import datetime
+
+from alembic import op
+
+MONTHS_AHEAD = 3
+
+
+def next_month(month):
+    if month.month == 12:
+        return datetime.date(month.year + 1, 1, 1)
+    return datetime.date(month.year, month.month + 1, 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE data RENAME TO data_unpartitioned')
+    op.execute('ALTER TABLE data_unpartitioned '
+               'RENAME CONSTRAINT quota_guid_date TO quota_guid_date_old')
+    op.execute(
+        'CREATE TABLE data ('
+        'quota VARCHAR NOT NULL REFERENCES quota (guid), '
+        'date_collected DATE NOT NULL, '
+        'memory_limit INTEGER, '
+        'total_routes INTEGER, '
+        'total_services INTEGER, '
+        'CONSTRAINT quota_guid_date PRIMARY KEY (quota, date_collected)'
+        ') PARTITION BY RANGE (date_collected)')
+
+    today = datetime.date.today()
+    first = bind.scalar('SELECT min(date_collected) FROM data_unpartitioned')
+    month = datetime.date((first or today).year, (first or today).month, 1)
+    last = datetime.date(today.year, today.month, 1)
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        op.execute(
+            "CREATE TABLE data_y{0:04d}m{1:02d} PARTITION OF data "
+            "FOR VALUES FROM ('{2}') TO ('{3}')".format(
+                month.year, month.month,
+                month.isoformat(), next_month(month).isoformat()))
+        month = next_month(month)
+    op.execute('CREATE TABLE data_default PARTITION OF data DEFAULT')
+
+    op.execute(
+        'INSERT INTO data (quota, date_collected, memory_limit, '
+        'total_routes, total_services) '
+        'SELECT quota, date_collected, memory_limit, total_routes, '
+        'total_services FROM data_unpartitioned')
+    op.execute('DROP TABLE data_unpartitioned')
+    op.execute('ANALYZE data')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    op.execute('ALTER TABLE data RENAME TO data_partitioned')
+    op.execute('ALTER TABLE data_partitioned '
+               'RENAME CONSTRAINT quota_guid_date TO quota_guid_date_old')
+    op.execute(
+        'CREATE TABLE data ('
+        'quota VARCHAR NOT NULL REFERENCES quota (guid), '
+        'date_collected DATE NOT NULL, '
+        'memory_limit INTEGER, '
+        'total_routes INTEGER, '
+        'total_services INTEGER, '
+        'CONSTRAINT quota_guid_date PRIMARY KEY (quota, date_collected))')
+    op.execute(
+        'INSERT INTO data SELECT quota, date_collected, memory_limit, '
+        'total_routes, total_services FROM data_partitioned')
+    # Dropping the parent drops every partition
+    op.execute('DROP TABLE data_partitioned')
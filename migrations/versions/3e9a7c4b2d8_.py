@@ -0,0 +1,28 @@
+"""tag quotas and load runs with their foundation
+
+Revision ID: 3e9a7c4b2d8
+Revises: 5c8d2e7f1a6
+Create Date: 2026-10-19 15:20:44.106372
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e9a7c4b2d8'
+down_revision = '5c8d2e7f1a6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quota', sa.Column('foundation', sa.String(), nullable=True))
+    op.create_index(
+        op.f('ix_quota_foundation'), 'quota', ['foundation'], unique=False)
+    op.add_column(
+        'load_runs', sa.Column('foundation', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('load_runs', 'foundation')
+    op.drop_index(op.f('ix_quota_foundation'), table_name='quota')
+    op.drop_column('quota', 'foundation')
@@ -0,0 +1,35 @@
+"""add load_runs table
+
+Revision ID: 4a1c9e0b7d2
+Revises: 36faeb18642
+Create Date: 2026-10-19 09:12:41.518230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a1c9e0b7d2'
+down_revision = '36faeb18642'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('load_runs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('status', sa.String(), nullable=True),
+    sa.Column('pages_fetched', sa.Integer(), nullable=True),
+    sa.Column('http_time', sa.Float(), nullable=True),
+    sa.Column('db_time', sa.Float(), nullable=True),
+    sa.Column('rows_upserted', sa.Integer(), nullable=True),
+    sa.Column('errors', sa.Integer(), nullable=True),
+    sa.Column('duration', sa.Float(), nullable=True),
+    sa.Column('error_message', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('load_runs')
@@ -0,0 +1,222 @@
+"""integer surrogate keys for quotas
+
+Revision ID: 5c8d2e7f1a6
+Revises: 1b6e4f2a9c3
+Create Date: 2026-10-19 14:02:31.517846
+
+Gives quota an integer primary key and makes data and data_monthly
+reference it instead of the quota guid, which keeps their rows and primary
+key indexes narrow. The guid stays unique on quota. SQLite cannot change
+keys in place, so there each table is rebuilt in batch mode. Other
+databases are refused rather than left behind the models.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c8d2e7f1a6'
+down_revision = '1b6e4f2a9c3'
+
+from alembic import op
+from alembic.util import CommandError
+import sqlalchemy as sa
+
+# Key columns of the tables referencing quota besides the quota itself, and
+# the names of their primary keys before and after the upgrade
+REFERENCING = [
+    ('data', ['date_collected'], 'quota_guid_date', 'quota_id_date'),
+    ('data_monthly', ['month', 'memory_limit'], 'quota_guid_month_memory',
+     'quota_id_month_memory'),
+]
+
+
+def dialect():
+    name = op.get_bind().dialect.name
+    if name not in ('postgresql', 'sqlite'):
+        raise CommandError(
+            'Revision {0} supports postgresql and sqlite, not {1}'.format(
+                revision, name))
+    return name
+
+
+def quota_table(key):
+    """ The quota table with both the guid and id columns, keyed on key.
+    Constraints carry their Postgres names so batch mode can drop them """
+    constraints = [sa.PrimaryKeyConstraint(key, name='quota_pkey')]
+    if key == 'id':
+        constraints.append(
+            sa.UniqueConstraint('guid', name='quota_guid_key'))
+    return sa.Table(
+        'quota', sa.MetaData(),
+        sa.Column('guid', sa.String(), nullable=key == 'id'),
+        sa.Column('name', sa.String()),
+        sa.Column('url', sa.String()),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('updated_at', sa.DateTime()),
+        sa.Column('id', sa.Integer(), nullable=key == 'guid'),
+        *constraints)
+
+
+def referencing_table(table, key, primary_key):
+    """ data or data_monthly with both the quota and quota_id columns,
+    keyed on key and primary_key """
+    if table == 'data':
+        columns = [
+            sa.Column('date_collected', sa.Date(), nullable=False),
+            sa.Column('memory_limit', sa.Integer()),
+            sa.Column('total_routes', sa.Integer()),
+            sa.Column('total_services', sa.Integer()),
+        ]
+    else:
+        columns = [
+            sa.Column('month', sa.Date(), nullable=False),
+            sa.Column('memory_limit', sa.Integer(), nullable=False),
+            sa.Column('days', sa.Integer()),
+        ]
+    key_columns = next(
+        key_columns for name, key_columns, _, _ in REFERENCING
+        if name == table)
+    remote = 'quota.id' if key == 'quota_id' else 'quota.guid'
+    return sa.Table(
+        table, sa.MetaData(),
+        sa.Column('quota', sa.String(), nullable=key == 'quota_id'),
+        sa.Column('quota_id', sa.Integer(), nullable=key == 'quota'),
+        *columns + [
+            sa.PrimaryKeyConstraint(*[key] + key_columns, name=primary_key),
+            sa.ForeignKeyConstraint(
+                [key], [remote], name='{0}_{1}_fkey'.format(table, key)),
+        ])
+
+
+def upgrade_sqlite():
+    op.add_column('quota', sa.Column('id', sa.Integer()))
+    op.execute('UPDATE quota SET id = rowid')
+    with op.batch_alter_table(
+            'quota', copy_from=quota_table('guid'), recreate='always',
+            table_args=[sa.PrimaryKeyConstraint('id', name='quota_pkey')]
+    ) as batch_op:
+        batch_op.drop_constraint('quota_pkey', type_='primary')
+        batch_op.alter_column('id', nullable=False)
+        batch_op.create_unique_constraint('quota_guid_key', ['guid'])
+
+    for table, key_columns, old_key, new_key in REFERENCING:
+        op.add_column(table, sa.Column('quota_id', sa.Integer()))
+        op.execute(
+            'UPDATE {0} SET quota_id = (SELECT id FROM quota '
+            'WHERE quota.guid = {0}.quota)'.format(table))
+        with op.batch_alter_table(
+                table, copy_from=referencing_table(table, 'quota', old_key),
+                recreate='always',
+                table_args=[sa.PrimaryKeyConstraint(
+                    *['quota_id'] + key_columns, name=new_key)]
+        ) as batch_op:
+            batch_op.drop_constraint(old_key, type_='primary')
+            batch_op.drop_constraint(
+                '{0}_quota_fkey'.format(table), type_='foreignkey')
+            batch_op.drop_column('quota')
+            batch_op.alter_column('quota_id', nullable=False)
+            batch_op.create_foreign_key(
+                '{0}_quota_id_fkey'.format(table), 'quota', ['quota_id'],
+                ['id'])
+
+
+def downgrade_sqlite():
+    for table, key_columns, old_key, new_key in REFERENCING:
+        op.add_column(table, sa.Column('quota', sa.String()))
+        op.execute(
+            'UPDATE {0} SET quota = (SELECT guid FROM quota '
+            'WHERE quota.id = {0}.quota_id)'.format(table))
+        with op.batch_alter_table(
+                table, copy_from=referencing_table(table, 'quota_id', new_key),
+                recreate='always',
+                table_args=[sa.PrimaryKeyConstraint(
+                    *['quota'] + key_columns, name=old_key)]
+        ) as batch_op:
+            batch_op.drop_constraint(new_key, type_='primary')
+            batch_op.drop_constraint(
+                '{0}_quota_id_fkey'.format(table), type_='foreignkey')
+            batch_op.drop_column('quota_id')
+            batch_op.alter_column('quota', nullable=False)
+            batch_op.create_foreign_key(
+                '{0}_quota_fkey'.format(table), 'quota', ['quota'], ['guid'])
+
+    with op.batch_alter_table(
+            'quota', copy_from=quota_table('id'), recreate='always',
+            table_args=[sa.PrimaryKeyConstraint('guid', name='quota_pkey')]
+    ) as batch_op:
+        batch_op.drop_constraint('quota_pkey', type_='primary')
+        batch_op.drop_constraint('quota_guid_key', type_='unique')
+        batch_op.drop_column('id')
+        batch_op.alter_column('guid', nullable=False)
+
+
+def upgrade():
+    if dialect() == 'sqlite':
+        return upgrade_sqlite()
+    op.execute('ALTER TABLE quota ADD COLUMN id SERIAL')
+    op.execute('ALTER TABLE quota ADD CONSTRAINT quota_guid_key UNIQUE (guid)')
+
+    for table in ['data', 'data_monthly']:
+        op.execute('ALTER TABLE {0} ADD COLUMN quota_id INTEGER'.format(table))
+        op.execute(
+            'UPDATE {0} SET quota_id = quota.id FROM quota '
+            'WHERE {0}.quota = quota.guid'.format(table))
+        op.execute(
+            'ALTER TABLE {0} ALTER COLUMN quota_id SET NOT NULL'.format(table))
+        op.execute(
+            'ALTER TABLE {0} DROP CONSTRAINT {0}_quota_fkey'.format(table))
+    op.execute('ALTER TABLE data DROP CONSTRAINT quota_guid_date')
+    op.execute(
+        'ALTER TABLE data_monthly DROP CONSTRAINT quota_guid_month_memory')
+    op.execute('ALTER TABLE data DROP COLUMN quota')
+    op.execute('ALTER TABLE data_monthly DROP COLUMN quota')
+
+    op.execute('ALTER TABLE quota DROP CONSTRAINT quota_pkey')
+    op.execute('ALTER TABLE quota ADD CONSTRAINT quota_pkey PRIMARY KEY (id)')
+    op.execute(
+        'ALTER TABLE data ADD CONSTRAINT quota_id_date '
+        'PRIMARY KEY (quota_id, date_collected)')
+    op.execute(
+        'ALTER TABLE data_monthly ADD CONSTRAINT quota_id_month_memory '
+        'PRIMARY KEY (quota_id, month, memory_limit)')
+    for table in ['data', 'data_monthly']:
+        op.execute(
+            'ALTER TABLE {0} ADD CONSTRAINT {0}_quota_id_fkey '
+            'FOREIGN KEY (quota_id) REFERENCES quota (id)'.format(table))
+    op.execute('ANALYZE quota')
+    op.execute('ANALYZE data')
+    op.execute('ANALYZE data_monthly')
+
+
+def downgrade():
+    if dialect() == 'sqlite':
+        return downgrade_sqlite()
+    for table in ['data', 'data_monthly']:
+        op.execute('ALTER TABLE {0} ADD COLUMN quota VARCHAR'.format(table))
+        op.execute(
+            'UPDATE {0} SET quota = quota.guid FROM quota '
+            'WHERE {0}.quota_id = quota.id'.format(table))
+        op.execute(
+            'ALTER TABLE {0} ALTER COLUMN quota SET NOT NULL'.format(table))
+        op.execute(
+            'ALTER TABLE {0} DROP CONSTRAINT {0}_quota_id_fkey'.format(table))
+    op.execute('ALTER TABLE data DROP CONSTRAINT quota_id_date')
+    op.execute(
+        'ALTER TABLE data_monthly DROP CONSTRAINT quota_id_month_memory')
+    op.execute('ALTER TABLE data DROP COLUMN quota_id')
+    op.execute('ALTER TABLE data_monthly DROP COLUMN quota_id')
+
+    op.execute('ALTER TABLE quota DROP CONSTRAINT quota_pkey')
+    op.execute(
+        'ALTER TABLE quota ADD CONSTRAINT quota_pkey PRIMARY KEY (guid)')
+    op.execute('ALTER TABLE quota DROP CONSTRAINT quota_guid_key')
+    op.execute('ALTER TABLE quota DROP COLUMN id')
+    op.execute(
+        'ALTER TABLE data ADD CONSTRAINT quota_guid_date '
+        'PRIMARY KEY (quota, date_collected)')
+    op.execute(
+        'ALTER TABLE data_monthly ADD CONSTRAINT quota_guid_month_memory '
+        'PRIMARY KEY (quota, month, memory_limit)')
+    for table in ['data', 'data_monthly']:
+        op.execute(
+            'ALTER TABLE {0} ADD CONSTRAINT {0}_quota_fkey '
+            'FOREIGN KEY (quota) REFERENCES quota (guid)'.format(table))
@@ -0,0 +1,31 @@
+"""standard reports table
+
+Revision ID: 7d4f1b9e2c5
+Revises: 3e9a7c4b2d8
+Create Date: 2026-10-19 18:41:07.392518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d4f1b9e2c5'
+down_revision = '3e9a7c4b2d8'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'standard_reports',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('report_format', sa.String(), nullable=False),
+        sa.Column('version', sa.String(), nullable=False),
+        sa.Column('report_date', sa.Date(), nullable=False),
+        sa.Column('start_date', sa.Date(), nullable=False),
+        sa.Column('end_date', sa.Date(), nullable=False),
+        sa.Column('body', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'report_format'))
+
+
+def downgrade():
+    op.drop_table('standard_reports')
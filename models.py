@@ -1,5 +1,5 @@
-from datetime import date
-from quotas import db
+from datetime import date, datetime
+from database import db
 from sqlalchemy.orm import relationship
 
 
@@ -8,15 +8,18 @@ class QuotaData(db.Model):
 
     __tablename__ = 'data'
 
-    quota = db.Column(db.String, db.ForeignKey('quota.guid'))
+    # References the integer key of the quota rather than its guid to keep
+    # the rows and the primary key index of this table narrow
+    quota_id = db.Column(db.Integer, db.ForeignKey('quota.id'))
     date_collected = db.Column(db.Date())
     memory_limit = db.Column(db.Integer())
     total_routes = db.Column(db.Integer())
     total_services = db.Column(db.Integer())
+    quota = relationship("Quota", back_populates="data")
 
     # Limiting the data by date
     __table_args__ = (db.PrimaryKeyConstraint(
-        'quota', 'date_collected', name='quota_guid_date'),)
+        'quota_id', 'date_collected', name='quota_id_date'),)
 
     def __init__(self, quota, date_collected=None):
         self.quota = quota
@@ -25,8 +28,39 @@ class QuotaData(db.Model):
         else:
             self.date_collected = date.today()
 
+    @property
+    def quota_guid(self):
+        """ Guid of the quota, the identifier shown in the API """
+        return self.quota.guid
+
     def __repr__(self):
-        return '<guid {0} date {1}>'.format(self.quota, self.date_collected)
+        return '<quota {0} date {1}>'.format(
+            self.quota_id, self.date_collected)
+
+
+class QuotaDataMonthly(db.Model):
+    """ Model for a quota's data compacted into the number of days each
+    memory limit was active in a month """
+
+    __tablename__ = 'data_monthly'
+
+    quota_id = db.Column(db.Integer, db.ForeignKey('quota.id'))
+    month = db.Column(db.Date())
+    memory_limit = db.Column(db.Integer())
+    days = db.Column(db.Integer())
+
+    __table_args__ = (db.PrimaryKeyConstraint(
+        'quota_id', 'month', 'memory_limit', name='quota_id_month_memory'),)
+
+    def __init__(self, quota_id, month, memory_limit, days=0):
+        self.quota_id = quota_id
+        self.month = month
+        self.memory_limit = memory_limit
+        self.days = days
+
+    def __repr__(self):
+        return '<quota {0} month {1} memory {2}>'.format(
+            self.quota_id, self.month, self.memory_limit)
 
 
 class Quota(db.Model):
@@ -34,12 +68,15 @@ class Quota(db.Model):
 
     __tablename__ = 'quota'
 
-    guid = db.Column(db.String, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+    guid = db.Column(db.String, unique=True, nullable=False)
     name = db.Column(db.String)
     url = db.Column(db.String())
     created_at = db.Column(db.DateTime())
     updated_at = db.Column(db.DateTime())
-    data = relationship("QuotaData")
+    # Name of the Cloud Foundry foundation the quota was collected from
+    foundation = db.Column(db.String(), index=True)
+    data = relationship("QuotaData", back_populates="quota")
 
     def __init__(self, guid, name=None, url=None):
         self.guid = guid
@@ -50,3 +87,53 @@ class Quota(db.Model):
 
     def __repr__(self):
         return '<name {}>'.format(self.name)
+
+
+class LoadRun(db.Model):
+    """ Model for one run of the data loader """
+
+    __tablename__ = 'load_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime())
+    finished_at = db.Column(db.DateTime())
+    status = db.Column(db.String())
+    pages_fetched = db.Column(db.Integer())
+    http_time = db.Column(db.Float())
+    db_time = db.Column(db.Float())
+    rows_upserted = db.Column(db.Integer())
+    errors = db.Column(db.Integer())
+    duration = db.Column(db.Float())
+    error_message = db.Column(db.String())
+    foundation = db.Column(db.String())
+
+    def __init__(self, started_at=None, foundation=None):
+        if started_at:
+            self.started_at = started_at
+        else:
+            self.started_at = datetime.utcnow()
+        self.foundation = foundation
+        self.status = 'running'
+
+    def __repr__(self):
+        return '<load run {0} {1} {2}>'.format(
+            self.id, self.foundation, self.status)
+
+
+class StandardReport(db.Model):
+    """ Model for a standard report written by the loader, kept in the
+    database so that every instance can serve it """
+
+    __tablename__ = 'standard_reports'
+
+    name = db.Column(db.String(), primary_key=True)
+    report_format = db.Column(db.String(), primary_key=True)
+    version = db.Column(db.String(), nullable=False)
+    report_date = db.Column(db.Date(), nullable=False)
+    start_date = db.Column(db.Date(), nullable=False)
+    end_date = db.Column(db.Date(), nullable=False)
+    body = db.Column(db.LargeBinary(), nullable=False)
+
+    def __repr__(self):
+        return '<standard report {0}.{1} {2}>'.format(
+            self.name, self.report_format, self.version)
@@ -0,0 +1,73 @@
+""" Monthly range partitions of the data table. On Postgres the data table
+is partitioned on date_collected, one partition per month, so date
+filtered queries only scan the months they cover. Other backends keep an
+unpartitioned table and every function here is a no-op for them. """
+
+import datetime
+import logging
+
+PARENT_TABLE = 'data'
+
+
+def month_start(day):
+    """ First day of the month containing day """
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    """ First day of the month count months after month """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    """ Name of the partition holding month, e.g. data_y2015m01 """
+    return '{0}_y{1:04d}m{2:02d}'.format(PARENT_TABLE, month.year, month.month)
+
+
+def is_partitioned(connection):
+    """ Check if the data table is a partitioned Postgres table """
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.scalar(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = %s)", PARENT_TABLE)
+
+
+def existing_partitions(connection):
+    """ Names of the partitions attached to the data table """
+    rows = connection.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = %s", PARENT_TABLE)
+    return set(row[0] for row in rows)
+
+
+def create_partition(connection, month):
+    """ Create the partition for one month """
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} "
+        "FOR VALUES FROM ('{2}') TO ('{3}')".format(
+            partition_name(month), PARENT_TABLE,
+            month.isoformat(), add_months(month, 1).isoformat()))
+
+
+def ensure_partitions(connection, months_ahead=3, today=None):
+    """ Create any missing partitions from the current month through
+    months_ahead months ahead, so the loader never writes into the default
+    partition. Returns the names of the partitions created """
+    if not is_partitioned(connection):
+        return []
+    current = month_start(today or datetime.date.today())
+    existing = existing_partitions(connection)
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if partition_name(month) not in existing:
+            create_partition(connection, month)
+            created.append(partition_name(month))
+    if created:
+        logging.info('Created data partitions: %s', ', '.join(created))
+    return created
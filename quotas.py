@@ -1,68 +1,307 @@
+import datetime
 import os
+import tempfile
+from collections import OrderedDict
 
-from apscheduler.schedulers.background import BackgroundScheduler
-import datetime
-from flask import Flask, Response, jsonify, request
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask import (
+    Blueprint, Flask, Response, current_app, jsonify, request, send_file,
+    url_for)
+from api import LoadRunResource, QuotaResource
 from auth import requires_auth
+from database import db
+from filters import ParameterError, parse_limit, parse_ranges, parse_sort
+import admission
+import formats
+import instrumentation
+
+views = Blueprint('views', __name__)
+
+
+def create_app(config=None):
+    """ Builds the app. Building it doesn't connect to the database or
+    start the scheduler, which runs in its own process (scheduler.py).
+    Modules only some routes need, reports and export, are imported by
+    those routes on first use to keep them out of every worker's startup """
+    app = Flask(__name__, static_url_path='')
+    app.config.from_object(config or os.environ['APP_SETTINGS'])
+    db.init_app(app)
+    instrumentation.init_app(app)
+    app.register_blueprint(views)
+    return app
+
+
+def request_date_ranges():
+    """ Parses the since, until and range parameters of the request """
+    return parse_ranges(
+        since=request.args.get('since'),
+        until=request.args.get('until'),
+        ranges=request.args.get('range'))
+
+
+def request_report_options():
+    """ Parses the filter, sort and limit parameters of a quota report """
+    sort, descending = parse_sort(
+        sort=request.args.get('sort'), order=request.args.get('order'))
+    return {
+        'foundation': request.args.get('foundation'),
+        'name_prefix': request.args.get('name_prefix'),
+        'guid_prefix': request.args.get('guid_prefix'),
+        'sort': sort,
+        'descending': descending,
+        'limit': parse_limit(request.args.get('limit')),
+    }
+
 
-app = Flask(__name__, static_url_path='')
-app.config.from_object(os.environ['APP_SETTINGS'])
+@views.app_errorhandler(ParameterError)
+def invalid_parameter(error):
+    return jsonify({'error': str(error)}), 400
 
-db = SQLAlchemy(app)
 
-# Schedule Updates
-from scripts import load_data
-scheduler = BackgroundScheduler()
-job = scheduler.add_job(load_data, 'cron', hour='3,12,18')
-scheduler.start()
+@views.app_errorhandler(admission.Saturated)
+def saturated(error):
+    """ Turn heavy requests away while the instance is busy with others """
+    instrumentation.metrics.inc(
+        'quotas_admission_rejected_total',
+        {'endpoint': request.endpoint or 'unknown'})
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
-# Import Quota model
-from api import QuotaResource
 
+@views.route("/healthz", methods=['GET'])
+def healthz():
+    """ Liveness check, answers as soon as a worker is serving """
+    return jsonify({'status': 'ok'})
 
-@app.route("/", methods=['GET'])
+
+@views.route("/readyz", methods=['GET'])
+def readyz():
+    """ Readiness check, reports whether data has been loaded and the age
+    of the last successful load. Only runs indexed single row lookups """
+    try:
+        has_data = QuotaResource.any_exist()
+        last_load = LoadRunResource.last_success()
+    except Exception:
+        current_app.logger.exception('Readiness check failed')
+        return jsonify({'ready': False, 'error': 'database unavailable'}), 503
+    finished_at = last_load.finished_at if last_load else None
+    age = None
+    if finished_at:
+        age = (datetime.datetime.utcnow() - finished_at).total_seconds()
+    status = {
+        'ready': has_data,
+        'has_data': has_data,
+        'last_load': str(finished_at) if finished_at else None,
+        'data_age_seconds': age,
+    }
+    return jsonify(status), 200 if has_data else 503
+
+
+@views.route("/", methods=['GET'])
 @requires_auth
 def index():
-    return app.send_static_file("index.html")
+    return current_app.send_static_file("index.html")
 
 
-@app.route("/api/quotas/", methods=['GET'])
+@views.route("/api/quotas/", methods=['GET'])
 @requires_auth
 def api_all_dates():
     """ Endpoint that lists all quotas with details between
-    two specific dates """
-    start_date = request.args.get('since')
-    end_date = request.args.get('until', datetime.datetime.today().now())
-    return jsonify(
-        {'Quotas':
-            QuotaResource.list_all(start_date=start_date, end_date=end_date)}
-    )
+    two specific dates, filtered, sorted and limited by the report
+    parameters """
+    import reports
+    mimetype = formats.negotiate()
+    if mimetype is None:
+        return formats.not_acceptable()
+    date_ranges = request_date_ranges()
+    options = request_report_options()
+    if mimetype == formats.JSON:
+        standard = reports.standard_report(date_ranges, 'json', **options)
+        if standard:
+            return send_report_file(*standard)
+    with admission.admitted(), db.replica():
+        rows = QuotaResource.list_all_rows(
+            date_ranges=date_ranges, **options)
+    return formats.list_response(
+        mimetype, 'Quotas', rows, QuotaResource.aggregates_dict)
+
+
+def request_guids():
+    """ Guids of a batch request, from a JSON body with a guids list or a
+    comma separated guids parameter """
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return None
+    guids = body.get('guids')
+    if guids is None:
+        guids = [
+            guid for guid in request.args.get('guids', '').split(',')
+            if guid
+        ]
+    if not isinstance(guids, list) or \
+            not all(isinstance(guid, str) for guid in guids):
+        return None
+    # Keep the order the guids were asked for, without duplicates
+    return list(OrderedDict.fromkeys(guids))
 
 
-@app.route("/api/quotas/<guid>/", methods=['GET'])
+@views.route("/api/quotas/batch", methods=['GET', 'POST'])
+@requires_auth
+def api_batch():
+    """ Endpoint that lists the details and aggregates of many quotas in
+    one request, limited by date """
+    guids = request_guids()
+    if guids is None:
+        return jsonify({'error': 'guids must be a list of strings'}), 400
+    max_guids = current_app.config['BATCH_MAX_GUIDS']
+    if len(guids) > max_guids:
+        return jsonify(
+            {'error': 'At most {0} guids per request'.format(max_guids)}), 400
+    date_ranges = request_date_ranges()
+    quotas = []
+    if guids:
+        with admission.admitted(), db.replica():
+            quotas = QuotaResource.list_many(
+                guids=guids, date_ranges=date_ranges)
+    found = set(quota['guid'] for quota in quotas)
+    with instrumentation.timed('serialize'):
+        return jsonify({
+            'Quotas': quotas,
+            'missing': [guid for guid in guids if guid not in found],
+        })
+
+
+@views.route("/api/quotas/<guid>/", methods=['GET'])
 @requires_auth
 def api_one_dates(guid):
     """ Endpoint that lists one quota details limited by date """
-    start_date = request.args.get('since')
-    end_date = request.args.get('until', datetime.datetime.today().now())
-    data = QuotaResource.list_one_aggregate(
-        guid=guid, start_date=start_date, end_date=end_date)
+    mimetype = formats.negotiate()
+    if mimetype is None:
+        return formats.not_acceptable()
+    date_ranges = request_date_ranges()
+    with db.replica():
+        data = QuotaResource.list_one_aggregate(
+            guid=guid, date_ranges=date_ranges)
     if data:
-        return jsonify(data)
+        return formats.item_response(mimetype, data)
     else:
         return jsonify({'error': 'No Data'}), 404
 
 
-@app.route('/quotas.csv')
+def report_status(status):
+    """ Status of a report job as returned by the api """
+    data = dict(status)
+    data['url'] = url_for('views.api_report', report_id=status['id'])
+    if status['status'] == 'ready':
+        data['download_url'] = url_for(
+            'views.download_report', report_id=status['id'])
+    return data
+
+
+def send_report_file(path, mimetype):
+    """ Serve a report saved on disk. send_file hands the open file to the
+    WSGI server's file wrapper, which gunicorn sends with sendfile() """
+    return send_file(
+        os.path.abspath(path), mimetype=mimetype, conditional=True)
+
+
+@views.route("/api/reports/", methods=['POST'])
+@requires_auth
+def api_submit_report():
+    """ Endpoint that submits a report job from a JSON spec of the report
+    format, dates and filters, and returns the job to poll """
+    import reports
+    spec = request.get_json(silent=True)
+    if spec is None:
+        spec = request.args.to_dict()
+    status = reports.submit(spec)
+    code = 200 if status['status'] == 'ready' else 202
+    return jsonify(report_status(status)), code
+
+
+@views.route("/api/reports/<report_id>/", methods=['GET'])
+@requires_auth
+def api_report(report_id):
+    """ Endpoint that reports the status of a report job """
+    import reports
+    status = reports.load_status(report_id)
+    if status is None:
+        return jsonify({'error': 'No such report'}), 404
+    return jsonify(report_status(status))
+
+
+@views.route("/api/reports/<report_id>/download", methods=['GET'])
+@requires_auth
+def download_report(report_id):
+    """ Route for downloading the result of a finished report job """
+    import reports
+    status = reports.load_status(report_id)
+    if status is None:
+        return jsonify({'error': 'No such report'}), 404
+    if status['status'] != 'ready':
+        return jsonify(report_status(status)), 409
+    path, mimetype = reports.result_file(status)
+    return send_file(
+        os.path.abspath(path), mimetype=mimetype, as_attachment=True,
+        attachment_filename='quotas-{0}.{1}'.format(
+            report_id[:8], status['spec']['format']))
+
+
+@views.route('/export/data.parquet')
+@requires_auth
+def export_data():
+    """ Route for downloading the daily and compacted monthly data of
+    every quota within the date parameters as a Parquet file """
+    import export
+    date_ranges = request_date_ranges()
+    # Written to disk batch by batch, since the Parquet footer can only be
+    # written once every row group is known
+    output = tempfile.NamedTemporaryFile(suffix='.parquet')
+    try:
+        with admission.admitted(), db.replica():
+            export.write_parquet(
+                output.name, date_ranges,
+                current_app.config['EXPORT_BATCH_SIZE'])
+    except Exception:
+        output.close()
+        raise
+    return send_file(
+        output, mimetype=export.PARQUET, as_attachment=True,
+        attachment_filename='data.parquet')
+
+
+@views.route("/api/admission/", methods=['GET'])
+@requires_auth
+def api_admission():
+    """ Endpoint that shows how many heavy report requests are running and
+    waiting on this instance """
+    return jsonify(admission.status())
+
+
+@views.route("/api/loads/", methods=['GET'])
+@requires_auth
+def api_loads():
+    """ Endpoint that lists the most recent data loader runs """
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({'Loads': LoadRunResource.list_recent(limit=limit)})
+
+
+@views.route('/quotas.csv')
 @requires_auth
 def download_quotas():
     """ Route for downloading quotas """
-    start_date = request.args.get('since')
-    end_date = request.args.get('until', datetime.datetime.today().now())
-    csv = QuotaResource.generate_cvs(start_date=start_date, end_date=end_date)
+    import reports
+    date_ranges = request_date_ranges()
+    options = request_report_options()
+    standard = reports.standard_report(date_ranges, 'csv', **options)
+    if standard:
+        return send_report_file(*standard)
+    with admission.admitted(), db.replica():
+        csv = QuotaResource.generate_cvs(
+            date_ranges=date_ranges, **options)
     return Response(csv, mimetype='text/csv')
 
 if __name__ == "__main__":
     port = int(os.getenv('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    create_app().run(host='0.0.0.0', port=port)
@@ -0,0 +1,211 @@
+""" Read only queries for the reports, issued with SQLAlchemy Core. Only
+the needed columns are selected and rows are returned as namedtuples, so
+reports skip building mapped instances and identity map entries. """
+
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import Integer, cast, func, select, union_all
+
+from database import db
+from filters import DateRangeError, date_clause
+from models import Quota, QuotaData, QuotaDataMonthly
+from partitions import add_months
+
+quota_table = Quota.__table__
+data_table = QuotaData.__table__
+monthly_table = QuotaDataMonthly.__table__
+
+QuotaRecord = namedtuple(
+    'QuotaRecord',
+    ['id', 'guid', 'name', 'created_at', 'updated_at', 'foundation'])
+DataRecord = namedtuple(
+    'DataRecord', ['quota_guid', 'date_collected', 'memory_limit',
+                   'total_routes', 'total_services'])
+MemoryRecord = namedtuple(
+    'MemoryRecord', ['quota_id', 'memory_limit', 'days'])
+StatementRecord = namedtuple(
+    'StatementRecord',
+    ['guid', 'name', 'foundation', 'memory_limit', 'days'])
+
+
+def prefix_clause(column, prefix):
+    """ Predicate matching values of column that start with prefix, which
+    can use an index on column """
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+    return column.like(escaped + '%', escape='\\')
+
+
+def limit_quotas(query, guids=None, foundation=None, name_prefix=None,
+                 guid_prefix=None):
+    """ Limits a query on the quota table to guids, one foundation and
+    name and guid prefixes when they are given """
+    if guids is not None:
+        query = query.where(quota_table.c.guid.in_(guids))
+    if foundation is not None:
+        query = query.where(quota_table.c.foundation == foundation)
+    if name_prefix:
+        query = query.where(prefix_clause(quota_table.c.name, name_prefix))
+    if guid_prefix:
+        query = query.where(prefix_clause(quota_table.c.guid, guid_prefix))
+    return query
+
+
+def quota_ids(**filters):
+    """ Subquery selecting the integer keys of the quotas matching the
+    filters of limit_quotas, or None when no filter is given """
+    if all(value is None for value in filters.values()):
+        return None
+    return limit_quotas(select([quota_table.c.id]), **filters)
+
+
+def quota_records(date_ranges=None, sort=None, descending=False, limit=None,
+                  **filters):
+    """ Quotas matching the filters of limit_quotas, ordered by sort and
+    then guid. Sorting by cost orders by the memory used over date_ranges,
+    aggregated in the same query, so a limited query only returns the
+    quotas it needs """
+    query = select([
+        quota_table.c.id, quota_table.c.guid, quota_table.c.name,
+        quota_table.c.created_at, quota_table.c.updated_at,
+        quota_table.c.foundation,
+    ])
+    query = limit_quotas(query, **filters)
+    if sort == 'cost':
+        combined = memory_union(date_ranges or [], quota_ids(**filters))
+        totals = select([
+            combined.c.quota_id,
+            func.sum(combined.c.memory_limit * combined.c.days).label(
+                'mb_days'),
+        ]).group_by(combined.c.quota_id).alias('totals')
+        query = query.select_from(quota_table.outerjoin(
+            totals, totals.c.quota_id == quota_table.c.id))
+        key = func.coalesce(totals.c.mb_days, 0)
+    elif sort in ('name', 'created_at'):
+        key = quota_table.c[sort]
+    else:
+        key = quota_table.c.guid
+    query = query.order_by(
+        key.desc() if descending else key.asc(), quota_table.c.guid)
+    if limit is not None:
+        query = query.limit(limit)
+    return [QuotaRecord(*row) for row in db.session.execute(query)]
+
+
+def data_records(guid, date_ranges):
+    """ Daily data of one quota ordered by date """
+    query = select([
+        quota_table.c.guid, data_table.c.date_collected,
+        data_table.c.memory_limit, data_table.c.total_routes,
+        data_table.c.total_services,
+    ]).select_from(
+        data_table.join(quota_table, data_table.c.quota_id == quota_table.c.id)
+    ).where(quota_table.c.guid == guid)
+    clause = date_clause(data_table.c.date_collected, date_ranges)
+    if clause is not None:
+        query = query.where(clause)
+    query = query.order_by(data_table.c.date_collected)
+    return [DataRecord(*row) for row in db.session.execute(query)]
+
+
+def month_boundaries(date_ranges):
+    """ The ends of date_ranges that fall inside a month rather than on its
+    first or last day """
+    inside = []
+    for date_range in date_ranges:
+        if date_range.start is not None and date_range.start.day != 1:
+            inside.append(date_range.start)
+        if date_range.end is not None and (
+                date_range.end + datetime.timedelta(days=1)).day != 1:
+            inside.append(date_range.end)
+    return inside
+
+
+def check_compacted_ranges(date_ranges):
+    """ Compacted months keep only the days per memory limit, so they can
+    not be split. Raises DateRangeError when a range starts or ends inside
+    the compacted history rather than on a month boundary. The compacted
+    history is only looked up when some range ends inside a month """
+    inside = month_boundaries(date_ranges)
+    if not inside:
+        return
+    last_month = db.session.execute(
+        select([func.max(monthly_table.c.month)])).scalar()
+    if last_month is None:
+        return
+    frontier = add_months(last_month, 1)
+    if any(day < frontier for day in inside):
+        raise DateRangeError(
+            'Data before {0} is kept by month: ranges before then must '
+            'start on the first and end on the last day of a month'.format(
+                frontier.isoformat()))
+
+
+def memory_union(date_ranges, quotas=None):
+    """ Days each memory limit was active per quota in the daily data,
+    and the compacted monthly days, as one union. quotas limits it to a
+    list or subquery of quota ids. Compacted months are matched by their
+    first day, which is exact as check_compacted_ranges only lets whole
+    compacted months through """
+    check_compacted_ranges(date_ranges)
+    daily = select([
+        data_table.c.quota_id.label('quota_id'),
+        data_table.c.memory_limit.label('memory_limit'),
+        func.count(data_table.c.date_collected).label('days'),
+    ]).group_by(data_table.c.quota_id, data_table.c.memory_limit)
+    monthly = select([
+        monthly_table.c.quota_id.label('quota_id'),
+        monthly_table.c.memory_limit.label('memory_limit'),
+        monthly_table.c.days.label('days'),
+    ])
+    if quotas is not None:
+        daily = daily.where(data_table.c.quota_id.in_(quotas))
+        monthly = monthly.where(monthly_table.c.quota_id.in_(quotas))
+    daily_dates = date_clause(data_table.c.date_collected, date_ranges)
+    if daily_dates is not None:
+        daily = daily.where(daily_dates)
+        monthly = monthly.where(
+            date_clause(monthly_table.c.month, date_ranges))
+    return union_all(daily, monthly).alias('combined')
+
+
+def memory_records(date_ranges, ids=None, **filters):
+    """ Number of days each memory limit was active per quota, from daily
+    and compacted monthly data, in one query. Limited to the quota ids in
+    ids, or else to the filters of limit_quotas. Returns a dict of quota
+    id to (memory_limit, days) tuples ordered by memory limit """
+    quotas = ids if ids is not None else quota_ids(**filters)
+    combined = memory_union(date_ranges, quotas)
+    query = select([
+        combined.c.quota_id,
+        combined.c.memory_limit,
+        cast(func.sum(combined.c.days), Integer),
+    ]).group_by(combined.c.quota_id, combined.c.memory_limit).order_by(
+        combined.c.quota_id, combined.c.memory_limit)
+    memory = {}
+    for row in db.session.execute(query):
+        record = MemoryRecord(*row)
+        memory.setdefault(record.quota_id, []).append(
+            (record.memory_limit, record.days))
+    return memory
+
+
+def statement_records(date_ranges):
+    """ Days each memory limit was active over date_ranges for every quota
+    with data, joined to the quota details in one query. Ordered by guid
+    and then memory limit """
+    combined = memory_union(date_ranges)
+    query = select([
+        quota_table.c.guid,
+        quota_table.c.name,
+        quota_table.c.foundation,
+        combined.c.memory_limit,
+        cast(func.sum(combined.c.days), Integer),
+    ]).select_from(
+        combined.join(quota_table, combined.c.quota_id == quota_table.c.id)
+    ).group_by(
+        quota_table.c.guid, quota_table.c.name, quota_table.c.foundation,
+        combined.c.memory_limit,
+    ).order_by(quota_table.c.guid, combined.c.memory_limit)
+    return [StatementRecord(*row) for row in db.session.execute(query)]
@@ -0,0 +1,458 @@
+""" Reports saved to disk instead of being built within a request.
+
+Report jobs are for reports too slow to build within a request. A job is
+submitted with a spec of the format, date range and filters, built by a
+pool of background threads with the QuotaResource report logic and saved
+under REPORTS_DIR. In gevent workers those threads are greenlets, so each
+job is built in a child process instead, which they wait on. The job's
+status is kept in a JSON file next to the result, so every worker process
+on the instance sees the same jobs, but other instances don't: a job can
+only be polled and downloaded on the instance that took it, which its
+status names. Jobs with the same spec over the same loaded data share one
+id and are only built once.
+
+Standard reports cover the ranges most requests ask for: the current
+month, the previous month and the year to date. The loader writes them to
+the database at the end of every run, so every instance can serve them.
+The report routes serve them as files when a request matches one of them,
+from a copy each instance keeps under REPORTS_DIR. """
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import and_, select
+
+from api import LoadRunResource, QuotaResource
+from database import db
+from filters import (
+    DateRange, ParameterError, parse_limit, parse_ranges, parse_sort)
+from models import StandardReport
+from partitions import add_months, month_start
+
+FORMATS = {'csv': 'text/csv', 'json': 'application/json'}
+SPEC_KEYS = (
+    'format', 'since', 'until', 'range', 'foundation', 'name_prefix',
+    'guid_prefix', 'sort', 'order', 'limit',
+)
+
+STANDARD_DIR = 'standard'
+standard_table = StandardReport.__table__
+MANAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manage.py')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def normalize_spec(spec):
+    """ Validates a report spec and returns it with only the known, set
+    keys, all as strings so that equal specs hash the same """
+    if not isinstance(spec, dict):
+        raise ParameterError('The report spec must be an object')
+    unknown = set(spec) - set(SPEC_KEYS)
+    if unknown:
+        raise ParameterError('Unknown report parameters: {0}'.format(
+            ', '.join(sorted(unknown))))
+    normalized = dict(
+        (key, str(value)) for key, value in spec.items()
+        if value is not None and value != '')
+    normalized.setdefault('format', 'csv')
+    if normalized['format'] not in FORMATS:
+        raise ParameterError('format must be one of {0}'.format(
+            ', '.join(sorted(FORMATS))))
+    report_options(normalized)
+    return normalized
+
+
+def report_options(spec):
+    """ The date_ranges and list_all options of a normalized spec """
+    sort, descending = parse_sort(spec.get('sort'), spec.get('order'))
+    return {
+        'date_ranges': parse_ranges(
+            since=spec.get('since'), until=spec.get('until'),
+            ranges=spec.get('range')),
+        'foundation': spec.get('foundation'),
+        'name_prefix': spec.get('name_prefix'),
+        'guid_prefix': spec.get('guid_prefix'),
+        'sort': sort,
+        'descending': descending,
+        'limit': parse_limit(spec.get('limit')),
+    }
+
+
+def data_version():
+    """ Id of the last successful load, which changes whenever the data
+    the reports are built from does """
+    last_load = LoadRunResource.last_success()
+    return last_load.id if last_load else 0
+
+
+def job_id(spec, version):
+    """ Id of the job building spec over the data of load version """
+    key = json.dumps({'spec': spec, 'version': version}, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+
+def reports_dir():
+    directory = current_app.config['REPORTS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def status_path(report_id):
+    return os.path.join(reports_dir(), '{0}.status.json'.format(report_id))
+
+
+def result_path(report_id, report_format):
+    return os.path.join(
+        reports_dir(), '{0}.{1}'.format(report_id, report_format))
+
+
+def write_atomic(path, data):
+    """ Write data to path through a temporary file, so readers never see
+    a partly written file """
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_status(status):
+    write_atomic(
+        status_path(status['id']),
+        json.dumps(status, sort_keys=True).encode('utf-8'))
+
+
+def load_status(report_id):
+    """ Status of a job, or None if there is no such job """
+    if not report_id.isalnum():
+        return None
+    try:
+        with open(status_path(report_id)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def claim_job(status):
+    """ Create the status file of a new job. Returns False if another
+    request or worker process created it first """
+    try:
+        fd = os.open(
+            status_path(status['id']), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump(status, f, sort_keys=True)
+    return True
+
+
+def claim_retry(status, existing):
+    """ Replace the status of a failed or stale job with a new attempt.
+    Requests that saw the same attempt race to create one marker file for
+    it, so only one of them starts the retry. Returns False if another
+    request or worker process got there first """
+    marker = '{0}.{1!r}.retry'.format(
+        status_path(status['id']), existing['updated_at'])
+    try:
+        os.close(os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return False
+    save_status(status)
+    return True
+
+
+def instance():
+    """ The X-CF-APP-INSTANCE header value that routes requests to this
+    Cloud Foundry instance, None when not running on Cloud Foundry """
+    index = os.environ.get('CF_INSTANCE_INDEX')
+    try:
+        application = json.loads(os.environ.get('VCAP_APPLICATION', ''))
+    except ValueError:
+        return None
+    if index is None or 'application_id' not in application:
+        return None
+    return '{0}:{1}'.format(application['application_id'], index)
+
+
+def is_stale(status):
+    """ Check if a job has been pending or running for so long that the
+    process building it has probably died """
+    if status['status'] not in ('pending', 'running'):
+        return False
+    timeout = current_app.config['REPORT_JOB_TIMEOUT']
+    return time.time() - status['updated_at'] > timeout
+
+
+def get_executor():
+    """ The background pool of this process, started on first use so that
+    each gunicorn worker starts its own after the fork """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config['REPORT_WORKERS'])
+        return _executor
+
+
+def submit(spec):
+    """ Submit a report job and return its status. A job with the same
+    spec over the same data is reused unless it failed or went stale """
+    spec = normalize_spec(spec)
+    version = data_version()
+    report_id = job_id(spec, version)
+    existing = load_status(report_id)
+    if existing and existing['status'] != 'failed' and \
+            not is_stale(existing):
+        return existing
+    now = time.time()
+    status = {
+        'id': report_id,
+        'status': 'pending',
+        'spec': spec,
+        'data_version': version,
+        'created_at': now,
+        'updated_at': now,
+        'error': None,
+        'instance': instance(),
+    }
+    if existing is not None:
+        # Retry the failed or stale job under the same id
+        claimed = claim_retry(status, existing)
+    else:
+        claimed = claim_job(status)
+    if not claimed:
+        return load_status(report_id)
+    app = current_app._get_current_object()
+    runner = run_job_process if in_gevent_worker() else run_job
+    get_executor().submit(runner, app, status)
+    return status
+
+
+def render_report(report_format, **options):
+    """ Body of a report in report_format, built with the live report
+    logic from the options of QuotaResource.list_all """
+    if report_format == 'csv':
+        return QuotaResource.generate_cvs(**options).encode('utf-8')
+    quotas = QuotaResource.list_all(**options)
+    return json.dumps({'Quotas': quotas}).encode('utf-8')
+
+
+def build_report(spec):
+    """ Build the report body of a job's spec, without the statement
+    timeout of requests """
+    timeout = current_app.config['JOB_STATEMENT_TIMEOUT']
+    with db.replica(), db.statement_timeout(timeout):
+        return render_report(spec['format'], **report_options(spec))
+
+
+def run_job(app, status):
+    """ Build the report of a job in a background thread and record the
+    outcome in its status file """
+    with app.app_context():
+        try:
+            status['status'] = 'running'
+            status['updated_at'] = time.time()
+            save_status(status)
+            body = build_report(status['spec'])
+            write_atomic(
+                result_path(status['id'], status['spec']['format']), body)
+            status['status'] = 'ready'
+            status['size'] = len(body)
+        except Exception as error:
+            logging.exception('Report %s failed', status['id'])
+            status['status'] = 'failed'
+            status['error'] = str(error)
+        finally:
+            status['updated_at'] = time.time()
+            status['finished_at'] = str(datetime.datetime.utcnow())
+            save_status(status)
+            db.session.remove()
+        remove_expired(app.config['REPORT_MAX_AGE'])
+
+
+def in_gevent_worker():
+    """ Check if threads are greenlets in this process, as they are in
+    gevent workers """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def run_job_process(app, status):
+    """ Build the report of a job with `manage.py report` and wait for it.
+    A build on a greenlet would block every request of the gevent worker
+    until it is done, while waiting on a child process lets them run. A
+    child that dies without an outcome fails the job """
+    code = subprocess.call([sys.executable, MANAGE, 'report', status['id']])
+    with app.app_context():
+        current = load_status(status['id'])
+        if code and current and current['status'] in ('pending', 'running'):
+            current['status'] = 'failed'
+            current['error'] = 'Report process exited with {0}'.format(code)
+            current['updated_at'] = time.time()
+            save_status(current)
+
+
+def result_file(status):
+    """ Path and mimetype of a ready job's report """
+    report_format = status['spec']['format']
+    return result_path(status['id'], report_format), FORMATS[report_format]
+
+
+def remove_expired(max_age):
+    """ Delete the reports and statuses of jobs not updated for max_age
+    seconds. Returns the number of files removed """
+    directory = reports_dir()
+    cutoff = time.time() - max_age
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            # Standard reports are replaced by the loader
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            # Removed by another worker in the meantime
+            continue
+    return removed
+
+
+def standard_ranges(today):
+    """ Date ranges of the standard reports as of today. Each range ends
+    today at the latest, since there is no data for later days """
+    month = month_start(today)
+    previous = add_months(month, -1)
+    return {
+        'current_month': [DateRange(month, today)],
+        'previous_month': [
+            DateRange(previous, month - datetime.timedelta(days=1))],
+        'year_to_date': [DateRange(datetime.date(today.year, 1, 1), today)],
+    }
+
+
+def clip_ranges(date_ranges, today):
+    """ Ranges with their ends capped at today, which makes ranges that
+    cover the same loaded data compare equal """
+    return [
+        DateRange(
+            date_range.start,
+            min(date_range.end or today, today))
+        for date_range in date_ranges
+    ]
+
+
+def standard_dir():
+    return os.path.join(reports_dir(), STANDARD_DIR)
+
+
+def write_standard_reports(today=None):
+    """ Write the standard reports for the data loaded so far to the
+    database, replacing the previous ones in the same transaction, so
+    readers only ever see a complete set of reports. If writing fails the
+    old reports are withdrawn, as they no longer match the data """
+    try:
+        return save_standard_reports(today or datetime.date.today())
+    except Exception:
+        db.session.rollback()
+        discard_standard_reports()
+        raise
+
+
+def discard_standard_reports():
+    """ Stop serving the standard reports until they are written again """
+    StandardReport.query.delete()
+    db.session.commit()
+
+
+def save_standard_reports(today):
+    version = '{0}-{1}'.format(
+        data_version(), datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'))
+    saved = []
+    for name, (date_range,) in standard_ranges(today).items():
+        for report_format in FORMATS:
+            saved.append(StandardReport(
+                name=name, report_format=report_format, version=version,
+                report_date=today, start_date=date_range.start,
+                end_date=date_range.end,
+                body=render_report(report_format, date_ranges=[date_range])))
+    StandardReport.query.delete()
+    db.session.add_all(saved)
+    db.session.commit()
+    logging.info('Wrote standard reports %s', version)
+    return load_manifest()
+
+
+def load_manifest():
+    """ Version, date and ranges of the current standard reports, if any,
+    read without their bodies """
+    rows = db.session.execute(select([
+        standard_table.c.name, standard_table.c.version,
+        standard_table.c.report_date, standard_table.c.start_date,
+        standard_table.c.end_date,
+    ])).fetchall()
+    if not rows:
+        return None
+    return {
+        'version': rows[0].version,
+        'date': rows[0].report_date,
+        'reports': {
+            row.name: [DateRange(row.start_date, row.end_date)]
+            for row in rows
+        },
+    }
+
+
+def cached_report(version, name, report_format):
+    """ Path of a standard report on this instance's disk, copied from the
+    database on first use so it can be sent as a file. Copies of older
+    versions are removed. None if the report was replaced meanwhile """
+    directory = os.path.join(standard_dir(), version)
+    path = os.path.join(directory, '{0}.{1}'.format(name, report_format))
+    if os.path.exists(path):
+        return path
+    body = db.session.execute(
+        select([standard_table.c.body]).where(and_(
+            standard_table.c.name == name,
+            standard_table.c.report_format == report_format,
+            standard_table.c.version == version))).scalar()
+    if body is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    write_atomic(path, body)
+    for other in os.listdir(standard_dir()):
+        if other != version:
+            shutil.rmtree(
+                os.path.join(standard_dir(), other), ignore_errors=True)
+    return path
+
+
+def standard_report(date_ranges, report_format, **options):
+    """ Path and mimetype of the standard report answering a request with
+    date_ranges and options, or None when it needs a live report. Only
+    requests without filters, sorting or limits can match """
+    if not current_app.config['PRECOMPUTED_REPORTS'] or not date_ranges or \
+            any(value for value in options.values()):
+        return None
+    with db.replica():
+        manifest = load_manifest()
+        if manifest is None:
+            return None
+        wanted = clip_ranges(date_ranges, manifest['date'])
+        for name, stored in manifest['reports'].items():
+            if stored == wanted:
+                path = cached_report(manifest['version'], name, report_format)
+                if path:
+                    return path, FORMATS[report_format]
+    return None
@@ -0,0 +1,16 @@
+""" Runs the scheduled data loads. The scheduler runs in its own process,
+started with `python manage.py scheduler`, so web workers never load data """
+
+
+def run_scheduler(app):
+    """ Load data on a schedule until the process is stopped """
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from scripts import load_data
+
+    def scheduled_load():
+        with app.app_context():
+            load_data()
+
+    scheduler = BlockingScheduler()
+    scheduler.add_job(scheduled_load, 'cron', hour='3,12,18')
+    scheduler.start()
@@ -1,12 +1,61 @@
 """ Script for adding quotas to database """
 
-import os
 import datetime
 import logging
+import queue
+import threading
+import time
+
+from flask import current_app
 
 from cloudfoundry import CloudFoundry
-from models import Quota, QuotaData
-from quotas import db
+from database import db
+from models import LoadRun, Quota, QuotaData
+from partitions import ensure_partitions
+import reports
+
+
+# Marks the end of the fetched quotas on the loader queue
+FETCH_DONE = object()
+
+
+class LoadStats:
+
+    """ Counters collected while loading quotas """
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.rows_upserted = 0
+        self.errors = 0
+        self.fetch_time = 0.0
+        self.quotas_fetched = 0
+        self.batches = 0
+        self.queue_samples = 0
+        self.queue_depth_total = 0
+        self.queue_depth_max = 0
+
+    def sample_queue(self, depth):
+        """ Record the number of batches waiting to be written """
+        self.queue_samples += 1
+        self.queue_depth_total += depth
+        self.queue_depth_max = max(self.queue_depth_max, depth)
+
+    def log(self, foundation=None):
+        """ Log the throughput of each stage and the queue depth """
+        name = foundation or 'default'
+        logging.info(
+            'Fetch stage [%s]: %s quotas in %.1fs (%.0f/s)',
+            name, self.quotas_fetched, self.fetch_time,
+            self.quotas_fetched / self.fetch_time if self.fetch_time else 0)
+        logging.info(
+            'Write stage [%s]: %s quotas, %s errors in %s batches in %.1fs '
+            '(%.0f/s)', name, self.rows_upserted, self.errors, self.batches,
+            self.db_time,
+            self.rows_upserted / self.db_time if self.db_time else 0)
+        logging.info(
+            'Loader queue depth [%s]: mean %.1f, max %s batches', name,
+            self.queue_depth_total / self.queue_samples
+            if self.queue_samples else 0, self.queue_depth_max)
 
 
 def get_or_create(model, **kwargs):
@@ -17,7 +66,7 @@ def get_or_create(model, **kwargs):
     else:
         instance = model(**kwargs)
         db.session.add(instance)
-        db.session.commit()
+        db.session.flush()
         return instance, True
 
 
@@ -31,46 +80,273 @@ def update_quota_data(quota_model, entity_data):
     """ Add quota data to to database """
     quota_data, data_created = get_or_create(
         model=QuotaData,
-        quota=quota_model.guid,
+        quota=quota_model,
         date_collected=datetime.date.today())
     quota_data.memory_limit = entity_data['memory_limit']
     quota_data.total_routes = entity_data['total_routes']
     quota_data.total_services = entity_data['total_services']
-    quota_model.data.append(quota_data)
 
 
-def update_quota(quota):
-    """ Load one quota into database """
+def update_quota(quota, commit=True, foundation=None):
+    """ Load one quota into database, tagged with the foundation it came
+    from when one is given """
     quota_model, quota_created = get_or_create(
         model=Quota,
         guid=quota['metadata']['guid']
     )
     quota_model.url = quota['metadata']['url']
     quota_model.name = quota['entity']['name']
+    if foundation:
+        quota_model.foundation = foundation
     quota_model.created_at = get_datetime(quota['metadata']['created_at'])
     updated = quota['metadata'].get('updated_at')
     if updated:
         quota_model.updated_at = get_datetime(updated)
     update_quota_data(quota_model=quota_model, entity_data=quota['entity'])
     db.session.merge(quota_model)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return quota_model
 
 
-def load_quotas(cf_api):
-    """ Load quotas into database """
-    quotas = cf_api.get_quotas()
-    for quota in quotas:
-        update_quota(quota)
+class FoundationSource:
+
+    """ One Cloud Foundry foundation being loaded: connect returns its
+    client, which is created in the fetch thread so a slow login doesn't
+    hold up the other foundations """
+
+    def __init__(self, name, connect, stats=None):
+        self.name = name
+        self.connect = connect
+        self.stats = stats or LoadStats()
+        self.cf_api = None
+        self.error = None
+
+
+def fetch_quotas(source, batches, stop, batch_size):
+    """ Fetch stage of the loader: puts the quotas of one foundation on the
+    batches queue, batch_size at a time. Blocks while the queue is full so
+    fetching never runs far ahead of the writes, and gives up when stop is
+    set. Errors are passed through the queue to the write stage """
+    stats = source.stats
+    batch = []
+    try:
+        start = time.time()
+        source.cf_api = source.connect()
+        quotas = iter(source.cf_api.get_quotas())
+        stats.fetch_time += time.time() - start
+        while not stop.is_set():
+            start = time.time()
+            quota = next(quotas, FETCH_DONE)
+            stats.fetch_time += time.time() - start
+            if quota is FETCH_DONE:
+                break
+            stats.quotas_fetched += 1
+            batch.append(quota)
+            if len(batch) >= batch_size:
+                put_batch(batches, (source, batch), stop)
+                batch = []
+        if batch:
+            put_batch(batches, (source, batch), stop)
+        put_batch(batches, (source, FETCH_DONE), stop)
+    except Exception as error:
+        put_batch(batches, (source, error), stop)
+
+
+def put_batch(batches, item, stop):
+    """ Put item on the queue, waiting for space unless stop is set """
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def write_batch(batch, stats, foundation=None):
+    """ Write stage of the loader: writes a batch of quotas in one
+    transaction. If the batch fails it is retried one quota at a time, so
+    a quota that fails to load is skipped and counted """
+    start = time.time()
+    try:
+        for quota in batch:
+            update_quota(quota, commit=False, foundation=foundation)
+        db.session.commit()
+        stats.rows_upserted += len(batch)
+    except Exception:
+        db.session.rollback()
+        for quota in batch:
+            try:
+                update_quota(quota, foundation=foundation)
+                stats.rows_upserted += 1
+            except Exception:
+                db.session.rollback()
+                stats.errors += 1
+                logging.exception(
+                    'Failed to load quota %s', quota['metadata'].get('guid'))
+    finally:
+        stats.batches += 1
+        stats.db_time += time.time() - start
+
+
+def load_sources(sources, batch_size=100, queue_size=4, on_finish=None):
+    """ Load the quotas of several foundations at once. Each foundation is
+    fetched in its own thread and all of them share one bounded queue of
+    batches, which the calling thread writes in the order they arrive, so
+    a slow foundation doesn't hold up the others. A foundation that fails
+    is recorded on its source and the others carry on. on_finish is called
+    with each source as soon as it is done or has failed. Database writes
+    stay on the calling thread and its session """
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    fetchers = []
+    for source in sources:
+        fetcher = threading.Thread(
+            target=fetch_quotas,
+            name='quota-fetcher-{0}'.format(source.name),
+            args=(source, batches, stop, batch_size))
+        fetcher.daemon = True
+        fetcher.start()
+        fetchers.append(fetcher)
+    remaining = len(sources)
+    try:
+        while remaining:
+            depth = batches.qsize()
+            try:
+                source, batch = batches.get(timeout=1)
+            except queue.Empty:
+                # A fetcher can put its last batch and exit after the get
+                # timed out, so the queue is checked again once none is alive
+                if not any(fetcher.is_alive() for fetcher in fetchers) and \
+                        batches.empty():
+                    raise RuntimeError('Quota fetchers stopped unexpectedly')
+                continue
+            source.stats.sample_queue(depth)
+            if batch is not FETCH_DONE and not isinstance(batch, Exception):
+                write_batch(batch, source.stats, foundation=source.name)
+                continue
+            remaining -= 1
+            if batch is not FETCH_DONE:
+                source.error = batch
+                logging.error(
+                    'Fetching from foundation %s failed: %r',
+                    source.name, batch)
+            if on_finish:
+                on_finish(source)
+    finally:
+        stop.set()
+        for fetcher in fetchers:
+            fetcher.join()
+        for source in sources:
+            source.stats.log(source.name)
+    return sources
+
+
+def load_quotas(cf_api, stats=None, batch_size=100, queue_size=4,
+                foundation=None):
+    """ Load quotas into database, skipping quotas that fail to load. The
+    quotas are fetched in a background thread while the previous batches
+    are written, with at most queue_size batches waiting in between """
+    source = FoundationSource(foundation, lambda: cf_api, stats)
+    load_sources([source], batch_size=batch_size, queue_size=queue_size)
+    if source.error:
+        raise source.error
+    return source.stats
+
+
+def finish_load_run(run, stats, cf_api=None, error=None):
+    """ Record the outcome and metrics of a loader run """
+    run.finished_at = datetime.datetime.utcnow()
+    run.duration = (run.finished_at - run.started_at).total_seconds()
+    run.db_time = stats.db_time
+    run.rows_upserted = stats.rows_upserted
+    run.errors = stats.errors
+    if cf_api:
+        run.pages_fetched = cf_api.pages_fetched
+        run.http_time = cf_api.http_time
+    if error:
+        run.status = 'failed'
+        run.error_message = str(error)
+    else:
+        run.status = 'success'
+    db.session.add(run)
+    db.session.commit()
+
+
+def prepare_partitions():
+    """ Make sure the data table has partitions for the coming months """
+    connection = db.engine.connect()
+    try:
+        months_ahead = current_app.config['PARTITION_MONTHS_AHEAD']
+        return ensure_partitions(connection, months_ahead=months_ahead)
+    finally:
+        connection.close()
+
+
+def connect_foundation(foundation):
+    """ Returns a function that logs in to a foundation from the
+    CF_FOUNDATIONS config """
+    def connect():
+        return CloudFoundry(
+            api_url=foundation['api_url'],
+            uaa_url=foundation['uaa_url'],
+            username=foundation['username'],
+            password=foundation['password'])
+    return connect
 
 
 def load_data():
-    """ Starts the data loading process """
-    cf_api = CloudFoundry(
-        api_url=os.getenv('CF_API_URL'),
-        uaa_url=os.getenv('CF_UAA_URL'),
-        username=os.getenv('CF_USERNAME'),
-        password=os.getenv('CF_PASSWORD'))
+    """ Starts the data loading process, collecting every foundation in
+    CF_FOUNDATIONS concurrently. Each foundation records its own LoadRun as
+    soon as it is done, so a slow foundation doesn't hold up the others'.
+    The standard reports are then rewritten from the new data. Raises the
+    first error after every foundation has finished """
+    prepare_partitions()
+    foundations = current_app.config['CF_FOUNDATIONS']
+    runs = {}
+    sources = []
+    for foundation in foundations:
+        source = FoundationSource(
+            foundation['name'], connect_foundation(foundation))
+        runs[source] = LoadRun(foundation=foundation['name'])
+        sources.append(source)
+    db.session.add_all(runs.values())
+    db.session.commit()
+    errors = []
+
+    def finish(source):
+        run = runs.pop(source)
+        finish_load_run(
+            run, source.stats, cf_api=source.cf_api, error=source.error)
+        if source.error:
+            errors.append(source.error)
+            logging.error(
+                'Data Update Failed for %s: %s', source.name, source.error)
+        else:
+            logging.info(
+                'Data Update Successful for %s: %s quotas, %s errors '
+                'in %.1fs', source.name, source.stats.rows_upserted,
+                source.stats.errors, run.duration)
+
     logging.info('Starting Data Update')
-    load_quotas(cf_api=cf_api)
-    logging.info('Data Update Successful')
+    try:
+        load_sources(
+            sources,
+            batch_size=current_app.config['LOADER_BATCH_SIZE'],
+            queue_size=current_app.config['LOADER_QUEUE_SIZE'],
+            on_finish=finish)
+    except Exception as error:
+        db.session.rollback()
+        for source, run in runs.items():
+            finish_load_run(
+                run, source.stats, cf_api=source.cf_api,
+                error=source.error or error)
+        logging.exception('Data Update Failed')
+        raise
+    if current_app.config['PRECOMPUTED_REPORTS']:
+        try:
+            reports.write_standard_reports()
+        except Exception:
+            logging.exception('Writing the standard reports failed')
+    if errors:
+        raise errors[0]
@@ -0,0 +1,132 @@
+""" Monthly chargeback statements, one CSV file per month with a row per
+quota. Months are built in parallel by a pool of processes. Each process
+builds its own app and database connections and reads a month with one
+query, so the months never wait on each other or on a shared GIL. """
+
+import csv
+import datetime
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+
+from api import QuotaResource
+from database import db
+from filters import DateRange
+from partitions import add_months, month_start
+import records
+from reports import write_atomic
+
+MANIFEST = 'manifest.json'
+HEADER = [
+    'month', 'foundation', 'quota_name', 'quota_guid', 'mb_days', 'cost',
+]
+
+_app = None
+
+
+def statement_months(months, today=None):
+    """ First days of the last `months` complete months, oldest first """
+    current = month_start(today or datetime.date.today())
+    return [add_months(current, -offset) for offset in range(months, 0, -1)]
+
+
+def month_range(month):
+    """ The date range covering every day of month """
+    return DateRange(month, add_months(month, 1) - datetime.timedelta(days=1))
+
+
+def statement_rows(month):
+    """ One statement row per quota with data in month """
+    label = month.strftime('%Y-%m')
+    rows = records.statement_records([month_range(month)])
+    for guid, quota_rows in groupby(rows, key=lambda row: row.guid):
+        quota_rows = list(quota_rows)
+        memory = [(row.memory_limit or 0, row.days) for row in quota_rows]
+        yield [
+            label,
+            quota_rows[0].foundation,
+            quota_rows[0].name,
+            guid,
+            sum(limit * days for limit, days in memory),
+            str(QuotaResource.get_mem_cost(memory)),
+        ]
+
+
+def render_statement(month):
+    """ CSV body of the statement of month and its number of quotas """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(HEADER)
+    count = 0
+    for row in statement_rows(month):
+        writer.writerow(row)
+        count += 1
+    return output.getvalue().encode('utf-8'), count
+
+
+def worker_app(config):
+    """ The app of this worker process, built on first use. The scoped
+    session inherited through the fork is dropped without closing, since
+    its connection belongs to the parent """
+    global _app
+    if _app is None:
+        from quotas import create_app
+        db.session.registry.clear()
+        _app = create_app(config)
+    return _app
+
+
+def build_statement(config, month, out_dir):
+    """ Write the statement of month to out_dir in a worker process and
+    return its manifest entry """
+    start = time.perf_counter()
+    app = worker_app(config)
+    with app.app_context():
+        try:
+            with db.replica(), db.statement_timeout(
+                    app.config['JOB_STATEMENT_TIMEOUT']):
+                body, count = render_statement(month)
+        finally:
+            db.session.remove()
+    file_name = 'statement-{0}.csv'.format(month.strftime('%Y-%m'))
+    write_atomic(os.path.join(out_dir, file_name), body)
+    return {
+        'month': month.strftime('%Y-%m'),
+        'file': file_name,
+        'quotas': count,
+        'bytes': len(body),
+        'seconds': time.perf_counter() - start,
+        'pid': os.getpid(),
+    }
+
+
+def generate_statements(config, months, out_dir, workers=None, today=None):
+    """ Write the statements of the last `months` complete months to
+    out_dir with a pool of worker processes, then a manifest listing them
+    with the run's throughput. Returns the manifest """
+    os.makedirs(out_dir, exist_ok=True)
+    wanted = statement_months(months, today=today)
+    # Workers are forked, make sure none inherits an open connection
+    db.session.remove()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(
+            build_statement, [config] * len(wanted), wanted,
+            [out_dir] * len(wanted)))
+    elapsed = time.perf_counter() - start
+    total = sum(entry['quotas'] for entry in entries)
+    manifest = {
+        'generated_at': str(datetime.datetime.utcnow()),
+        'months': entries,
+        'quotas': total,
+        'seconds': elapsed,
+        'quotas_per_second': total / elapsed if elapsed else None,
+        'months_per_second': len(entries) / elapsed if elapsed else None,
+    }
+    write_atomic(
+        os.path.join(out_dir, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
@@ -7,18 +7,50 @@ var QuotaModel = require('./QuotaModel');
 var QuotaCollection = Backbone.Collection.extend({
   url: '/api/quotas/',
   model: QuotaModel,
+  batchUrl: '/api/quotas/batch',
   initialize: function initialize () {
+    this.dates = {};
+    this.pendingIds = [];
+    this.pendingBatch = null;
     this.fetch();
   },
   getId: function search (id) {
     var model = this.get(id);
     if (model) {
-      return $.Deferred().resolveWith(this, model);
+      return $.Deferred().resolveWith(this, [model]);
     }
-    else {
-      model = new QuotaModel({ guid: id });
-      return model.fetch();
+    var collection = this;
+    return this.fetchMany([id]).then(function () {
+      return collection.get(id);
+    });
+  },
+  // Quotas asked for in the same tick are fetched with one batch request
+  fetchMany: function fetchMany (ids) {
+    this.pendingIds = _.union(this.pendingIds, ids);
+    if (!this.pendingBatch) {
+      this.pendingBatch = $.Deferred();
+      _.defer(_.bind(this.sendBatch, this));
     }
+    return this.pendingBatch.promise();
+  },
+  sendBatch: function sendBatch () {
+    var batch = this.pendingBatch;
+    var ids = this.pendingIds;
+    var collection = this;
+    this.pendingBatch = null;
+    this.pendingIds = [];
+    $.ajax({
+      url: this.batchUrl + '?' + $.param(_.pick(this.dates, _.identity)),
+      type: 'POST',
+      contentType: 'application/json',
+      dataType: 'json',
+      data: JSON.stringify({ guids: ids })
+    }).done(function (response) {
+      collection.add(response.Quotas, { merge: true });
+      batch.resolveWith(collection, [collection, response.missing]);
+    }).fail(function () {
+      batch.rejectWith(collection, arguments);
+    });
   },
   filterByDates: function filterByDates (sinceDate, untilDate, guid) {
     console.log('filtering by dates');
@@ -32,6 +64,7 @@ var QuotaCollection = Backbone.Collection.extend({
       'since': sinceDate,
       'until': untilDate
     };
+    this.dates = dates;
     this.trigger('sync');
 
     return this.fetch({data: dates});
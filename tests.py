@@ -1,27 +1,55 @@
 # Extral Imports
 from unittest import mock
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 from flask.ext.testing import TestCase
 import base64
 import copy
 import datetime
+import flask
+import io
+import json
+import msgpack
+import os
+import pyarrow.parquet
+import queue
 import requests
+import shutil
+import threading
+import time
 import types
 import unittest
 
 # App imports
 from cloudfoundry import CloudFoundry
-from quotas import app, db
-from models import Quota, QuotaData
+from database import db
+from quotas import create_app
+from models import (
+    LoadRun, Quota, QuotaData, QuotaDataMonthly, StandardReport)
 from api import QuotaResource, QuotaDataResource
+import admission
+import bench
+import cloudfoundry
+import compaction
+import database
+import export
+import filters
+import instrumentation
+import loadtest
+import partitions
+import reports
 import scripts
+import statements
 
 # Auth testings
 from config import Config
 from werkzeug.test import Client
 from werkzeug.datastructures import Headers
 
-# Flip app settings to testing
-app.config.from_object('config.TestingConfig')
+# Build the app with testing settings
+app = create_app('config.TestingConfig')
 
 mock_quota = {
     'metadata': {
@@ -93,6 +121,14 @@ class MockReq:
     def json(self):
         return self.data
 
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        body = json.dumps(self.data).encode('utf-8')
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
 
 def mock_token(func):
     """ Patches post request and return a mock token """
@@ -123,6 +159,26 @@ def mock_orgs_request(func):
     return test_mock_get
 
 
+class AppFactoryTest(unittest.TestCase):
+    """ Test the application factory """
+
+    def test_create_app(self):
+        """ Check that each call builds a configured app with the routes """
+        new_app = create_app('config.TestingConfig')
+        self.assertFalse(new_app is app)
+        self.assertTrue(new_app.config['TESTING'])
+        rules = [rule.rule for rule in new_app.url_map.iter_rules()]
+        self.assertTrue('/api/quotas/' in rules)
+        self.assertTrue('/quotas.csv' in rules)
+
+    def test_create_app_does_not_schedule(self):
+        """ Check that building the app doesn't start a scheduler """
+        with mock.patch(
+                'apscheduler.schedulers.base.BaseScheduler.start') as start:
+            create_app('config.TestingConfig')
+        self.assertFalse(start.called)
+
+
 class CloudFoundryTest(unittest.TestCase):
     """ Test CloudFoundry client """
 
@@ -172,6 +228,47 @@ class CloudFoundryTest(unittest.TestCase):
         quotas = list(self.cf.get_quotas())
         self.assertEqual(len(quotas), 2)
 
+    @mock_token
+    def test_get_quotas_streams_pages(self):
+        """ Test that quotas are decoded from streamed pages of the largest
+        size and that next_url is followed """
+        first_page = {
+            'total_results': 3,
+            'next_url': '/v2/quota_definitions?page=2&results-per-page=100',
+            'resources': [mock_quota, mock_quota_2],
+        }
+        second_page = {'next_url': None, 'resources': [mock_quota]}
+        responses = [MockReq(first_page), MockReq(second_page)]
+        with mock.patch.object(requests, 'get', side_effect=responses) as get:
+            quotas = list(self.cf.get_quotas())
+        self.assertEqual(quotas, [mock_quota, mock_quota_2, mock_quota])
+        self.assertEqual(self.cf.pages_fetched, 2)
+        first_call, second_call = get.call_args_list
+        self.assertEqual(
+            first_call[1]['params'], {'results-per-page': 100})
+        self.assertTrue(first_call[1]['stream'])
+        self.assertEqual(
+            first_call[1]['timeout'], cloudfoundry.REQUEST_TIMEOUT)
+        self.assertEqual(second_call[1]['params'], None)
+
+    def test_iter_json_resources(self):
+        """ Test that resources are parsed whichever way the page is split
+        into chunks, and that the other keys are kept """
+        text = json.dumps(dict(mock_quotas_data, total_results=2))
+        for size in [1, 7, len(text)]:
+            page = {}
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            resources = list(
+                cloudfoundry.iter_json_resources(chunks, page))
+            self.assertEqual(resources, mock_quotas_data['resources'])
+            self.assertEqual(page, {'next_url': None, 'total_results': 2})
+
+    def test_iter_json_resources_truncated(self):
+        """ Test that a truncated page raises an error """
+        text = json.dumps(mock_quotas_data)[:-10]
+        self.assertRaises(
+            ValueError, list, cloudfoundry.iter_json_resources([text], {}))
+
     @mock_token
     @mock_quotas_request
     def test_yield_request(self):
@@ -221,15 +318,18 @@ class QuotaModelsTest(TestCase):
 
     def test_primary_key_constraint(self):
         """ Test that only one instance of a quota can be created """
-        # Adding two instances of the same Quota with same dates
         new_quota = Quota(guid='test_guid', name='test_name', url='test_url')
         db.session.add(new_quota)
-        new_quota = Quota(guid='test_guid', name='test_name', url='test_url')
-        db.session.merge(new_quota)
         db.session.commit()
-        # Getting data from quota
+        # The guid is unique although the primary key is the integer id
+        new_quota = Quota(guid='test_guid', name='test_name', url='test_url')
+        db.session.add(new_quota)
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
         quotas = Quota.query.filter_by(guid='test_guid').all()
         self.assertEqual(len(quotas), 1)
+        self.assertIsInstance(quotas[0].id, int)
 
 
 class DatabaseForeignKeyTest(TestCase):
@@ -269,16 +369,10 @@ class DatabaseForeignKeyTest(TestCase):
 
     def test_primary_key_constraints_for_quotadata(self):
         """ Check that the PrimaryKeyConstraints work for QuotaData """
-        failed = False
-        quota_data = QuotaData(self.quota)
-        quota_data_2 = QuotaData(self.quota)
-        self.quota.data.append(quota_data)
-        self.quota.data.append(quota_data_2)
-        try:
-            db.session.commit()
-        except:
-            failed = True
-        self.assertTrue(failed)
+        # Building QuotaData for a quota adds it to quota.data already
+        QuotaData(self.quota)
+        QuotaData(self.quota)
+        self.assertRaises(IntegrityError, db.session.commit)
 
     def test_quota_data_one_to_many(self):
         """ Check that the relationship between Quota and QuotaData is
@@ -333,7 +427,7 @@ class APITest(TestCase):
         quota_dict = quota.details()
         self.assertEqual(
             sorted(list(quota_dict.keys())),
-            ['created_at', 'guid', 'name', 'updated_at'])
+            ['created_at', 'foundation', 'guid', 'name', 'updated_at'])
 
     def test_list_one_details(self):
         """ Check that list one function returns dict of one quota """
@@ -355,6 +449,57 @@ class APITest(TestCase):
         self.assertEqual(quotas[0]['guid'], 'test_guid')
         self.assertEqual(quotas[1]['guid'], 'test_guid_2')
 
+    def test_list_all_by_foundation(self):
+        """ Check that list all and the csv can be limited to the quotas of
+        one foundation """
+        quota = QuotaResource.query.filter_by(guid='test_guid').first()
+        quota.foundation = 'east'
+        db.session.commit()
+        quotas = QuotaResource.list_all(foundation='east')
+        self.assertEqual([q['guid'] for q in quotas], ['test_guid'])
+        self.assertEqual(quotas[0]['foundation'], 'east')
+        self.assertEqual(len(quotas[0]['memory']), 2)
+        self.assertEqual(QuotaResource.list_all(foundation='west'), [])
+        csv = QuotaResource.generate_cvs(foundation='east').split('\r\n')
+        self.assertEqual(csv[1:], ['test_name,test_guid,13.2,None', ''])
+
+    def test_list_all_sorted_by_cost(self):
+        """ Check that quotas are ordered and limited by cost in SQL """
+        quotas = QuotaResource.list_all(sort='cost', descending=True)
+        self.assertEqual(
+            [q['guid'] for q in quotas], ['test_guid', 'test_guid_2'])
+        self.assertEqual(quotas[0]['cost'], 13.2)
+        top = QuotaResource.list_all(sort='cost', descending=True, limit=1)
+        self.assertEqual(top, quotas[:1])
+        cheapest = QuotaResource.list_all(sort='cost', limit=1)
+        self.assertEqual([q['guid'] for q in cheapest], ['test_guid_2'])
+        # Only the memory used in the date range counts
+        ranged = QuotaResource.list_all(
+            sort='cost', descending=True, start_date='2015-01-01')
+        self.assertEqual(ranged[0]['cost'], 3.3)
+
+    def test_list_all_prefix_filters(self):
+        """ Check the name and guid prefix filters, which treat LIKE
+        wildcards literally """
+        quotas = QuotaResource.list_all(name_prefix='test_name_')
+        self.assertEqual([q['guid'] for q in quotas], ['test_guid_2'])
+        quotas = QuotaResource.list_all(guid_prefix='test_guid')
+        self.assertEqual(len(quotas), 2)
+        self.assertEqual(QuotaResource.list_all(guid_prefix='test%'), [])
+        quotas = QuotaResource.list_all(sort='name', descending=True)
+        self.assertEqual(
+            [q['name'] for q in quotas], ['test_name_2', 'test_name'])
+
+    def test_list_many(self):
+        """ Check that list many returns only the requested quotas with the
+        same output as the single quota path """
+        quotas = QuotaResource.list_many(guids=['test_guid_2', 'test_guid'])
+        self.assertEqual(
+            [q['guid'] for q in quotas], ['test_guid', 'test_guid_2'])
+        self.assertEqual(
+            quotas[0], QuotaResource.list_one_aggregate(guid='test_guid'))
+        self.assertEqual(QuotaResource.list_many(guids=['missing']), [])
+
     def test_get_mem_single_cost(self):
         """ Check that the cost function works with multiple days
         with single mem limit """
@@ -413,11 +558,24 @@ class APITest(TestCase):
             end_date=datetime.date(2014, 1, 2))
         self.assertEqual(len(one_quota['memory']), 1)
 
+    def test_list_all_matches_orm(self):
+        """ Check that the Core read path produces the output of the ORM
+        path the benchmarks compare it to """
+        self.assertEqual(
+            QuotaResource.list_all(start_date='2013-06-01'),
+            bench.list_all_orm('2013-06-01', None))
+        quota = QuotaResource.query.filter_by(guid='test_guid').first()
+        self.assertEqual(
+            QuotaResource.list_one_details(guid='test_guid'),
+            quota.data_details())
+
     def test_quotadata_details(self):
         """ Check that details function returns dict for a specific
         quotadata object """
-        data = QuotaDataResource.query.filter_by(quota='test_guid').first()
+        quota = Quota.query.filter_by(guid='test_guid').first()
+        data = QuotaDataResource.query.filter_by(quota_id=quota.id).first()
         self.assertTrue('memory_limit' in data.details().keys())
+        self.assertEqual(data.details()['quota_guid'], 'test_guid')
 
     def test_quotadata_aggregate(self):
         """ Check that the aggregate function return the number of days a
@@ -438,6 +596,19 @@ class APITest(TestCase):
         # Addition test allows the test to work with postgres and sqlite
         self.assertEqual(data[0][1] + data[1][1], 2)
 
+    def test_quotadata_aggregate_open_ended(self):
+        """ Check that a range with only a start date is filtered """
+        data = QuotaDataResource.aggregate(
+            quota_guid='test_guid', start_date='2013-06-01')
+        self.assertEqual(data, [(1000, 2)])
+
+    def test_quotadata_aggregate_multiple_ranges(self):
+        """ Check that several ranges are aggregated in one query """
+        date_ranges = filters.parse_ranges(ranges='2013-01..2013-03,2015')
+        data = QuotaDataResource.aggregate(
+            quota_guid='test_guid', date_ranges=date_ranges)
+        self.assertEqual(sorted(data), [(1000, 1), (2000, 1)])
+
     def test_foreign_key_preparer(self):
         """ Verify that function prepares a details list for a given
         foreign key """
@@ -457,6 +628,214 @@ auth = '{0}:{1}'.format(Config.USERNAME, Config.PASSWORD).encode('ascii')
 valid_header.add('Authorization', b'Basic ' + base64.b64encode(auth))
 
 
+class DateRangeTest(unittest.TestCase):
+    """ Test parsing of date range parameters """
+
+    def test_parse_date(self):
+        """ Check that dates are parsed in the supported formats """
+        self.assertEqual(
+            filters.parse_date('2014-1-2'), datetime.date(2014, 1, 2))
+        self.assertEqual(
+            filters.parse_date('2014-01-02 13:03:13.810978'),
+            datetime.date(2014, 1, 2))
+        self.assertEqual(
+            filters.parse_date('2014-02'), datetime.date(2014, 2, 1))
+        self.assertEqual(
+            filters.parse_date('2014-02', end=True),
+            datetime.date(2014, 2, 28))
+        self.assertEqual(
+            filters.parse_date(datetime.datetime(2014, 1, 2, 5)),
+            datetime.date(2014, 1, 2))
+
+    def test_parse_date_invalid(self):
+        """ Check that invalid dates are rejected """
+        self.assertRaises(filters.DateRangeError, filters.parse_date, 'x')
+        self.assertRaises(
+            filters.DateRangeError, filters.parse_date, '2014-13-01')
+
+    def test_parse_ranges_since_until(self):
+        """ Check that since and until build one, possibly open, range """
+        self.assertEqual(filters.parse_ranges(), [])
+        self.assertEqual(
+            filters.parse_ranges(since='2014-01-01'),
+            [filters.DateRange(datetime.date(2014, 1, 1), None)])
+        self.assertRaises(
+            filters.DateRangeError, filters.parse_ranges,
+            since='2015-01-01', until='2014-01-01')
+
+    def test_parse_ranges_list(self):
+        """ Check that a list of ranges is parsed """
+        ranges = filters.parse_ranges(ranges='2024-01..2024-03,2024-07..')
+        self.assertEqual(ranges, [
+            filters.DateRange(
+                datetime.date(2024, 1, 1), datetime.date(2024, 3, 31)),
+            filters.DateRange(datetime.date(2024, 7, 1), None),
+        ])
+        self.assertRaises(
+            filters.DateRangeError, filters.parse_ranges, ranges='..')
+        self.assertRaises(
+            filters.DateRangeError, filters.parse_ranges,
+            since='2014-01-01', ranges='2014')
+
+    def test_parse_sort_and_limit(self):
+        """ Check the sort, order and limit parameters of reports """
+        self.assertEqual(filters.parse_sort(), (None, False))
+        self.assertEqual(filters.parse_sort('cost'), ('cost', True))
+        self.assertEqual(filters.parse_sort('cost', 'asc'), ('cost', False))
+        self.assertEqual(filters.parse_sort('name'), ('name', False))
+        self.assertEqual(filters.parse_limit('10'), 10)
+        self.assertEqual(filters.parse_limit(None), None)
+        self.assertRaises(filters.ParameterError, filters.parse_sort, 'url')
+        self.assertRaises(
+            filters.ParameterError, filters.parse_sort, 'name', 'up')
+        self.assertRaises(filters.ParameterError, filters.parse_limit, '0')
+        self.assertRaises(filters.ParameterError, filters.parse_limit, 'ten')
+
+
+class PartitionTest(TestCase):
+    """ Test monthly partition maintenance """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def test_partition_names(self):
+        """ Check that partitions are named after their month """
+        self.assertEqual(
+            partitions.partition_name(datetime.date(2015, 1, 1)),
+            'data_y2015m01')
+
+    def test_add_months(self):
+        """ Check that months roll over into the next year """
+        self.assertEqual(
+            partitions.add_months(datetime.date(2015, 11, 1), 3),
+            datetime.date(2016, 2, 1))
+        self.assertEqual(
+            partitions.month_start(datetime.date(2015, 11, 17)),
+            datetime.date(2015, 11, 1))
+
+    def test_ensure_partitions_unpartitioned(self):
+        """ Check that unpartitioned backends are left alone """
+        db.create_all()
+        try:
+            self.assertEqual(scripts.prepare_partitions(), [])
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+class CompactionTest(TestCase):
+    """ Test compaction of old daily data into monthly rows """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        db.create_all()
+        quota = Quota(guid='guid', name='test_name', url='test_url')
+        db.session.add(quota)
+        day = datetime.date(2013, 12, 20)
+        while day < datetime.date(2014, 3, 10):
+            quota_data = QuotaData(quota, day)
+            quota_data.memory_limit = 1000 if day.month % 2 else 2000
+            quota.data.append(quota_data)
+            day += datetime.timedelta(days=1)
+        db.session.commit()
+        self.today = datetime.date(2014, 3, 15)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_compaction_cutoff(self):
+        """ Check that the cutoff is rounded down to a whole month """
+        self.assertEqual(
+            compaction.compaction_cutoff(45, today=self.today),
+            datetime.date(2014, 1, 1))
+
+    def test_compact(self):
+        """ Check that old daily rows are rolled into monthly rows """
+        deleted = compaction.compact(45, batch_size=1, today=self.today)
+        self.assertEqual(deleted, 12)
+        self.assertEqual(QuotaData.query.count(), 31 + 28 + 9)
+        monthly = QuotaDataMonthly.query.one()
+        self.assertEqual(monthly.month, datetime.date(2013, 12, 1))
+        self.assertEqual(monthly.memory_limit, 2000)
+        self.assertEqual(monthly.days, 12)
+        # Running again finds nothing left to compact
+        self.assertEqual(
+            compaction.compact(45, batch_size=1, today=self.today), 0)
+
+    def test_totals_across_compacted_boundary(self):
+        """ Check that aggregates and costs are unchanged by compaction """
+        before_all = QuotaResource.list_one_aggregate(guid='guid')
+        before_range = QuotaResource.list_one_aggregate(
+            guid='guid', start_date='2013-12-01', end_date='2014-02-28')
+        compaction.compact(45, today=self.today)
+        compaction.compact(10, today=self.today)
+        after_all = QuotaResource.list_one_aggregate(guid='guid')
+        after_range = QuotaResource.list_one_aggregate(
+            guid='guid', start_date='2013-12-01', end_date='2014-02-28')
+        self.assertEqual(QuotaDataMonthly.query.count(), 3)
+        for before, after in [(before_all, after_all),
+                              (before_range, after_range)]:
+            self.assertEqual(before['cost'], after['cost'])
+            self.assertEqual(
+                sorted(before['memory'], key=lambda m: m['size']),
+                sorted(after['memory'], key=lambda m: m['size']))
+
+    def test_export_compacted_months(self):
+        """ Check that the export keeps compacted months as rows with their
+        number of days, ahead of the daily rows """
+        compaction.compact(45, today=self.today)
+        path = 'test_export.parquet'
+        try:
+            written = export.write_parquet(
+                path, filters.parse_ranges(until='2014-01-31'),
+                batch_size=100)
+            table = pyarrow.parquet.read_table(path).to_pydict()
+        finally:
+            os.remove(path)
+        self.assertEqual(written, 1 + 31)
+        self.assertEqual(table['month'][0], datetime.date(2013, 12, 1))
+        self.assertEqual(table['date_collected'][0], None)
+        self.assertEqual(
+            (table['memory_limit'][0], table['days'][0]), (2000, 12))
+        self.assertEqual(table['month'][1:], [None] * 31)
+        self.assertEqual(
+            table['date_collected'][1:],
+            [datetime.date(2014, 1, day) for day in range(1, 32)])
+        self.assertEqual(sum(table['days']), 12 + 31)
+        self.assertRaises(
+            filters.DateRangeError, export.write_parquet, path,
+            filters.parse_ranges(since='2013-12-25'), 100)
+        self.assertFalse(os.path.exists(path))
+
+    def test_mid_month_range_over_compacted_month(self):
+        """ Check that a range splitting a compacted month is rejected,
+        while ranges splitting months that still have daily data work """
+        before = QuotaResource.list_one_aggregate(
+            guid='guid', start_date='2014-01-10', end_date='2014-02-15')
+        compaction.compact(45, today=self.today)
+        self.assertRaises(
+            filters.DateRangeError, QuotaResource.list_one_aggregate,
+            guid='guid', start_date='2013-12-25', end_date='2014-01-10')
+        response = self.client.get(
+            '/api/quotas/guid/?since=2013-12-25&until=2014-01-10',
+            headers=valid_header)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('2014-01-01', response.json['error'])
+        after = QuotaResource.list_one_aggregate(
+            guid='guid', start_date='2014-01-10', end_date='2014-02-15')
+        self.assertEqual(before['memory'], after['memory'])
+        whole = QuotaResource.list_one_aggregate(
+            guid='guid', start_date='2013-12-01', end_date='2014-01-10')
+        self.assertEqual(
+            sorted(whole['memory'], key=lambda m: m['size']),
+            [{'size': 1000, 'days': 10}, {'size': 2000, 'days': 12}])
+
+
 class QuotaAppTest(TestCase):
     """ Test Database """
 
@@ -466,24 +845,27 @@ class QuotaAppTest(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        db.create_all()
-        quota_1 = Quota(guid='guid', name='test_name', url='test_url')
-        db.session.add(quota_1)
-        quota_2 = Quota(guid='guid_2', name='test_name_2', url='test_url_2')
-        db.session.add(quota_2)
-        quota_data = QuotaData(quota_1)
-        quota_data.date_collected = datetime.date(2014, 1, 1)
-        quota_data.memory_limit = 1000
-        quota_data_2 = QuotaData(quota_1)
-        quota_data_2.memory_limit = 1000
-        quota_1.data.append(quota_data)
-        quota_1.data.append(quota_data_2)
-        db.session.commit()
+        with app.app_context():
+            db.create_all()
+            quota_1 = Quota(guid='guid', name='test_name', url='test_url')
+            db.session.add(quota_1)
+            quota_2 = Quota(
+                guid='guid_2', name='test_name_2', url='test_url_2')
+            db.session.add(quota_2)
+            quota_data = QuotaData(quota_1)
+            quota_data.date_collected = datetime.date(2014, 1, 1)
+            quota_data.memory_limit = 1000
+            quota_data_2 = QuotaData(quota_1)
+            quota_data_2.memory_limit = 1000
+            quota_1.data.append(quota_data)
+            quota_1.data.append(quota_data_2)
+            db.session.commit()
 
     @classmethod
     def tearDownClass(cls):
-        db.session.remove()
-        db.drop_all()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
 
     def test_main_page_locked(self):
         """ Check if main page is locked """
@@ -524,6 +906,88 @@ class QuotaAppTest(TestCase):
         rv = Client.open(self.client, path='/', headers=h)
         self.assert_200(rv)
 
+    def accept_header(self, mimetype):
+        headers = Headers(valid_header)
+        headers.add('Accept', mimetype)
+        return headers
+
+    def test_api_msgpack(self):
+        """ Test that MessagePack is sent when the client asks for it """
+        expected = QuotaResource.list_all(start_date='2013-01-01')
+        response = Client.open(
+            self.client, path="/api/quotas/?since=2013-01-01",
+            headers=self.accept_header('application/x-msgpack'))
+        self.assertEqual(response.mimetype, 'application/x-msgpack')
+        self.assertTrue('Accept' in response.headers['Vary'])
+        self.assertEqual(
+            msgpack.unpackb(response.data, encoding='utf-8'),
+            {'Quotas': expected})
+        response = Client.open(
+            self.client, path="/api/quotas/guid/?since=2013-01-01",
+            headers=self.accept_header('application/x-msgpack'))
+        self.assertEqual(
+            msgpack.unpackb(response.data, encoding='utf-8'),
+            QuotaResource.list_one_aggregate(
+                'guid', start_date='2013-01-01'))
+
+    def test_api_ndjson(self):
+        """ Test that NDJSON streams one quota per line """
+        expected = QuotaResource.list_all(start_date='2013-01-01')
+        response = Client.open(
+            self.client, path="/api/quotas/?since=2013-01-01",
+            headers=self.accept_header('application/x-ndjson'))
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+        response = Client.open(
+            self.client, path="/api/quotas/guid/",
+            headers=self.accept_header('application/x-ndjson'))
+        self.assertEqual(len(response.data.decode('utf-8').splitlines()), 1)
+
+    def test_api_formats_negotiated(self):
+        """ Test that JSON stays the default and unknown formats are
+        refused """
+        for accept in ['*/*', 'application/json', 'text/html,*/*;q=0.8']:
+            response = Client.open(
+                self.client, path="/api/quotas/",
+                headers=self.accept_header(accept))
+            self.assertEqual(response.mimetype, 'application/json')
+        response = Client.open(
+            self.client, path="/api/quotas/",
+            headers=self.accept_header('text/xml'))
+        self.assertEqual(response.status_code, 406)
+
+    def test_export_parquet(self):
+        """ Test that the data export holds the daily rows within the
+        dates, with their quota details """
+        response = Client.open(
+            self.client, path="/export/data.parquet?until=2014-12-31",
+            headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, export.PARQUET)
+        table = pyarrow.parquet.read_table(io.BytesIO(response.data))
+        self.assertEqual(table.to_pydict(), {
+            'quota_guid': ['guid'],
+            'quota_name': ['test_name'],
+            'foundation': [None],
+            'date_collected': [datetime.date(2014, 1, 1)],
+            'month': [None],
+            'memory_limit': [1000],
+            'total_routes': [None],
+            'total_services': [None],
+            'days': [1],
+        })
+
+    def test_export_batches(self):
+        """ Test that the export is written one row group per batch """
+        path = 'test_export.parquet'
+        try:
+            self.assertEqual(export.write_parquet(path, [], batch_size=1), 2)
+            self.assertEqual(
+                pyarrow.parquet.ParquetFile(path).num_row_groups, 2)
+        finally:
+            os.remove(path)
+
     def test_main_page(self):
         """ Test the main page """
         response = Client.open(self.client, path='/', headers=valid_header)
@@ -574,6 +1038,83 @@ class QuotaAppTest(TestCase):
         # Check if quota data was rendered
         self.assertEqual(len(response.json['memory']), 1)
 
+    def test_api_quota_detail_ranges(self):
+        """ Test the quota details page with several date ranges """
+        response = Client.open(
+            self.client,
+            path="/api/quotas/guid/?range=2012..2013,2014-01..2014-02",
+            headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['memory'], [{'size': 1000, 'days': 1}])
+
+    def test_api_quotas_top_n(self):
+        """ Test sorting and limiting the quotas list """
+        response = Client.open(
+            self.client, path="/api/quotas/?sort=cost&limit=1",
+            headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [q['guid'] for q in response.json['Quotas']], ['guid'])
+        response = Client.open(
+            self.client, path="/api/quotas/?sort=url", headers=valid_header)
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_quotas_batch(self):
+        """ Test that the batch endpoint lists several quotas by guid and
+        reports the guids it didn't find """
+        response = Client.open(
+            self.client,
+            path="/api/quotas/batch?guids=guid,missing,guid_2"
+                 "&since=2013-12-31&until=2014-01-02",
+            headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        quotas = response.json['Quotas']
+        self.assertEqual([q['guid'] for q in quotas], ['guid', 'guid_2'])
+        self.assertEqual(quotas[0]['memory'], [{'size': 1000, 'days': 1}])
+        self.assertEqual(quotas[1]['memory'], [])
+        self.assertEqual(response.json['missing'], ['missing'])
+
+    def test_api_quotas_batch_post(self):
+        """ Test that the batch endpoint accepts the guids as a JSON body
+        and matches the single quota endpoint """
+        response = Client.open(
+            self.client, path="/api/quotas/batch", method='POST',
+            data=json.dumps({'guids': ['guid']}),
+            content_type='application/json', headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        single = Client.open(
+            self.client, path="/api/quotas/guid/", headers=valid_header)
+        self.assertEqual(response.json['Quotas'], [single.json])
+
+    def test_api_quotas_batch_invalid(self):
+        """ Test that malformed and oversized batches are rejected """
+        response = Client.open(
+            self.client, path="/api/quotas/batch", method='POST',
+            data=json.dumps({'guids': 'guid'}),
+            content_type='application/json', headers=valid_header)
+        self.assertEqual(response.status_code, 400)
+        response = Client.open(
+            self.client, path="/api/quotas/batch", method='POST',
+            data=json.dumps(['guid']),
+            content_type='application/json', headers=valid_header)
+        self.assertEqual(response.status_code, 400)
+        app.config['BATCH_MAX_GUIDS'] = 1
+        try:
+            response = Client.open(
+                self.client, path="/api/quotas/batch?guids=guid,guid_2",
+                headers=valid_header)
+        finally:
+            app.config['BATCH_MAX_GUIDS'] = 500
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_quota_detail_invalid_date(self):
+        """ Test that an invalid date is rejected """
+        response = Client.open(
+            self.client,
+            path="/api/quotas/guid/?since=yesterday",
+            headers=valid_header)
+        self.assertEqual(response.status_code, 400)
+
     def test_api_quota_detail_dates_no_data(self):
         """ Test the quota details page when there are date but no data """
         response = Client.open(
@@ -620,6 +1161,311 @@ class QuotaAppTest(TestCase):
         self.assertEqual(len(data[0]['memory']), 1)
 
 
+class InstrumentationTest(TestCase):
+    """ Test request profiling and SQL instrumentation """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        app.config['INSTRUMENTATION'] = True
+        app.config['INSTRUMENTATION_N_PLUS_ONE'] = 2
+        db.create_all()
+        for guid in ['guid', 'guid_2']:
+            quota = Quota(guid=guid, name='test_name', url='test_url')
+            db.session.add(quota)
+            quota_data = QuotaData(quota, datetime.date(2014, 1, 1))
+            quota_data.memory_limit = 1000
+            quota.data.append(quota_data)
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['INSTRUMENTATION'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def test_server_timing_header(self):
+        """ Check that requests report their timings """
+        response = Client.open(
+            self.client, path="/api/quotas/", headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        timing = response.headers['Server-Timing']
+        self.assertTrue('db;dur=' in timing)
+        self.assertTrue('serialize;dur=' in timing)
+        self.assertTrue('total;dur=' in timing)
+
+    def test_batch_query_count(self):
+        """ Check that the batch endpoint runs the same number of queries
+        whatever the number of guids """
+        counts = []
+        for guids in ['guid', 'guid,guid_2']:
+            response = Client.open(
+                self.client, path="/api/quotas/batch?guids=" + guids,
+                headers=valid_header)
+            self.assertEqual(response.status_code, 200)
+            timing = response.headers['Server-Timing']
+            counts.append(timing.split('desc="')[1].split(' ')[0])
+        self.assertEqual(counts[0], counts[1])
+
+    def test_metrics_endpoint(self):
+        """ Check that metrics are exposed in the Prometheus format """
+        Client.open(self.client, path="/api/quotas/", headers=valid_header)
+        response = Client.open(
+            self.client, path="/metrics", headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode('utf-8')
+        self.assertTrue('# TYPE quotas_db_queries_total counter' in body)
+        self.assertTrue(
+            'quotas_db_queries_total{endpoint="views.api_all_dates"}'
+            in body)
+
+    def test_n_plus_one_flagged(self):
+        """ Check that a request repeating a statement is counted """
+        with app.test_request_context('/api/quotas/'):
+            stats = instrumentation.RequestStats()
+            stats.record_query('SELECT 1', 0.1)
+            stats.record_query('SELECT 1', 0.1)
+            flask.g.request_stats = stats
+            instrumentation.finish_request(app.response_class('ok'))
+        self.assertTrue(
+            'quotas_n_plus_one_total{endpoint="views.api_all_dates"}'
+            in instrumentation.metrics.render())
+
+    def test_failed_query_timing(self):
+        """ Check that a statement that raises leaves no timing state on
+        its connection and doesn't skew the timing of the next one """
+        with app.test_request_context('/api/quotas/'):
+            stats = instrumentation.RequestStats()
+            flask.g.request_stats = stats
+            connection = db.engine.connect()
+            try:
+                self.assertRaises(
+                    Exception, connection.execute, 'SELECT * FROM missing')
+                time.sleep(0.2)
+                connection.execute('SELECT 1')
+                self.assertFalse('query_start_time' in connection.info)
+            finally:
+                connection.close()
+        self.assertEqual(stats.query_count, 1)
+        self.assertTrue(stats.db_time < 0.2)
+
+    def test_metrics_disabled(self):
+        """ Check that the metrics endpoint is hidden when disabled """
+        app.config['INSTRUMENTATION'] = False
+        response = Client.open(
+            self.client, path="/metrics", headers=valid_header)
+        self.assertEqual(response.status_code, 404)
+        response = Client.open(
+            self.client, path="/api/quotas/", headers=valid_header)
+        self.assertFalse('Server-Timing' in response.headers)
+
+    def test_repeated_statements(self):
+        """ Check that repeated identical statements are flagged """
+        stats = instrumentation.RequestStats()
+        stats.record_query('SELECT 1', 0.1)
+        stats.record_query('SELECT 1', 0.1)
+        stats.record_query('SELECT 2', 0.1)
+        self.assertEqual(stats.query_count, 3)
+        self.assertEqual(
+            stats.repeated_statements(2), [('SELECT 1', 2)])
+
+
+class ConnectionPoolTest(TestCase):
+    """ Test that connections are returned under concurrent requests """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        db.create_all()
+        quota = Quota(guid='guid', name='test_name', url='test_url')
+        db.session.add(quota)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_connections_stable_under_concurrency(self):
+        """ Check that concurrent requests never hold more connections than
+        the pool allows and return every one of them. SQLite normally gets
+        no pool, so the requests run against a QueuePool on the same
+        database sized from the pool settings """
+        pool_size = app.config['SQLALCHEMY_POOL_SIZE']
+        max_overflow = app.config['SQLALCHEMY_MAX_OVERFLOW']
+        engine = create_engine(
+            db.get_engine(app).url, poolclass=QueuePool,
+            pool_size=pool_size, max_overflow=max_overflow,
+            pool_timeout=app.config['SQLALCHEMY_POOL_TIMEOUT'],
+            connect_args={'check_same_thread': False})
+        peak = {'checked_out': 0}
+        lock = threading.Lock()
+
+        def on_checkout(*args):
+            with lock:
+                peak['checked_out'] = max(
+                    peak['checked_out'], engine.pool.checkedout())
+
+        event.listen(engine.pool, 'checkout', on_checkout)
+        statuses = []
+
+        def make_requests():
+            client = app.test_client()
+            for _ in range(5):
+                response = client.get(
+                    '/api/quotas/guid/', headers=valid_header)
+                statuses.append(response.status_code)
+
+        try:
+            with mock.patch.object(db, 'get_engine', return_value=engine):
+                threads = [
+                    threading.Thread(target=make_requests)
+                    for _ in range(10)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            event.remove(engine.pool, 'checkout', on_checkout)
+            engine.dispose()
+        self.assertEqual(statuses, [200] * 50)
+        self.assertTrue(peak['checked_out'] > 0)
+        self.assertTrue(peak['checked_out'] <= pool_size + max_overflow)
+        self.assertEqual(engine.pool.checkedout(), 0)
+
+
+class ReplicaRoutingTest(TestCase):
+    """ Test that reporting reads are routed to the read replica """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        self.replica_path = os.path.join(app.root_path, 'test_replica.db')
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///' + self.replica_path}
+        app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'] = 0
+        db._replica_health.clear()
+        db.create_all()
+        db.session.add(Quota(guid='primary_guid', name='primary'))
+        db.session.commit()
+        # The replica holds different rows so reads show where they went
+        replica = db.get_engine(app, bind='replica')
+        db.Model.metadata.create_all(bind=replica)
+        replica.execute(
+            Quota.__table__.insert(), guid='replica_guid', name='replica')
+
+    def tearDown(self):
+        db.session.remove()
+        db.Model.metadata.drop_all(bind=db.get_engine(app, bind='replica'))
+        db.drop_all()
+        app.config['SQLALCHEMY_BINDS'] = None
+        os.remove(self.replica_path)
+
+    def test_reads_use_replica(self):
+        """ Check that reads inside db.replica() go to the replica """
+        with db.replica():
+            quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['replica_guid'])
+        # Reads outside the block still go to the primary
+        quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['primary_guid'])
+
+    def test_api_reads_use_replica(self):
+        """ Check that the reporting endpoints read from the replica """
+        response = Client.open(
+            self.client, path="/api/quotas/", headers=valid_header)
+        self.assertEqual(response.json['Quotas'][0]['guid'], 'replica_guid')
+
+    def test_writes_use_primary(self):
+        """ Check that writes go to the primary even inside db.replica() """
+        with db.replica():
+            scripts.update_quota(mock_quota)
+        self.assertEqual(
+            Quota.query.filter_by(guid='test_quota').count(), 1)
+
+    def test_reads_after_write_use_primary(self):
+        """ Check that reads following a write inside db.replica(), such as
+        the refresh after a commit, go to the primary, and that the next
+        block reads from the replica again """
+        with db.replica():
+            quota = Quota(guid='new_guid', name='new')
+            db.session.add(quota)
+            db.session.commit()
+            self.assertEqual(quota.name, 'new')
+            self.assertEqual(
+                Quota.query.filter_by(guid='new_guid').count(), 1)
+        with db.replica():
+            quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['replica_guid'])
+
+    def test_fallback_when_replica_unavailable(self):
+        """ Check that reads fall back to the primary when the replica can't
+        be reached """
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:////nonexistent/directory/replica.db'}
+        try:
+            with db.replica():
+                quotas = QuotaResource.list_all()
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = {
+                'replica': 'sqlite:///' + self.replica_path}
+        self.assertEqual([q['guid'] for q in quotas], ['primary_guid'])
+
+    def test_fallback_when_replica_fails_between_checks(self):
+        """ Check that a replica that goes down between health checks fails
+        over to the primary on the read that finds it down """
+        app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'] = 3600
+        replica = db.get_engine(app, bind='replica')
+        with db.replica():
+            quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['replica_guid'])
+        db.session.remove()
+        down = exc.OperationalError('connect', {}, Exception('down'))
+        with mock.patch.object(replica, 'contextual_connect',
+                               side_effect=down):
+            with db.replica():
+                quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['primary_guid'])
+        # The replica stays out until its next health check
+        with db.replica():
+            quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['primary_guid'])
+
+    def test_fallback_when_replica_connection_lost(self):
+        """ Check that a read on a replica connection that is lost mid
+        session is retried on the primary """
+        app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'] = 3600
+        replica = db.get_engine(app, bind='replica')
+        execute = Connection.execute
+
+        def lose_replica(connection, *args, **kwargs):
+            if connection.engine is replica:
+                raise exc.OperationalError(
+                    'SELECT', {}, Exception('lost'),
+                    connection_invalidated=True)
+            return execute(connection, *args, **kwargs)
+        with db.replica():
+            self.assertEqual(
+                [q['guid'] for q in QuotaResource.list_all()],
+                ['replica_guid'])
+            with mock.patch.object(Connection, 'execute', lose_replica):
+                quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['primary_guid'])
+
+    def test_fallback_when_replica_lags(self):
+        """ Check that reads fall back to the primary when the replica lags
+        past the threshold """
+        app.config['SQLALCHEMY_REPLICA_MAX_LAG'] = 30
+        with mock.patch('database.replica_lag', return_value=120):
+            with db.replica():
+                quotas = QuotaResource.list_all()
+        self.assertEqual([q['guid'] for q in quotas], ['primary_guid'])
+
+
 class LoadingTest(TestCase):
     """ Test Database """
 
@@ -684,6 +1530,172 @@ class LoadingTest(TestCase):
         found = Quota.query.filter_by(guid='test_guid').all()
         self.assertEqual(len(found), 1)
 
+    @mock_token
+    @mock_quotas_request
+    def test_load_data_records_run(self):
+        """ Test that a loader run is recorded with its metrics """
+        scripts.load_data()
+        run = LoadRun.query.one()
+        self.assertEqual(run.status, 'success')
+        self.assertEqual(run.foundation, 'default')
+        self.assertEqual(run.rows_upserted, 2)
+        self.assertEqual(run.errors, 0)
+        self.assertEqual(run.pages_fetched, 1)
+        self.assertTrue(run.duration >= 0)
+
+    @mock_token
+    def test_load_data_records_failure(self):
+        """ Test that a failed loader run is recorded """
+        with mock.patch.object(
+                requests, 'get', side_effect=requests.ConnectionError):
+            self.assertRaises(requests.ConnectionError, scripts.load_data)
+        run = LoadRun.query.one()
+        self.assertEqual(run.status, 'failed')
+        self.assertTrue(run.finished_at is not None)
+
+    def test_load_quotas_counts_errors(self):
+        """ Test that a quota that fails to load is counted and skipped """
+        broken_quota = copy.deepcopy(mock_quota_2)
+        broken_quota['metadata']['created_at'] = 'not a date'
+        cf_api = mock.Mock()
+        cf_api.get_quotas.return_value = [broken_quota, mock_quota]
+        stats = scripts.load_quotas(cf_api=cf_api)
+        self.assertEqual(stats.rows_upserted, 1)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(Quota.query.filter_by(guid='test_quota').count(), 1)
+
+    def test_load_quotas_skips_bad_quota(self):
+        """ Test that a bad quota in the middle of a batch is skipped and
+        the quotas around it are committed """
+        broken_quota = copy.deepcopy(mock_quota_2)
+        broken_quota['metadata']['created_at'] = 'not a date'
+        quotas = bench.generate_quota_definitions(4)
+        cf_api = mock.Mock()
+        cf_api.get_quotas.return_value = quotas[:2] + [broken_quota] + \
+            quotas[2:]
+        stats = scripts.load_quotas(cf_api=cf_api, batch_size=5)
+        self.assertEqual((stats.rows_upserted, stats.errors), (4, 1))
+        db.session.remove()
+        self.assertEqual(
+            sorted(guid for guid, in db.session.query(Quota.guid)),
+            sorted(quota['metadata']['guid'] for quota in quotas))
+
+    def test_load_quotas_pipeline(self):
+        """ Test that quotas are fetched and written in batches through a
+        bounded queue """
+        cf_api = bench.SyntheticCloudFoundry(
+            bench.generate_quota_definitions(5))
+        stats = scripts.load_quotas(cf_api=cf_api, batch_size=2, queue_size=1)
+        self.assertEqual(Quota.query.count(), 5)
+        self.assertEqual(stats.quotas_fetched, 5)
+        self.assertEqual(stats.rows_upserted, 5)
+        self.assertEqual(stats.batches, 3)
+        self.assertTrue(stats.queue_depth_max <= 1)
+
+    def test_load_quotas_fetch_error(self):
+        """ Test that an error in the fetch stage is raised by the loader
+        after the batches fetched before it are written """
+        def get_quotas():
+            yield mock_quota
+            raise requests.ConnectionError()
+        cf_api = mock.Mock()
+        cf_api.get_quotas.side_effect = get_quotas
+        self.assertRaises(
+            requests.ConnectionError, scripts.load_quotas,
+            cf_api=cf_api, batch_size=1)
+        self.assertEqual(Quota.query.filter_by(guid='test_quota').count(), 1)
+
+    def test_load_sources_isolates_failures(self):
+        """ Test that foundations are loaded concurrently, tagged with their
+        name, and that a failing foundation doesn't stop the others """
+        def fail():
+            raise requests.ConnectionError()
+        east = scripts.FoundationSource(
+            'east', lambda: bench.SyntheticCloudFoundry(
+                bench.generate_quota_definitions(3)))
+        west = scripts.FoundationSource('west', fail)
+        scripts.load_sources([east, west], batch_size=2)
+        self.assertEqual(Quota.query.filter_by(foundation='east').count(), 3)
+        self.assertEqual(east.stats.rows_upserted, 3)
+        self.assertTrue(east.error is None)
+        self.assertTrue(isinstance(west.error, requests.ConnectionError))
+
+    def test_load_sources_fetcher_exits_during_get(self):
+        """ Test that batches put by a fetcher that exits while the writer
+        waits on the queue are still written """
+        class LateQueue(queue.Queue):
+            """ Times out the first get only after the fetchers exited """
+            timed_out = False
+
+            def get(self, block=True, timeout=None):
+                if not self.timed_out:
+                    self.timed_out = True
+                    for thread in threading.enumerate():
+                        if thread.name.startswith('quota-fetcher-'):
+                            thread.join(5)
+                    raise queue.Empty()
+                return super().get(block, timeout)
+        east = scripts.FoundationSource(
+            'east', lambda: bench.SyntheticCloudFoundry(
+                bench.generate_quota_definitions(3)))
+        with mock.patch.object(scripts.queue, 'Queue', LateQueue):
+            scripts.load_sources([east], batch_size=2, queue_size=4)
+        self.assertEqual(Quota.query.filter_by(foundation='east').count(), 3)
+        self.assertTrue(east.error is None)
+
+    def test_load_sources_finishes_each_source(self):
+        """ Test that a foundation is finished as soon as it is done,
+        without waiting for a slower one """
+        east_finished = threading.Event()
+        finished = []
+
+        def connect_west():
+            east_finished.wait(5)
+            return bench.SyntheticCloudFoundry(
+                bench.generate_quota_definitions(1))
+
+        def on_finish(source):
+            finished.append((source.name, east_finished.is_set()))
+            east_finished.set()
+        east = scripts.FoundationSource(
+            'east', lambda: bench.SyntheticCloudFoundry(
+                bench.generate_quota_definitions(3)))
+        west = scripts.FoundationSource('west', connect_west)
+        scripts.load_sources([east, west], batch_size=2, on_finish=on_finish)
+        self.assertEqual(finished, [('east', False), ('west', True)])
+
+    def test_readyz_without_data(self):
+        """ Test that the app reports not ready before the first load """
+        response = self.client.get("/readyz")
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json['has_data'])
+        self.assertEqual(response.json['data_age_seconds'], None)
+
+    @mock_token
+    @mock_quotas_request
+    def test_readyz_with_data(self):
+        """ Test that the app reports ready with the data age after a load """
+        scripts.load_data()
+        response = self.client.get("/readyz")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['ready'])
+        self.assertTrue(response.json['data_age_seconds'] >= 0)
+
+    def test_healthz(self):
+        """ Test that the liveness check doesn't need auth or data """
+        response = self.client.get("/healthz")
+        self.assert_200(response)
+
+    def test_api_loads(self):
+        """ Test that loader runs are listed by the api """
+        db.session.add(LoadRun())
+        db.session.commit()
+        response = Client.open(
+            self.client, path="/api/loads/", headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['Loads']), 1)
+        self.assertEqual(response.json['Loads'][0]['status'], 'running')
+
     def test_get_or_create_get(self):
         """ Test that get_or_create function gets an old object """
         # Create and add a quota
@@ -700,5 +1712,449 @@ class LoadingTest(TestCase):
         self.assertEqual(len(found), 1)
 
 
+class ReportJobTest(TestCase):
+    """ Test background report jobs """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        db.create_all()
+        quota = Quota(guid='guid', name='test_name', url='test_url')
+        db.session.add(quota)
+        quota_data = QuotaData(quota, datetime.date(2014, 1, 1))
+        quota_data.memory_limit = 1000
+        quota.data.append(quota_data)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(app.config['REPORTS_DIR'], ignore_errors=True)
+        app.config['PRECOMPUTED_REPORTS'] = False
+
+    def wait_for_report(self, report_id):
+        """ Poll a job until its background build finishes """
+        for _ in range(100):
+            status = reports.load_status(report_id)
+            if status['status'] in ('ready', 'failed'):
+                return status
+            time.sleep(0.05)
+        self.fail('Report {0} did not finish'.format(report_id))
+
+    def test_report_job(self):
+        """ Test that a submitted report is built and downloaded """
+        response = Client.open(
+            self.client, path="/api/reports/", method='POST',
+            data=json.dumps({'format': 'csv', 'since': '2013-06-01'}),
+            content_type='application/json', headers=valid_header)
+        self.assertEqual(response.status_code, 202)
+        report_id = response.json['id']
+        self.assertEqual(self.wait_for_report(report_id)['status'], 'ready')
+        response = Client.open(
+            self.client, path="/api/reports/{0}/".format(report_id),
+            headers=valid_header)
+        self.assertEqual(response.json['status'], 'ready')
+        response = Client.open(
+            self.client, path=response.json['download_url'],
+            headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.data.decode('utf-8'),
+            QuotaResource.generate_cvs(start_date='2013-06-01'))
+
+    def test_json_report(self):
+        """ Test that JSON reports hold the quotas list """
+        status = reports.submit({'format': 'json', 'sort': 'cost'})
+        self.wait_for_report(status['id'])
+        path, mimetype = reports.result_file(
+            reports.load_status(status['id']))
+        self.assertEqual(mimetype, 'application/json')
+        with open(path) as f:
+            self.assertEqual(
+                json.load(f)['Quotas'],
+                QuotaResource.list_all(sort='cost', descending=True))
+
+    def test_duplicate_specs_share_a_job(self):
+        """ Test that the same spec over the same data is built once """
+        first = reports.submit({'since': '2014', 'format': 'csv'})
+        self.wait_for_report(first['id'])
+        second = reports.submit({'format': 'csv', 'since': '2014'})
+        self.assertEqual(first['id'], second['id'])
+        self.assertEqual(second['status'], 'ready')
+        self.assertEqual(first['created_at'], second['created_at'])
+        # A new load changes the data, and so the job
+        run = LoadRun()
+        run.status = 'success'
+        db.session.add(run)
+        db.session.commit()
+        third = reports.submit({'format': 'csv', 'since': '2014'})
+        self.assertNotEqual(first['id'], third['id'])
+        self.wait_for_report(third['id'])
+
+    def test_failed_job_retried_once(self):
+        """ Test that of the requests that find a job failed, only one
+        starts the retry """
+        with mock.patch.object(
+                reports, 'build_report', side_effect=RuntimeError):
+            first = reports.submit({'format': 'csv'})
+            failed = self.wait_for_report(first['id'])
+        self.assertEqual(failed['status'], 'failed')
+        retry = dict(failed, status='pending', updated_at=time.time())
+        self.assertTrue(reports.claim_retry(retry, failed))
+        self.assertFalse(reports.claim_retry(dict(retry), failed))
+        self.assertEqual(
+            reports.load_status(first['id'])['updated_at'],
+            retry['updated_at'])
+        with mock.patch.object(reports, 'get_executor') as get_executor:
+            self.assertEqual(
+                reports.submit({'format': 'csv'})['status'], 'pending')
+        self.assertFalse(get_executor.called)
+
+    def test_gevent_job_built_in_process(self):
+        """ Test that in gevent workers a job is built by a child process,
+        and fails if the child dies without an outcome """
+        with mock.patch.object(
+                reports, 'in_gevent_worker', return_value=True):
+            status = reports.submit({'format': 'csv'})
+            self.assertEqual(self.wait_for_report(status['id'])['status'],
+                             'ready')
+            with mock.patch.object(
+                    reports.subprocess, 'call', return_value=-9) as call:
+                status = reports.submit({'format': 'json'})
+                failed = self.wait_for_report(status['id'])
+        self.assertEqual(call.call_args[0][0][-2:], ['report', status['id']])
+        self.assertEqual(failed['status'], 'failed')
+
+    def test_job_names_instance(self):
+        """ Test that a job records the Cloud Foundry instance that took
+        it """
+        environ = {
+            'CF_INSTANCE_INDEX': '1',
+            'VCAP_APPLICATION': json.dumps({'application_id': 'app-guid'}),
+        }
+        with mock.patch.dict(os.environ, environ):
+            status = reports.submit({'format': 'csv'})
+        self.assertEqual(status['instance'], 'app-guid:1')
+        self.wait_for_report(status['id'])
+        with mock.patch.dict(os.environ, {'VCAP_APPLICATION': ''}):
+            self.assertEqual(reports.instance(), None)
+
+    def test_standard_reports_served(self):
+        """ Test that requests matching a standard report are served from
+        its file and others are computed live """
+        app.config['PRECOMPUTED_REPORTS'] = True
+        reports.write_standard_reports(today=datetime.date(2014, 1, 15))
+        expected = QuotaResource.generate_cvs(
+            start_date='2014-01-01', end_date='2014-01-15')
+        with mock.patch.object(
+                QuotaResource, 'generate_cvs', side_effect=AssertionError):
+            for query in ['since=2014-01', 'range=2014-01',
+                          'since=2014-01-01&until=2014-02-01']:
+                response = Client.open(
+                    self.client, path="/quotas.csv?" + query,
+                    headers=valid_header)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data.decode('utf-8'), expected)
+        response = Client.open(
+            self.client, path="/api/quotas/?range=2013-12",
+            headers=valid_header)
+        self.assertEqual(
+            response.json['Quotas'],
+            QuotaResource.list_all(start_date='2013-12-01',
+                                   end_date='2013-12-31'))
+        self.assertEqual(
+            reports.standard_report(
+                filters.parse_ranges(since='2014-01'), 'csv', sort='cost'),
+            None)
+        self.assertEqual(
+            reports.standard_report(
+                filters.parse_ranges(since='2013-01'), 'csv'),
+            None)
+
+    def test_standard_reports_replaced(self):
+        """ Test that each load replaces the standard reports and that a
+        failed write withdraws them """
+        app.config['PRECOMPUTED_REPORTS'] = True
+        first = reports.write_standard_reports()
+        second = reports.write_standard_reports()
+        self.assertNotEqual(first['version'], second['version'])
+        self.assertEqual(
+            set(report.version for report in StandardReport.query),
+            {second['version']})
+        self.assertEqual(StandardReport.query.count(), 6)
+        with mock.patch.object(
+                reports, 'render_report', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, reports.write_standard_reports)
+        self.assertEqual(reports.load_manifest(), None)
+        self.assertEqual(StandardReport.query.count(), 0)
+
+    def test_standard_reports_on_every_instance(self):
+        """ Test that an instance other than the loader's serves the
+        standard reports from the database and keeps a copy on its disk,
+        replacing the copy when a load writes new reports """
+        app.config['PRECOMPUTED_REPORTS'] = True
+        first = reports.write_standard_reports(
+            today=datetime.date(2014, 1, 15))
+        # Another instance has nothing under its own REPORTS_DIR
+        shutil.rmtree(app.config['REPORTS_DIR'], ignore_errors=True)
+        expected = QuotaResource.generate_cvs(
+            start_date='2014-01-01', end_date='2014-01-15')
+        with mock.patch.object(
+                QuotaResource, 'generate_cvs', side_effect=AssertionError):
+            response = Client.open(
+                self.client, path="/quotas.csv?since=2014-01",
+                headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode('utf-8'), expected)
+        self.assertEqual(
+            os.listdir(reports.standard_dir()), [first['version']])
+        second = reports.write_standard_reports(
+            today=datetime.date(2014, 1, 15))
+        path, mimetype = reports.standard_report(
+            filters.parse_ranges(since='2014-01'), 'json')
+        self.assertEqual(mimetype, 'application/json')
+        self.assertEqual(
+            os.listdir(reports.standard_dir()), [second['version']])
+
+    def test_job_statement_timeout(self):
+        """ Test that a job's transactions run with the job statement
+        timeout rather than the one of requests """
+        app.config['JOB_STATEMENT_TIMEOUT'] = 0
+        timeouts = []
+        render_report = reports.render_report
+
+        def render(*args, **kwargs):
+            timeouts.append(db.session().statement_timeout)
+            return render_report(*args, **kwargs)
+        with mock.patch.object(reports, 'render_report', side_effect=render):
+            reports.build_report(reports.normalize_spec({'format': 'csv'}))
+        self.assertEqual(timeouts, [0])
+        self.assertEqual(db.session().statement_timeout, None)
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+        database.apply_statement_timeout(db.session(), None, connection)
+        self.assertFalse(connection.execute.called)
+        with db.statement_timeout(0):
+            database.apply_statement_timeout(db.session(), None, connection)
+        connection.execute.assert_called_once_with(
+            'SET LOCAL statement_timeout = 0')
+
+    def test_invalid_reports(self):
+        """ Test that invalid specs and unknown jobs are rejected """
+        response = Client.open(
+            self.client, path="/api/reports/", method='POST',
+            data=json.dumps({'format': 'xml'}),
+            content_type='application/json', headers=valid_header)
+        self.assertEqual(response.status_code, 400)
+        response = Client.open(
+            self.client, path="/api/reports/missing/", headers=valid_header)
+        self.assertEqual(response.status_code, 404)
+
+
+class StatementTest(TestCase):
+    """ Test the monthly statements """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        db.create_all()
+        for guid in ['guid_a', 'guid_b']:
+            quota = Quota(guid=guid, name=guid + '_name', url='test_url')
+            db.session.add(quota)
+            for day in [datetime.date(2014, 1, 1), datetime.date(2014, 1, 2),
+                        datetime.date(2014, 2, 1)]:
+                quota_data = QuotaData(quota, day)
+                quota_data.memory_limit = 1000
+        db.session.commit()
+        self.out_dir = 'test_statements'
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+    def test_statement_months(self):
+        """ Test that only complete months are included, oldest first """
+        self.assertEqual(
+            statements.statement_months(2, today=datetime.date(2014, 3, 5)),
+            [datetime.date(2014, 1, 1), datetime.date(2014, 2, 1)])
+
+    def test_generate_statements(self):
+        """ Test that each month gets a statement matching the quota
+        aggregates and that the manifest lists them """
+        manifest = statements.generate_statements(
+            'config.TestingConfig', months=3, out_dir=self.out_dir,
+            workers=2, today=datetime.date(2014, 3, 5))
+        self.assertEqual(
+            [entry['month'] for entry in manifest['months']],
+            ['2013-12', '2014-01', '2014-02'])
+        self.assertEqual(
+            [entry['quotas'] for entry in manifest['months']], [0, 2, 2])
+        self.assertEqual(manifest['quotas'], 4)
+        with open(os.path.join(self.out_dir, statements.MANIFEST)) as f:
+            self.assertEqual(json.load(f)['quotas'], 4)
+        with open(os.path.join(self.out_dir, 'statement-2014-01.csv')) as f:
+            lines = f.read().splitlines()
+        expected = QuotaResource.list_one_aggregate(
+            'guid_a', start_date='2014-01-01', end_date='2014-01-31')
+        self.assertEqual(lines[0], ','.join(statements.HEADER))
+        self.assertEqual(
+            lines[1].split(','),
+            ['2014-01', '', 'guid_a_name', 'guid_a', '2000',
+             str(expected['cost'])])
+
+
+class AdmissionTest(TestCase):
+    """ Test admission control of the heavy report routes """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.config = dict(app.config)
+        app.config['HEAVY_REQUEST_LIMIT'] = 1
+        app.config['HEAVY_REQUEST_QUEUE'] = 1
+        app.config['HEAVY_REQUEST_QUEUE_TIMEOUT'] = 0.2
+
+    def tearDown(self):
+        app.config.update(self.config)
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(app.config['ADMISSION_DIR'], ignore_errors=True)
+
+    def test_saturated(self):
+        """ Test that heavy routes are turned away while the slots are
+        taken and that other routes are not """
+        running, queued = admission.slots()
+        held = running.acquire()
+        try:
+            self.assertEqual(admission.status()['in_flight'], 1)
+            for path in ["/api/quotas/", "/quotas.csv",
+                         "/api/quotas/batch?guids=a"]:
+                response = Client.open(
+                    self.client, path=path, headers=valid_header)
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers['Retry-After'], '5')
+            response = Client.open(
+                self.client, path="/api/quotas/guid/", headers=valid_header)
+            self.assertEqual(response.status_code, 404)
+        finally:
+            running.release(held)
+        response = Client.open(
+            self.client, path="/api/quotas/", headers=valid_header)
+        self.assertEqual(response.status_code, 200)
+        response = Client.open(
+            self.client, path="/api/admission/", headers=valid_header)
+        self.assertEqual(response.json['in_flight'], 0)
+
+    def test_queued(self):
+        """ Test that a queued request runs once a slot frees up """
+        running, queued = admission.slots()
+        held = running.acquire()
+        threading.Timer(0.05, running.release, [held]).start()
+        with admission.admitted():
+            self.assertEqual(admission.status()['in_flight'], 1)
+        self.assertEqual(admission.status()['in_flight'], 0)
+
+    def test_status_takes_no_locks(self):
+        """ Test that counting the slots in use doesn't lock any, so
+        monitoring can't turn requests away """
+        running, queued = admission.slots()
+        held = running.acquire()
+        try:
+            with mock.patch.object(
+                    admission.fcntl, 'flock', side_effect=AssertionError):
+                self.assertEqual(admission.status()['in_flight'], 1)
+                self.assertEqual(admission.status()['queued'], 0)
+        finally:
+            running.release(held)
+        self.assertEqual(admission.status()['in_flight'], 0)
+
+    def test_disabled(self):
+        """ Test that a limit of 0 admits every request """
+        app.config['HEAVY_REQUEST_LIMIT'] = 0
+        with admission.admitted():
+            with admission.admitted():
+                pass
+
+
+class BenchTest(TestCase):
+    """ Test the benchmark helpers """
+
+    def create_app(self):
+        app.config['LIVESERVER_PORT'] = 8943
+        return app
+
+    def setUp(self):
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_populate_database(self):
+        """ Check that the generator creates quotas x days of data """
+        guids = bench.populate_database(n_quotas=3, n_days=10)
+        self.assertEqual(len(guids), 3)
+        self.assertEqual(Quota.query.count(), 3)
+        self.assertEqual(QuotaData.query.count(), 30)
+
+    def test_synthetic_definitions_load(self):
+        """ Check that generated definitions can be loaded by the loader """
+        cf_api = bench.SyntheticCloudFoundry(
+            bench.generate_quota_definitions(2))
+        scripts.load_quotas(cf_api=cf_api)
+        self.assertEqual(Quota.query.count(), 2)
+        self.assertEqual(QuotaData.query.count(), 2)
+
+    def test_measure_allocations(self):
+        """ Check that allocations of the read paths are measured """
+        bench.populate_database(n_quotas=2, n_days=3)
+        allocation = bench.measure_allocations(QuotaResource.list_all)
+        self.assertTrue(allocation['peak_bytes'] > 0)
+        self.assertEqual(
+            bench.list_all_orm(None, None), QuotaResource.list_all())
+
+    def test_measure_storage(self):
+        """ Check that the size and full scan of the data table are
+        measured """
+        bench.populate_database(n_quotas=2, n_days=3)
+        storage = bench.measure_storage()
+        self.assertTrue(storage['data_bytes'] > 0)
+        self.assertEqual(storage['full_scan']['repeat'], 3)
+
+    def test_loadtest_mix(self):
+        """ Check that load test mixes are parsed and validated """
+        self.assertEqual(
+            loadtest.parse_mix(loadtest.DEFAULT_MIX),
+            {'list': 3, 'detail': 6, 'csv': 1})
+        self.assertRaises(ValueError, loadtest.parse_mix, 'list=1,other=2')
+        self.assertRaises(ValueError, loadtest.parse_mix, 'list=0')
+
+    def test_loadtest_summary(self):
+        """ Check the throughput and latency percentiles of a load test """
+        samples = [('detail', 200, index / 100.0) for index in range(1, 101)]
+        samples.append(('csv', 503, 2.0))
+        summary = loadtest.summarize(samples, elapsed=10)
+        self.assertEqual(summary['detail']['p50'], 0.5)
+        self.assertEqual(summary['detail']['p99'], 0.99)
+        self.assertEqual(summary['detail']['requests_per_second'], 10)
+        self.assertEqual(summary['all']['requests'], 101)
+        self.assertEqual(summary['all']['rejected'], 1)
+        self.assertEqual(summary['csv']['ok'], 0)
+
+    def test_time_call(self):
+        """ Check that time_call reports timings for each repeat """
+        timing = bench.time_call(lambda: None, repeat=2)
+        self.assertEqual(timing['repeat'], 2)
+        self.assertTrue(timing['min'] <= timing['mean'] <= timing['max'])
+
+
 if __name__ == "__main__":
     unittest.main()